@@ -0,0 +1,298 @@
+"""
+Benchmarks of the request hot paths through the Flask test client.
+
+Everything runs against a synthetic user tree in a temp folder with its own database,
+the real users_space and file_browser.db are not touched. Run from the repository root:
+
+    python -m benchmarks.run --entries 10000 --depth 3
+    python -m benchmarks.run --save-baseline
+
+Results are compared with benchmarks/baseline.json, a p50 slower than the baseline
+by more than --tolerance fails the run.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+
+from benchmarks.trees import build_tree, parse_size_mix, DEFAULT_SIZE_MIX
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+USERNAME = "benchuser"
+PASSWORD = "benchmark-password"
+
+# Body of every uploaded file
+UPLOAD_SIZE = 16 * 1024
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of this process so far, ru_maxrss is in KiB on Linux
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(count, send, check=None, after=None, warmup=5):
+    """
+    Call send(number) count times and time each request until its body is read and closed.
+    The first warmup requests fill caches and are not timed, numbers continue after them.
+    check(number, response) must return True for the response to count, after(number)
+    runs outside of the timing.
+    """
+    durations = []
+
+    for number in range(warmup + count):
+        started = time.perf_counter()
+        response = send(number)
+        response.get_data()
+        response.close()
+        if number >= warmup:
+            durations.append(time.perf_counter() - started)
+
+        if check is not None and not check(number, response):
+            raise BenchmarkError(f"Unexpected response {response.status_code} {response.location or ''}")
+        if after is not None:
+            after(number)
+
+    total = sum(durations)
+    return {'requests': count,
+            'throughput': round(count / total, 1),
+            'p50_ms': round(percentile(durations, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+            'peak_rss_mb': round(get_peak_rss_mb(), 1),
+            }
+
+def create_benchmark_app(folder, password_method):
+    from file_browser import create_app
+
+    return create_app({
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'BACKGROUND_SERVICES': False,
+        'SQLALCHEMY_DATABASE_URI': "sqlite:///" + os.path.join(folder, "benchmark.db"),
+        'UPLOAD_FOLDER': os.path.join(folder, "users_space"),
+        'SEARCH_INDEX_FOLDER': os.path.join(folder, "search_index"),
+        'THUMBNAIL_FOLDER': os.path.join(folder, "thumbnails"),
+        'THUMBNAIL_ON_UPLOAD': False,
+        'PROVISION_TEMPLATE_FOLDER': os.path.join(folder, "user_template"),
+        'SESSION_FOLDER': os.path.join(folder, "flask_session"),
+        'PROFILE_FOLDER': os.path.join(folder, "profiles"),
+        'PASSWORD_HASH_METHOD': password_method,
+        # Same client logs in again and again, the limits would refuse it
+        'LOGIN_USERNAME_BURST': 0,
+        'LOGIN_IP_BURST': 0,
+        'USER_STORAGE_QUOTA': 0,
+    })
+
+def create_benchmark_user(app, entries, depth, size_mix):
+    """
+    Register the benchmark user and build the synthetic tree in its folder.
+    Returns the tree description from
+    :build_tree()
+    """
+    from file_browser import db
+    from file_browser.models import User
+    from file_browser.helpers import get_user_root
+    from file_browser.passwords import hash_password
+    from file_browser.provisioning import provision_user, PROVISIONING_READY
+
+    with app.app_context():
+        db.session.add(User(username=USERNAME, password=hash_password(PASSWORD)))
+        db.session.commit()
+        if provision_user(USERNAME) != PROVISIONING_READY:
+            raise BenchmarkError("Benchmark user folder could not be created")
+
+        root = get_user_root(USERNAME)
+        tree = build_tree(os.path.join(root, "bench"), entries, depth, size_mix)
+
+    tree['levels'] = [f"bench/{level}" for level in tree['levels']]
+    tree['samples'] = {size: f"bench/{path}" for size, path in tree['samples'].items()}
+    tree['root'] = root
+    return tree
+
+def run_benchmarks(app, tree, iterations, auth_iterations):
+    from file_browser.dircache import directory_cache
+
+    results = {}
+    client = app.test_client()
+
+    def redirects_to(location):
+        return lambda number, response: response.status_code == 302 and response.location == location
+
+    def is_ok(number, response):
+        return response.status_code == 200
+
+    def clear_flashes(number):
+        # Download flashes the integrity result, a browser would show it on the next page
+        with client.session_transaction() as session:
+            session.pop('_flashes', None)
+
+    # Registration and login hash a password on every request
+    results['register'] = measure(
+        auth_iterations,
+        lambda number: app.test_client().post("/register", data={'username': f"bench{number:06d}",
+                                                                  'password': PASSWORD,
+                                                                  'confirm_password': PASSWORD}),
+        redirects_to("/login"))
+
+    results['login'] = measure(
+        auth_iterations,
+        lambda number: client.post("/login", data={'username': USERNAME, 'password': PASSWORD}),
+        redirects_to("/"))
+
+    wide, deep = tree['levels'][0], tree['levels'][-1]
+
+    results['index'] = measure(iterations, lambda number: client.get(f"/{wide}"), is_ok)
+    results['index_sorted_by_size'] = measure(iterations, lambda number: client.get(f"/{wide}?sort=size&order=desc"), is_ok)
+    results['index_deep'] = measure(iterations, lambda number: client.get(f"/{deep}"), is_ok)
+    results['index_uncached'] = measure(iterations, lambda number: client.get(f"/{wide}"), is_ok,
+                                        after=lambda number: directory_cache.clear())
+
+    for size, path in sorted(tree['samples'].items()):
+        results[f"download_{size}"] = measure(iterations, lambda number: client.get(f"/download/{path}"), is_ok,
+                                              after=clear_flashes)
+
+    # Same downloads with FILE_DELIVERY=x-accel-redirect, the worker is done after the checks and
+    # the front proxy sends the bytes. The time is how long a worker thread is busy with the request
+    def is_offloaded(number, response):
+        return response.status_code == 200 and "X-Accel-Redirect" in response.headers
+
+    app.config['FILE_DELIVERY'] = "x-accel-redirect"
+    for size, path in sorted(tree['samples'].items()):
+        results[f"download_{size}_offloaded"] = measure(iterations, lambda number: client.get(f"/download/{path}"),
+                                                        is_offloaded, after=clear_flashes)
+    app.config['FILE_DELIVERY'] = "direct"
+
+    # Text, uploads are checked to start like their .txt extension
+    body = os.urandom(UPLOAD_SIZE // 2).hex().encode()
+    upload_folder = os.path.join(tree['root'], wide)
+
+    results['upload_file'] = measure(
+        iterations,
+        lambda number: client.post("/upload_file",
+                                   data={'folder_path': f"/{wide}",
+                                         'upload_file_name': (io.BytesIO(body), f"upload_{number:06d}.txt")},
+                                   content_type="multipart/form-data"),
+        lambda number, response: os.path.isfile(os.path.join(upload_folder, f"upload_{number:06d}.txt")))
+
+    results['rename'] = measure(
+        iterations,
+        lambda number: client.post("/rename_file", json={'old_file_name': f"upload_{number:06d}.txt",
+                                                         'file_suffix': "txt",
+                                                         'new_file_name': f"renamed_{number:06d}",
+                                                         'path_to_file': f"/{wide}"}),
+        lambda number, response: os.path.isfile(os.path.join(upload_folder, f"renamed_{number:06d}.txt")))
+
+    results['delete_file'] = measure(
+        iterations,
+        lambda number: client.post("/delete_file", json={'delete_file': f"renamed_{number:06d}.txt",
+                                                         'path_to_delete_file': f"/{wide}"}),
+        is_ok)
+
+    return results
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Returns names of benchmarks whose p50 is slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected and result['p50_ms'] > expected['p50_ms'] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+def print_results(results, baseline):
+    print(f"{'benchmark':<24}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'rss MB':>9}{'vs base':>9}")
+    for name, result in results.items():
+        expected = baseline.get(name)
+        change = f"{result['p50_ms'] / expected['p50_ms'] - 1:+.0%}" if expected and expected['p50_ms'] else "-"
+        print(f"{name:<24}{result['throughput']:>10}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+              f"{result['peak_rss_mb']:>9}{change:>9}")
+
+def get_environment(args):
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'entries': args.entries,
+            'depth': args.depth,
+            'sizes': args.sizes,
+            'iterations': args.iterations,
+            'auth_iterations': args.auth_iterations,
+            'password_method': args.password_method,
+            }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark listing, upload, download and auth requests.")
+    parser.add_argument("--entries", type=int, default=1000, help="Entries in the synthetic tree (10 to 100000).")
+    parser.add_argument("--depth", type=int, default=3, help="Nested folder levels the entries are spread over.")
+    parser.add_argument("--sizes", default="512:60,16k:30,1m:10", help="File size mix as size:weight,...")
+    parser.add_argument("--iterations", type=int, default=200, help="Requests per benchmark.")
+    parser.add_argument("--auth-iterations", type=int, default=20, help="Requests for register and login.")
+    parser.add_argument("--password-method", default="scrypt", help="Werkzeug password hash method.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare with.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed p50 slowdown against the baseline.")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file.")
+    args = parser.parse_args(argv)
+
+    if not 10 <= args.entries <= 100_000:
+        parser.error("--entries must be between 10 and 100000")
+
+    size_mix = parse_size_mix(args.sizes) if args.sizes else DEFAULT_SIZE_MIX
+    folder = tempfile.mkdtemp(prefix="file-browser-benchmark-")
+
+    try:
+        started = time.perf_counter()
+        app = create_benchmark_app(folder, args.password_method)
+        tree = create_benchmark_user(app, args.entries, args.depth, size_mix)
+        print(f"Built tree of {args.entries} entries in {args.depth} levels in {time.perf_counter() - started:.1f}s")
+
+        results = run_benchmarks(app, tree, args.iterations, args.auth_iterations)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['environment'] != get_environment(args):
+            print("Baseline was recorded with other settings or on other machine, comparison is only indicative")
+        baseline = stored['results']
+
+    print_results(results, baseline)
+
+    report = {'environment': get_environment(args), 'results': results}
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"Slower than baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
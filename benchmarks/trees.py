@@ -0,0 +1,69 @@
+import os
+import random
+
+# Default mix of file sizes as (bytes, weight)
+DEFAULT_SIZE_MIX = ((512, 60), (16 * 1024, 30), (1024 * 1024, 10))
+
+# Files bigger than this are created sparse, a 100k entry tree must not need gigabytes of disk
+SPARSE_THRESHOLD = 64 * 1024
+
+
+def parse_size(text):
+    """
+    '512', '16k', '4m' or '1g' to bytes
+    """
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    text = text.strip().lower()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_size_mix(text):
+    """
+    '512:60,16k:30,1m:10' to ((512, 60), (16384, 30), (1048576, 10))
+    """
+    mix = []
+    for part in text.split(","):
+        size, _, weight = part.partition(":")
+        mix.append((parse_size(size), int(weight or 1)))
+    return tuple(mix)
+
+def write_file(path, size, rng):
+    with open(path, "wb") as f:
+        if size > SPARSE_THRESHOLD:
+            f.truncate(size)
+        else:
+            f.write(rng.randbytes(size))
+
+def build_tree(root, entries, depth=1, size_mix=DEFAULT_SIZE_MIX, seed=0):
+    """
+    Create a chain of depth nested folders under root with entries files spread evenly over them.
+    Every tenth entry of a level is a folder. Same seed gives the same tree.
+
+    Returns dict with the relative path of every level and one sample file per size.
+    """
+    rng = random.Random(seed)
+    sizes = [size for size, _ in size_mix]
+    weights = [weight for _, weight in size_mix]
+    per_level = max(entries // depth, 1)
+
+    levels = []
+    samples = {}
+    folder = root
+
+    for level in range(depth):
+        folder = os.path.join(folder, f"level_{level}")
+        os.makedirs(folder, exist_ok=True)
+        levels.append(os.path.relpath(folder, root))
+
+        for number in range(per_level):
+            if number % 10 == 9:
+                os.makedirs(os.path.join(folder, f"folder_{number:06d}"), exist_ok=True)
+                continue
+
+            size = rng.choices(sizes, weights)[0]
+            path = os.path.join(folder, f"file_{number:06d}.txt")
+            write_file(path, size, rng)
+            samples.setdefault(size, os.path.relpath(path, root))
+
+    return {'levels': levels, 'samples': samples}
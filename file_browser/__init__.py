@@ -1,97 +1,347 @@
 import os
+import time
+import fcntl
 
+import click
 from dotenv import load_dotenv
 from flask import Flask, Response
-from flask import session
+from flask import request, current_app
 from flask_wtf.csrf import CSRFProtect, generate_csrf
-from flask_session import Session
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-#import magic
-#import pyclamd
 
+# Importing the package only defines these, the app is built by create_app().
+# Views, background services and CLI commands are imported there.
 
-# Load env files
-load_dotenv('.env.development')
+# Get the absolute path of the current file’s directory
+basedir = os.path.abspath(os.path.dirname(__file__))
 
-# Init flask app
-app = Flask(__name__)
-csrf = CSRFProtect()
+# Set upload folder
+UPLOAD_FOLDER = 'users_space'
+
+# Configure allowed files and max size
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
 
-# Get secret key from .env 
-app.secret_key = os.getenv('SECRET_KEY')
+# Allowed image types that get a thumbnail in the listing
+THUMBNAIL_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+db_name = "file_browser.db"
+
+# Extensions are created unbound and attached to the app in create_app()
+db = SQLAlchemy()
+csrf = CSRFProtect()
 
 #Init login manager for flask_login
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+
+def load_config(app):
+    # Get secret key from .env 
+    app.secret_key = os.getenv('SECRET_KEY')
+
+    # Server side sessions, the cookie holds only the session id.
+    # Backends: filesystem (cachelib), sqlite, shm (SQLite on /dev/shm shared by all workers) or cookie (Flask default)
+    app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'filesystem')
+    app.config['SESSION_FOLDER'] = os.getenv('SESSION_FOLDER', os.path.join(basedir, 'flask_session'))
+    app.config['SESSION_SHM_FOLDER'] = os.getenv('SESSION_SHM_FOLDER', '/dev/shm/file_browser_session')
+    app.config['SESSION_KEY_PREFIX'] = 'session:'
+    app.config['SESSION_PERMANENT'] = True
+    app.config['SESSION_ID_LENGTH'] = 32
+    # Store is written only when the session changes, not to move the expiry on every request
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+    # Expired sessions are deleted in background every SESSION_CLEANUP_INTERVAL seconds (0 disables)
+    app.config['SESSION_CLEANUP_INTERVAL'] = int(os.getenv('SESSION_CLEANUP_INTERVAL', 10 * 60))
+
+    # Configure max size of uploads
+    app.config['MAX_CONTENT_LENGTH'] = (15 * 1024) * 1024
+
+    # Password hashing, werkzeug method string like 'scrypt', 'scrypt:65536:8:1' or 'pbkdf2:sha256:600000'.
+    # Stored hashes made with other parameters are replaced on the next successful login
+    app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config['PASSWORD_SALT_LENGTH'] = int(os.getenv('PASSWORD_SALT_LENGTH', 16))
+    # Threads hashing passwords and how many more requests may wait for them before login answers busy
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('PASSWORD_HASH_QUEUE', 8))
+
+    # Login attempts: burst size and refill per minute, per username and per client address (burst 0 disables)
+    app.config['LOGIN_USERNAME_BURST'] = int(os.getenv('LOGIN_USERNAME_BURST', 5))
+    app.config['LOGIN_USERNAME_PER_MINUTE'] = float(os.getenv('LOGIN_USERNAME_PER_MINUTE', 5))
+    app.config['LOGIN_IP_BURST'] = int(os.getenv('LOGIN_IP_BURST', 20))
+    app.config['LOGIN_IP_PER_MINUTE'] = float(os.getenv('LOGIN_IP_PER_MINUTE', 30))
+    # Buckets are shared by all workers in a SQLite file (sqlite) or kept per worker (memory)
+    app.config['LOGIN_LIMIT_STORE'] = os.getenv('LOGIN_LIMIT_STORE', 'sqlite')
+    app.config['LOGIN_LIMIT_DATABASE'] = os.getenv('LOGIN_LIMIT_DATABASE', os.path.join(basedir, 'login_limits.db'))
+
+    # Behind a front proxy like nginx.conf every client has the proxy address. With BEHIND_PROXY=1 the client
+    # address and scheme are taken from the X-Forwarded-For and X-Forwarded-Proto headers the one proxy sets
+    app.config['BEHIND_PROXY'] = os.getenv('BEHIND_PROXY', '0') == '1'
+
+    # Logged in users are cached for this many seconds instead of loaded on every request (0 disables)
+    app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))
+    app.config['USER_CACHE_MAX_ENTRIES'] = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+
+    # Max number of files rendered on one index page
+    app.config['LISTING_PAGE_SIZE'] = int(os.getenv('LISTING_PAGE_SIZE', 500))
+
+    # Memory budget for cached directory listings, 0 disables the cache
+    app.config['LISTING_CACHE_MAX_BYTES'] = int(os.getenv('LISTING_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    app.config['LISTING_CACHE_INOTIFY'] = os.getenv('LISTING_CACHE_INOTIFY', '1') == '1'
+
+    # Content hash algorithm for downloads and uploads: blake2b, blake2s or sha256
+    app.config['FILE_HASH_ALGORITHM'] = os.getenv('FILE_HASH_ALGORITHM', 'blake2b')
+
+    # Max size of one chunk of chunked upload, the whole file is not limited
+    app.config['UPLOAD_CHUNK_MAX_SIZE'] = int(os.getenv('UPLOAD_CHUNK_MAX_SIZE', 64 * 1024 * 1024))
+
+    # Batch file operations
+    app.config['BATCH_MAX_OPERATIONS'] = int(os.getenv('BATCH_MAX_OPERATIONS', 1000))
+    app.config['BATCH_MAX_WORKERS'] = int(os.getenv('BATCH_MAX_WORKERS', 8))
+
+    # Threads running background delete and copy jobs
+    app.config['JOB_MAX_WORKERS'] = int(os.getenv('JOB_MAX_WORKERS', 2))
+    # Each process holds a lock file here while it runs jobs. Jobs of processes that are gone
+    # are marked failed at startup and every JOB_SWEEP_INTERVAL seconds (0 disables)
+    app.config['JOB_LOCK_FOLDER'] = os.getenv('JOB_LOCK_FOLDER', os.path.join(basedir, 'job_locks'))
+    app.config['JOB_SWEEP_INTERVAL'] = int(os.getenv('JOB_SWEEP_INTERVAL', 60))
+
+    # Filename search index, one SQLite file per user, rebuilt every SEARCH_CRAWL_INTERVAL seconds (0 disables)
+    app.config['SEARCH_INDEX_FOLDER'] = os.getenv('SEARCH_INDEX_FOLDER', os.path.join(basedir, 'search_index'))
+    app.config['SEARCH_CRAWL_INTERVAL'] = int(os.getenv('SEARCH_CRAWL_INTERVAL', 60 * 60))
+
+    # Default storage quota per user in bytes (0 is unlimited) and how often usage is recounted from disk
+    app.config['USER_STORAGE_QUOTA'] = int(os.getenv('USER_STORAGE_QUOTA', 1024 * 1024 * 1024))
+    app.config['QUOTA_RECONCILE_INTERVAL'] = int(os.getenv('QUOTA_RECONCILE_INTERVAL', 6 * 60 * 60))
+
+    # Image thumbnails: edge size in pixels, render processes, cache budget in bytes and render wait (seconds)
+    app.config['THUMBNAIL_FOLDER'] = os.getenv('THUMBNAIL_FOLDER', os.path.join(basedir, 'thumbnails'))
+    app.config['THUMBNAIL_SIZE'] = int(os.getenv('THUMBNAIL_SIZE', 256))
+    app.config['THUMBNAIL_WORKERS'] = int(os.getenv('THUMBNAIL_WORKERS', 2))
+    app.config['THUMBNAIL_CACHE_MAX_BYTES'] = int(os.getenv('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    app.config['THUMBNAIL_TIMEOUT'] = int(os.getenv('THUMBNAIL_TIMEOUT', 30))
+    app.config['THUMBNAIL_ON_UPLOAD'] = os.getenv('THUMBNAIL_ON_UPLOAD', '1') == '1'
+
+    # users_space layout: flat (users_space/<username>) or sharded, spread by hash of the username over
+    # USERS_SPACE_SHARD_LEVELS levels of 256 folders. 'flask users-space-migrate' moves existing folders to the layout
+    app.config['USERS_SPACE_LAYOUT'] = os.getenv('USERS_SPACE_LAYOUT', 'flat')
+    app.config['USERS_SPACE_SHARD_LEVELS'] = int(os.getenv('USERS_SPACE_SHARD_LEVELS', 2))
+    # Lock files of the user folders, taken by uploads, provisioning and users-space-migrate of every process
+    app.config['USER_LOCK_FOLDER'] = os.getenv('USER_LOCK_FOLDER', os.path.join(basedir, 'user_locks'))
 
-# Set csrf for app
-csrf.init_app(app)
+    # New user folders are cloned from a template tree in background: reflink, hardlink or copy
+    app.config['PROVISION_TEMPLATE_FOLDER'] = os.getenv('PROVISION_TEMPLATE_FOLDER', os.path.join(basedir, 'user_template'))
+    app.config['PROVISION_LINK_MODE'] = os.getenv('PROVISION_LINK_MODE', 'reflink')
+    app.config['PROVISION_WORKERS'] = int(os.getenv('PROVISION_WORKERS', 2))
+
+    # Content addressed blob store: identical uploads are stored once and user files link to them.
+    # Hardlinks need the store on the same filesystem as UPLOAD_FOLDER, BLOB_LINK_MODE is hardlink or reflink
+    app.config['BLOB_STORE_ENABLED'] = os.getenv('BLOB_STORE_ENABLED', '0') == '1'
+    app.config['BLOB_STORE_FOLDER'] = os.getenv('BLOB_STORE_FOLDER', os.path.join(basedir, 'blob_store'))
+    app.config['BLOB_LINK_MODE'] = os.getenv('BLOB_LINK_MODE', 'hardlink')
+
+    # File delivery: direct (the worker sends the bytes), x-accel-redirect (nginx) or x-sendfile (Apache, lighttpd).
+    # The proxy modes need the front proxy set up as in nginx.conf, FILE_DELIVERY_INTERNAL_PREFIX is its internal location
+    app.config['FILE_DELIVERY'] = os.getenv('FILE_DELIVERY', 'direct')
+    app.config['FILE_DELIVERY_INTERNAL_PREFIX'] = os.getenv('FILE_DELIVERY_INTERNAL_PREFIX', '/_protected_files/')
+
+    # Uploads must start like the type of their extension (PDF, PNG, JPEG and GIF signatures, text without NUL bytes)
+    app.config['UPLOAD_MIME_CHECK'] = os.getenv('UPLOAD_MIME_CHECK', '1') == '1'
+
+    # Malware scan of uploads: files wait in quarantine until a background scanner passes them.
+    # UPLOAD_SCANNER is clamd or the import path of a scanner class, CLAMD_ADDRESS a unix socket path or host:port.
+    # Workers and queue bound the scans of one process, what does not fit is picked up every UPLOAD_SCAN_RETRY_INTERVAL seconds
+    app.config['UPLOAD_SCAN_ENABLED'] = os.getenv('UPLOAD_SCAN_ENABLED', '0') == '1'
+    app.config['UPLOAD_SCANNER'] = os.getenv('UPLOAD_SCANNER', 'clamd')
+    app.config['CLAMD_ADDRESS'] = os.getenv('CLAMD_ADDRESS', '/var/run/clamav/clamd.ctl')
+    app.config['UPLOAD_SCAN_WORKERS'] = int(os.getenv('UPLOAD_SCAN_WORKERS', 2))
+    app.config['UPLOAD_SCAN_QUEUE'] = int(os.getenv('UPLOAD_SCAN_QUEUE', 100))
+    app.config['UPLOAD_SCAN_TIMEOUT'] = int(os.getenv('UPLOAD_SCAN_TIMEOUT', 60))
+    app.config['UPLOAD_SCAN_MAX_ATTEMPTS'] = int(os.getenv('UPLOAD_SCAN_MAX_ATTEMPTS', 5))
+    app.config['UPLOAD_SCAN_RETRY_INTERVAL'] = int(os.getenv('UPLOAD_SCAN_RETRY_INTERVAL', 60))
+    # Outside users_space so no request reaches files not scanned yet, on its filesystem so release is a rename
+    app.config['QUARANTINE_FOLDER'] = os.getenv('QUARANTINE_FOLDER', os.path.join(basedir, 'quarantine'))
+
+    # Unfinished chunked uploads older than this are removed (seconds)
+    app.config['UPLOAD_SESSION_MAX_AGE'] = int(os.getenv('UPLOAD_SESSION_MAX_AGE', 24 * 60 * 60))
+
+    # Configure the app for db, uploads
+    app.config['SQLALCHEMY_DATABASE_URI']="sqlite:///" +os.path.join(basedir, db_name)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['WTF_CSRF_UNABLED'] = True
+
+    # SQLite tuning and connection pool of each worker process
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+    app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 10))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', 30))
+
+    # Prometheus metrics on /metrics, protected by 'Authorization: Bearer METRICS_TOKEN'.
+    # Without the token only local requests that did not come through the proxy are answered
+    app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') == '1'
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    # Folder each worker writes its metrics to every METRICS_WRITE_INTERVAL seconds, /metrics sums them.
+    # gunicorn.conf.py sets it, empty serves the metrics of the answering process only
+    app.config['METRICS_FOLDER'] = os.getenv('METRICS_FOLDER', '')
+    app.config['METRICS_WRITE_INTERVAL'] = float(os.getenv('METRICS_WRITE_INTERVAL', 5))
+
+    # Sampling profiler: share of requests profiled (0 disables), interval between stack samples (seconds)
+    # and how slow a profiled request must be to have its collapsed stacks saved in PROFILE_FOLDER
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_INTERVAL'] = float(os.getenv('PROFILE_INTERVAL', 0.005))
+    app.config['PROFILE_SLOW_REQUEST'] = float(os.getenv('PROFILE_SLOW_REQUEST', 1.0))
+    app.config['PROFILE_FOLDER'] = os.getenv('PROFILE_FOLDER', os.path.join(basedir, 'profiles'))
+    app.config['PROFILE_MAX_FILES'] = int(os.getenv('PROFILE_MAX_FILES', 200))
+
+    # Background threads (search crawler, quota reconciler, session cleaner, provisioning queue, upload scan sweeper).
+    # CLI commands and tests that do not need them can set BACKGROUND_SERVICES=0
+    app.config['BACKGROUND_SERVICES'] = os.getenv('BACKGROUND_SERVICES', '1') == '1'
+
+    # Seconds a new worker may take to import and build the app, new workers must come up fast when scaling out.
+    # create_app() logs a warning when it alone takes longer, 'flask startup-time' checks the whole cold start
+    app.config['STARTUP_TIME_BUDGET'] = float(os.getenv('STARTUP_TIME_BUDGET', 1.0))
 
-@app.after_request
 def add_csrf_cookie(response: Response):
-    if response.status_code in range(200, 400) and not response.direct_passthrough:
-        response.set_cookie("csrftoken", generate_csrf(), secure=True)
+    # Set only when the browser has none, it expires before the token gets too old
+    if "csrftoken" not in request.cookies and response.status_code in range(200, 400) and not response.direct_passthrough:
+        max_age = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+        response.set_cookie("csrftoken", generate_csrf(), secure=True, max_age=max(max_age - 60, 60))
     return response
 
-# Init Session
-#sess = Session()
+def init_extensions(app):
+    """
+    Attach db, login manager and csrf to the app and create missing tables.
+    Migrate is attached only when the app is built by the flask CLI, workers never run
+    migrations and skip importing alembic.
+    """
+    from file_browser.database import get_engine_options, configure_engine
 
-# Configure Session type
-app.config['SESSION_TYPE'] = 'filesystem'
-#sess.init_app(app)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', get_engine_options(app.config))
 
-# Configure the app for db uploads
-# Get the absolute path of the current file’s directory
-basedir = os.path.abspath(os.path.dirname(__file__))
+    db.init_app(app)
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=os.path.join(os.path.dirname(basedir), 'migrations'))
+    login_manager.init_app(app)
+    csrf.init_app(app)
+    app.after_request(add_csrf_cookie)
 
-# Set upload folder
-UPLOAD_FOLDER = 'users_space'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    with app.app_context():
+        configure_engine(db.engine, app.config)
 
-# Configure allowed files and max size
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+        # Create missing tables. Workers start at the same time, the lock lets one create them
+        from file_browser import models
+        with open(os.path.join(basedir, ".create_db.lock"), "w") as create_db_lock:
+            fcntl.flock(create_db_lock, fcntl.LOCK_EX)
+            db.create_all()
 
-app.config['MAX_CONTENT_LENGTH'] = (15 * 1024) * 1024
+def register_blueprints(app):
+    from file_browser.views import bp
+    from file_browser.user_cache import load_cached_user
 
-#def allowed_mime_type(file):
-#    mime = magic.from_buffer(file.stream.read(2048), mime=True)
-#    file.stream.seek(0) 
-#    return mime in ['image/png', 'image/jpeg', 'application/pdf']
+    app.register_blueprint(bp)
 
-## Scan for malicious code
-#def scan_file(file_path):
-#    cd = pyclamd.ClamdUnixSocket()
-#    result = cd.scan_file(file_path)
-#    return result
+    # User loader callback to reload user id stored in session or return None and not raise exception
+    @login_manager.user_loader
+    def load_user(user_id):
+        return load_cached_user(int(user_id))
 
+def register_commands(app):
+    from file_browser.quota import quota_reconcile_command
+    from file_browser.search import search_rebuild_command
+    from file_browser.user_import import import_users_command
+    from file_browser.sessions import session_benchmark_command
+    from file_browser.startup import startup_time_command
+    from file_browser.blobstore import blob_gc_command
+    from file_browser.layout import users_space_migrate_command
+    from file_browser.scanning import upload_scan_command, fake_clamd_command
 
-# Configure the app for db, uploads
-# Get the absolute path of the current file’s directory
-basedir = os.path.abspath(os.path.dirname(__file__))
-db_name = "file_browser.db"
-app.config['SQLALCHEMY_DATABASE_URI']="sqlite:///" +os.path.join(basedir, db_name)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['WTF_CSRF_UNABLED'] = True
+    for command in (quota_reconcile_command, search_rebuild_command, import_users_command,
+                    session_benchmark_command, startup_time_command, blob_gc_command,
+                    users_space_migrate_command, upload_scan_command, fake_clamd_command):
+        app.cli.add_command(command)
+
+def configure_services(app):
+    """
+    Size the in-process caches and login limits from the app config and install instrumentation
+    """
+    from file_browser.dircache import directory_cache
+    from file_browser.user_cache import user_cache
+    from file_browser.passwords import configure_login_limits, configure_password_method
+    from file_browser.sessions import init_sessions
+    from file_browser.metrics import init_metrics
+
+    directory_cache.configure(app.config['LISTING_CACHE_MAX_BYTES'], app.config['LISTING_CACHE_INOTIFY'])
+    user_cache.configure(app.config['USER_CACHE_TTL'], app.config['USER_CACHE_MAX_ENTRIES'])
+    configure_login_limits(app.config)
+    configure_password_method(app)
+
+    # Install the server side session store
+    init_sessions(app)
+
+    # Request, template and SQL timing
+    with app.app_context():
+        init_metrics(app, db.engine)
+
+def start_background_services(app):
+    """
+    Start the background threads. Each takes a lock file, so only one process of the
+    server runs it and the others skip it. The returned handles keep the locks open.
+    The metrics writer runs in every process.
+    """
+    from file_browser.search import start_search_crawler
+    from file_browser.quota import start_quota_reconciler
+    from file_browser.provisioning import resume_pending_provisioning
+    from file_browser.sessions import start_session_cleaner
+    from file_browser.scanning import start_scan_sweeper
+    from file_browser.jobs import start_job_sweeper
+    from file_browser.metrics import start_metrics_writer
+
+    with app.app_context():
+        return {'search_crawler': start_search_crawler(),
+                'quota_reconciler': start_quota_reconciler(),
+                'session_cleaner': start_session_cleaner(),
+                'provisioning': resume_pending_provisioning(),
+                'upload_scan_sweeper': start_scan_sweeper(),
+                'job_sweeper': start_job_sweeper(),
+                'metrics_writer': start_metrics_writer(app),
+                }
+
+def create_app(config=None):
+    """
+    Build the app. config overrides values read from the environment.
+
+    The build is timed, taking longer than
+    :app.config['STARTUP_TIME_BUDGET']
+    logs a warning.
+    """
+    started = time.perf_counter()
+
+    # Load env files
+    load_dotenv('.env.development')
+
+    # Init flask app
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
 
-# Init db and migrate
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+    if app.config['BEHIND_PROXY']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
 
-app.app_context().push()
+    init_extensions(app)
+    register_blueprints(app)
+    register_commands(app)
+    configure_services(app)
 
-# Create db if doesnt exists
-if not os.path.isfile(db_name):
-    db.create_all()
+    app.extensions['background_services'] = start_background_services(app) if app.config['BACKGROUND_SERVICES'] else {}
 
-# Import views
-from file_browser import views
-from file_browser.models import User
+    startup_seconds = time.perf_counter() - started
+    app.extensions['startup_seconds'] = startup_seconds
+    if startup_seconds > app.config['STARTUP_TIME_BUDGET']:
+        app.logger.warning("App startup took %.3fs, budget is %.3fs (STARTUP_TIME_BUDGET)",
+                           startup_seconds, app.config['STARTUP_TIME_BUDGET'])
 
-# User loader callback to reload user id stored in session or return None and not raise exception
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+    return app
@@ -0,0 +1,234 @@
+import os
+import stat
+import time
+import tarfile
+import zipfile
+from pathlib import Path
+
+from flask import Response, current_app, stream_with_context
+
+from file_browser.metrics import count_syscall
+from file_browser.helpers import UPLOAD_TEMP_PREFIX
+
+# Formats of folder downloads, ?format=
+ARCHIVE_FORMATS = ("zip", "tar")
+
+# ?compression= auto deflates except already compressed types, store never deflates
+ARCHIVE_COMPRESSIONS = ("auto", "store")
+
+# Read size of files put in the archive, also roughly the size of each streamed chunk
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+
+# Deflating these only costs CPU, they are stored as they are
+COMPRESSED_EXTENSIONS = {"7z", "aac", "avi", "br", "bz2", "docx", "epub", "flac", "gif", "gz", "heic", "jpeg", "jpg",
+                         "m4a", "m4p", "mkv", "mov", "mp3", "mp4", "odt", "ogg", "pdf", "png", "pptx", "rar", "tgz",
+                         "webm", "webp", "xlsx", "xz", "zip", "zst"}
+
+ARCHIVE_MIMETYPES = {"zip": "application/zip", "tar": "application/x-tar"}
+
+# Earliest date a zip entry can hold
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+class StreamBuffer:
+    """
+    Write only file object the archive writers write into.
+    The response generator takes the written bytes out after each step with
+    :drain()
+    so only one chunk is held in memory. It has no seek() or tell(), zipfile
+    then writes data descriptors after each file instead of seeking back.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def walk_folder(abs_path):
+    """
+    Yield (DirEntry, archive name) for every folder and regular file under abs_path, parents first.
+    Symlinks are skipped so the archive never leaves the user folder, so are temp files of unfinished uploads.
+    Names start with the folder name and use / as separator.
+    """
+    stack = [(abs_path, os.path.basename(abs_path.rstrip(os.sep)))]
+
+    while stack:
+        folder, name = stack.pop()
+        try:
+            count_syscall("scandir")
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as error:
+            current_app.logger.warning("Folder skipped in archive: %s", error)
+            continue
+
+        subfolders = []
+        for entry in entries:
+            if entry.name.startswith(UPLOAD_TEMP_PREFIX) or entry.is_symlink():
+                continue
+
+            entry_name = f"{name}/{entry.name}"
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append((entry.path, entry_name))
+                yield entry, entry_name
+            elif entry.is_file(follow_symlinks=False):
+                yield entry, entry_name
+
+        stack.extend(reversed(subfolders))
+
+def read_file_chunks(f, size):
+    """
+    Read at most size bytes, the size stat() gave when the entry header was written.
+    A file growing while it is archived is cut at that size.
+    """
+    remaining = size
+    while remaining > 0:
+        chunk = f.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def get_zip_info(name, file_stat, is_dir):
+    date_time = max(time.localtime(file_stat.st_mtime)[:6], ZIP_EPOCH)
+    zip_info = zipfile.ZipInfo(name + "/" if is_dir else name, date_time)
+    zip_info.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+    if is_dir:
+        # MS-DOS directory flag
+        zip_info.external_attr |= 0x10
+    else:
+        zip_info.file_size = file_stat.st_size
+    return zip_info
+
+def stream_zip(abs_path, compression="auto"):
+    """
+    Generator of a zip archive of the folder.
+    Each file is read and deflated in chunks and sent as soon as the chunk is compressed,
+    memory use does not depend on the size of the files or of the folder.
+    """
+    buffer = StreamBuffer()
+
+    with zipfile.ZipFile(buffer, mode="w", allowZip64=True) as archive:
+        for entry, name in walk_folder(abs_path):
+            try:
+                file_stat = entry.stat(follow_symlinks=False)
+                count_syscall("stat")
+                is_dir = stat.S_ISDIR(file_stat.st_mode)
+
+                if is_dir:
+                    archive.writestr(get_zip_info(name, file_stat, True), b"")
+                    continue
+
+                f = open(entry.path, "rb")
+                count_syscall("open")
+            except OSError as error:
+                # Removed or unreadable since the folder was listed
+                current_app.logger.warning("File skipped in archive: %s", error)
+                continue
+
+            with f:
+                zip_info = get_zip_info(name, file_stat, False)
+                extension = Path(entry.name).suffix[1:].lower()
+                if compression == "store" or extension in COMPRESSED_EXTENSIONS:
+                    zip_info.compress_type = zipfile.ZIP_STORED
+                else:
+                    zip_info.compress_type = zipfile.ZIP_DEFLATED
+
+                with archive.open(zip_info, mode="w") as destination:
+                    for chunk in read_file_chunks(f, file_stat.st_size):
+                        destination.write(chunk)
+                        # Deflate keeps small writes in its window and may return nothing yet
+                        data = buffer.drain()
+                        if data:
+                            yield data
+
+            # Rest of the compressed data and the data descriptor
+            yield buffer.drain()
+
+    # Central directory is written on close
+    yield buffer.drain()
+
+def stream_tar(abs_path):
+    """
+    Generator of an uncompressed tar archive of the folder.
+    Headers are made by
+    :tarfile.TarInfo
+    and the file data is copied in chunks, tarfile itself would copy a whole file in one call.
+    """
+    # Every member takes whole blocks, only the archive length in blocks is tracked
+    blocks = 0
+
+    for entry, name in walk_folder(abs_path):
+        try:
+            file_stat = entry.stat(follow_symlinks=False)
+            count_syscall("stat")
+            is_dir = stat.S_ISDIR(file_stat.st_mode)
+            f = None
+            if not is_dir:
+                f = open(entry.path, "rb")
+                count_syscall("open")
+        except OSError as error:
+            current_app.logger.warning("File skipped in archive: %s", error)
+            continue
+
+        tar_info = tarfile.TarInfo(name)
+        tar_info.mtime = int(file_stat.st_mtime)
+        tar_info.mode = stat.S_IMODE(file_stat.st_mode)
+        tar_info.type = tarfile.DIRTYPE if is_dir else tarfile.REGTYPE
+        tar_info.size = 0 if is_dir else file_stat.st_size
+
+        header = tar_info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        blocks += len(header) // tarfile.BLOCKSIZE
+        yield header
+
+        if f is None:
+            continue
+
+        with f:
+            written = 0
+            for chunk in read_file_chunks(f, tar_info.size):
+                written += len(chunk)
+                yield chunk
+
+        # Header promised st_size bytes, a file that shrank meanwhile is padded with zeros
+        padding = tar_info.size - written + (-tar_info.size % tarfile.BLOCKSIZE)
+        if padding:
+            yield tarfile.NUL * padding
+        blocks += -(-tar_info.size // tarfile.BLOCKSIZE)
+
+    # End of archive marker, then padding to the record size like tarfile does
+    size = (blocks + 2) * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -size % tarfile.RECORDSIZE)
+
+def send_folder_archive(abs_path, archive_format="zip", compression="auto"):
+    """
+    Streamed response with the folder as zip or tar archive.
+    The length is not known in advance, the body is sent chunked and nothing is written to disk.
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        archive_format = "zip"
+    if compression not in ARCHIVE_COMPRESSIONS:
+        compression = "auto"
+
+    if archive_format == "tar":
+        body = stream_tar(abs_path)
+    else:
+        body = stream_zip(abs_path, compression)
+
+    # The request context stays while the body streams, the generators log through current_app
+    response = Response(stream_with_context(body), mimetype=ARCHIVE_MIMETYPES[archive_format], direct_passthrough=True)
+    response.headers.set("Content-Disposition", "attachment",
+                         filename=f"{os.path.basename(abs_path.rstrip(os.sep))}.{archive_format}")
+    response.cache_control.no_store = True
+    return response
@@ -0,0 +1,297 @@
+import os
+import time
+import uuid
+import errno
+import shutil
+import hashlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.dialects.sqlite import insert
+
+from file_browser import db
+from file_browser.models import Blob, BlobReference
+from file_browser.hashing import get_hash_algorithm, store_file_hash, HASH_BUFFER_SIZE
+from file_browser.provisioning import clone_file
+from file_browser.metrics import count_hashed_bytes
+
+# How user files point to their blob: hardlink shares the inode, reflink shares the data blocks
+BLOB_LINK_MODES = ("hardlink", "reflink")
+
+# Inside BLOB_STORE_FOLDER, uploads being written and links being made before they are moved into place
+BLOB_TEMP_FOLDER = "tmp"
+
+# Temp files older than this are left overs of crashed workers, removed by blob-gc (seconds)
+BLOB_TEMP_MAX_AGE = 24 * 60 * 60
+
+# Files looked up in one query, SQLite limits the number of bound parameters
+RELEASE_BATCH_SIZE = 500
+
+
+class BlobNotStored(Exception):
+    pass
+
+
+def is_blob_store_enabled():
+    return current_app.config['BLOB_STORE_ENABLED']
+
+def get_blob_path(digest, algorithm):
+    """
+    Blobs are spread over two levels of folders by the first bytes of the digest
+    """
+    return os.path.join(current_app.config['BLOB_STORE_FOLDER'], algorithm, digest[:2], digest[2:4], digest)
+
+def get_temp_path():
+    """
+    New temp file name in the store. The store must be on the same filesystem as users_space,
+    files are renamed and linked from here.
+    """
+    folder = os.path.join(current_app.config['BLOB_STORE_FOLDER'], BLOB_TEMP_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{uuid.uuid4().hex}.part")
+
+def add_reference(digest, algorithm, size, blob_inode, file_stat):
+    """
+    Count one more user file of the blob. One statement so concurrent uploads do not lose counts.
+    """
+    db.session.execute(insert(Blob)
+                       .values(algorithm=algorithm, digest=digest, size=size, inode=blob_inode, refcount=1)
+                       .on_conflict_do_update(index_elements=[Blob.algorithm, Blob.digest],
+                                              set_={'refcount': Blob.refcount + 1, 'inode': blob_inode}))
+
+    # Reflinked or copied file has its own inode, it is remembered to find the blob when the file is deleted
+    if file_stat.st_ino != blob_inode:
+        db.session.merge(BlobReference(inode=file_stat.st_ino, device=file_stat.st_dev, mtime_ns=file_stat.st_mtime_ns,
+                                       algorithm=algorithm, digest=digest))
+
+    db.session.commit()
+
+def release_blob_references(file_stats):
+    """
+    Called with the stat results of deleted or overwritten user files, taken before they were removed.
+    Each file linked to a blob drops its refcount, a blob nobody links to is removed
+    from the store. Files outside the store are ignored.
+    """
+    if not file_stats or not is_blob_store_enabled():
+        return
+
+    file_stats = list(file_stats)
+    for start in range(0, len(file_stats), RELEASE_BATCH_SIZE):
+        release_files(file_stats[start:start + RELEASE_BATCH_SIZE])
+
+def release_files(file_stats):
+    inodes = [file_stat.st_ino for file_stat in file_stats]
+    released = {}
+
+    # A hardlinked file has the inode of the blob, which is not reused while the blob exists
+    for blob in Blob.query.filter(Blob.inode.in_(inodes)).all():
+        released[(blob.algorithm, blob.digest)] = inodes.count(blob.inode)
+
+    stats_by_inode = {file_stat.st_ino: file_stat for file_stat in file_stats}
+    references = BlobReference.query.filter(BlobReference.inode.in_(inodes)).all()
+    for reference in references:
+        db.session.delete(reference)
+        # The referenced file was removed without release and its inode reused by this one,
+        # the row is stale and blob-gc recounts the blob without it
+        if not reference.is_for(stats_by_inode[reference.inode]):
+            continue
+        key = (reference.algorithm, reference.digest)
+        released[key] = released.get(key, 0) + 1
+
+    removed = []
+    for (algorithm, digest), count in released.items():
+        db.session.execute(db.update(Blob)
+                           .where(Blob.algorithm == algorithm, Blob.digest == digest)
+                           .values(refcount=Blob.refcount - count))
+        deleted = db.session.execute(db.delete(Blob)
+                                     .where(Blob.algorithm == algorithm, Blob.digest == digest, Blob.refcount <= 0))
+        if deleted.rowcount:
+            removed.append(get_blob_path(digest, algorithm))
+
+    db.session.commit()
+
+    # Files go after the rows, a concurrent upload of the same content then stores it again
+    for blob_path in removed:
+        try:
+            os.remove(blob_path)
+        except FileNotFoundError:
+            pass
+
+def link_blob(digest, algorithm, file_path):
+    """
+    Put a link to the stored blob at file_path, replacing a file that is there.
+    The link is made in the store temp folder and renamed into place, file_path never
+    shows a half made file. Raises BlobNotStored if the blob is not in the store.
+    """
+    blob_path = get_blob_path(digest, algorithm)
+    staging = get_temp_path()
+
+    try:
+        blob_stat = os.stat(blob_path)
+        clone_file(blob_path, staging, current_app.config['BLOB_LINK_MODE'])
+    except FileNotFoundError:
+        raise BlobNotStored(digest)
+
+    try:
+        staging_stat = os.stat(staging)
+
+        # Own inode (reflink or copy fallback) gets the upload time, a hardlink shares the mtime of the blob
+        if staging_stat.st_ino != blob_stat.st_ino:
+            os.utime(staging)
+            staging_stat = os.stat(staging)
+
+        try:
+            replaced_stat = os.lstat(file_path)
+        except FileNotFoundError:
+            replaced_stat = None
+
+        # Same content uploaded again, rename() between two links of one inode would do nothing
+        if replaced_stat is not None and os.path.samestat(replaced_stat, staging_stat):
+            os.remove(staging)
+            store_file_hash(file_path, digest, algorithm, staging_stat)
+            return
+
+        os.replace(staging, file_path)
+    except OSError:
+        os.remove(staging)
+        raise
+
+    add_reference(digest, algorithm, blob_stat.st_size, blob_stat.st_ino, staging_stat)
+    store_file_hash(file_path, digest, algorithm, staging_stat)
+
+    if replaced_stat is not None:
+        release_blob_references([replaced_stat])
+
+def add_blob(temp_path, blob_path):
+    """
+    Link temp_path into the store unless the blob exists. A blob is never replaced,
+    files linked to it keep pointing to the same inode.
+    """
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    try:
+        os.link(temp_path, blob_path)
+    except FileExistsError:
+        pass
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        # Temp file of chunked upload is in the user folder, on another filesystem than the store
+        copy_path = get_temp_path()
+        shutil.copyfile(temp_path, copy_path)
+        try:
+            os.link(copy_path, blob_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(copy_path)
+
+def store_file(temp_path, file_path, digest, algorithm):
+    """
+    Move finished temp file into the store and link file_path to it.
+    When the same content is already stored the temp file is dropped and only linked.
+    """
+    blob_path = get_blob_path(digest, algorithm)
+
+    try:
+        add_blob(temp_path, blob_path)
+        try:
+            link_blob(digest, algorithm, file_path)
+        except BlobNotStored:
+            # Garbage collected between the two steps, store this copy again
+            add_blob(temp_path, blob_path)
+            link_blob(digest, algorithm, file_path)
+    finally:
+        os.remove(temp_path)
+
+def save_upload_to_blob_store(file, file_path):
+    """
+    Blob store version of
+    :save_and_hash_upload()
+    werkzeug already spooled the upload to memory or a temp file while parsing the form,
+    so it is hashed first. Content that is already stored is only linked, nothing is written.
+    Returns the digest.
+    """
+    algorithm = get_hash_algorithm()
+    stream = file.stream
+    digest = None
+
+    if stream.seekable():
+        hash = hashlib.new(algorithm)
+        while chunk := stream.read(HASH_BUFFER_SIZE):
+            hash.update(chunk)
+            count_hashed_bytes(algorithm, len(chunk))
+        digest = hash.hexdigest()
+
+        try:
+            link_blob(digest, algorithm, file_path)
+            return digest
+        except BlobNotStored:
+            stream.seek(0)
+
+    temp_path = get_temp_path()
+    hash = hashlib.new(algorithm) if digest is None else None
+
+    with open(temp_path, 'wb') as f:
+        while chunk := stream.read(HASH_BUFFER_SIZE):
+            f.write(chunk)
+            if hash is not None:
+                hash.update(chunk)
+                count_hashed_bytes(algorithm, len(chunk))
+
+    if hash is not None:
+        digest = hash.hexdigest()
+
+    store_file(temp_path, file_path, digest, algorithm)
+    return digest
+
+def collect_garbage():
+    """
+    Recount references and remove unreferenced blobs and old temp files.
+    Hardlink references are counted from st_nlink, reflink ones from
+    :BlobReference
+    rows. Returns (blobs removed, bytes freed).
+    """
+    removed = 0
+    freed = 0
+
+    reflinks = dict(db.session.execute(db.select(BlobReference.algorithm + ":" + BlobReference.digest,
+                                                 db.func.count())
+                                       .group_by(BlobReference.algorithm, BlobReference.digest)).all())
+
+    for blob in Blob.query.all():
+        blob_path = get_blob_path(blob.digest, blob.algorithm)
+        try:
+            blob_stat = os.stat(blob_path)
+        except FileNotFoundError:
+            db.session.delete(blob)
+            continue
+
+        blob.refcount = blob_stat.st_nlink - 1 + reflinks.get(f"{blob.algorithm}:{blob.digest}", 0)
+        blob.inode = blob_stat.st_ino
+
+        if blob.refcount <= 0:
+            os.remove(blob_path)
+            db.session.delete(blob)
+            removed += 1
+            freed += blob_stat.st_size
+
+    db.session.commit()
+
+    temp_folder = os.path.join(current_app.config['BLOB_STORE_FOLDER'], BLOB_TEMP_FOLDER)
+    if os.path.isdir(temp_folder):
+        expired_before = time.time() - BLOB_TEMP_MAX_AGE
+        with os.scandir(temp_folder) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < expired_before:
+                    os.remove(entry.path)
+
+    return removed, freed
+
+@click.command("blob-gc")
+@with_appcontext
+def blob_gc_command():
+    """Recount blob store references and remove unreferenced blobs."""
+    removed, freed = collect_garbage()
+    click.echo(f"Removed {removed} blobs, freed {freed} bytes")
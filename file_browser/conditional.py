@@ -0,0 +1,220 @@
+import os
+import secrets
+import mimetypes
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from flask import request, send_file, Response, current_app
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified, parse_range_header, http_date
+
+from file_browser.hashing import get_stored_file_hash
+from file_browser.helpers import get_users_root
+
+# More ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 32
+
+# Read size when streaming ranges
+RANGE_CHUNK_SIZE = 256 * 1024
+
+# How file bytes are sent: by the worker, or by the front proxy after X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd)
+FILE_DELIVERY_MODES = ("direct", "x-accel-redirect", "x-sendfile")
+
+
+def get_file_etag(file_path, file_stat):
+    """
+    Strong ETag for the file.
+    The stored content hash is used when it is valid, otherwise inode, size and mtime
+    which also change with every write.
+    """
+    digest = get_stored_file_hash(file_path, file_stat)
+    if digest is not None:
+        return digest
+
+    return f"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"
+
+def if_range_matches(etag, last_modified):
+    """
+    Range is used only if the If-Range header is missing or still matches the file
+    """
+    if "If-Range" not in request.headers:
+        return True
+
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == int(last_modified)
+
+    return False
+
+def get_requested_ranges(file_size, etag, last_modified):
+    """
+    Parse Range header into sorted list of (start, stop) byte ranges, stop is exclusive.
+    Overlapping and adjacent ranges are merged.
+
+    Returns None when the whole file should be sent: no Range header, If-Range
+    does not match, invalid header or too many ranges.
+    Returns empty list if none of the ranges can be satisfied.
+    """
+    if request.method not in ("GET", "HEAD") or "Range" not in request.headers or file_size == 0:
+        return None
+
+    if not if_range_matches(etag, last_modified):
+        return None
+
+    parsed_range = parse_range_header(request.headers.get("Range"))
+    if parsed_range is None or parsed_range.units != "bytes" or len(parsed_range.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in parsed_range.ranges:
+        # Suffix range like bytes=-500
+        if start < 0:
+            start = max(file_size + start, 0)
+            stop = file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+
+        if start < stop:
+            ranges.append((start, stop))
+
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
+
+def read_file_ranges(file_path, ranges, parts=None):
+    """
+    Generator that reads the ranges from the file in chunks.
+    If parts is given each range is preceded by its multipart header and the closing boundary is added.
+    """
+    with open(file_path, 'rb') as f:
+        for index, (start, stop) in enumerate(ranges):
+            if parts is not None:
+                yield parts[index]
+
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+        if parts is not None:
+            yield parts[-1]
+
+def send_ranges(file_path, file_size, ranges, mimetype):
+    """
+    206 response for one range or multipart/byteranges response for many
+    """
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(read_file_ranges(file_path, ranges), status=206, mimetype=mimetype, direct_passthrough=True)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{file_size}"
+        response.content_length = stop - start
+        return response
+
+    boundary = secrets.token_hex(16)
+    parts = [(f"\r\n--{boundary}\r\n"
+              f"Content-Type: {mimetype}\r\n"
+              f"Content-Range: bytes {start}-{stop - 1}/{file_size}\r\n\r\n").encode()
+             for start, stop in ranges]
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+
+    content_length = sum(len(part) for part in parts) + sum(stop - start for start, stop in ranges)
+
+    response = Response(read_file_ranges(file_path, ranges, parts), status=206, direct_passthrough=True,
+                        mimetype=f"multipart/byteranges; boundary={boundary}")
+    response.content_length = content_length
+    return response
+
+def get_offload_header(file_path):
+    """
+    Returns (header name, value) telling the front proxy to send the file, or None when
+    FILE_DELIVERY is direct or the file cannot be named in a header, the worker sends it then.
+    X-Accel-Redirect gets the url of the file under the internal location FILE_DELIVERY_INTERNAL_PREFIX
+    that the proxy maps to users_space, X-Sendfile gets the absolute path.
+    """
+    mode = current_app.config['FILE_DELIVERY']
+
+    if mode == "x-accel-redirect":
+        relative = os.path.relpath(file_path, get_users_root())
+        if relative.startswith(os.pardir):
+            return None
+        prefix = current_app.config['FILE_DELIVERY_INTERNAL_PREFIX'].rstrip("/")
+        return "X-Accel-Redirect", f"{prefix}/{quote(relative.replace(os.sep, '/'))}"
+
+    if mode == "x-sendfile":
+        try:
+            # Header values are latin-1, the proxy does not decode quoted paths
+            file_path.encode("latin-1")
+        except UnicodeEncodeError:
+            return None
+        return "X-Sendfile", file_path
+
+    return None
+
+def send_file_offloaded(file_path, header, as_attachment=False):
+    """
+    Empty response with the offload header. The proxy reads the file and answers ranges itself,
+    the worker is free as soon as the headers are made.
+    """
+    mimetype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    response = Response(mimetype=mimetype)
+    response.headers[header[0]] = header[1]
+    if as_attachment:
+        response.headers.set("Content-Disposition", "attachment", filename=os.path.basename(file_path))
+    return response
+
+def send_file_conditional(file_path, as_attachment=False, etag=None):
+    """
+    Send file with content based ETag, 304 Not Modified and byte ranges (also multi range).
+    Shared by the download route and the inline file branch of the index route.
+    With FILE_DELIVERY other than direct the checks are made here and the bytes are sent by the proxy.
+
+    :etag
+    can be passed if the caller already knows the file hash
+    """
+    file_stat = os.stat(file_path)
+    etag = etag or get_file_etag(file_path, file_stat)
+    last_modified = file_stat.st_mtime
+
+    # Not modified wins over range
+    modified = is_resource_modified(request.environ,
+                                    etag=etag,
+                                    last_modified=datetime.fromtimestamp(last_modified, timezone.utc))
+    if request.method in ("GET", "HEAD") and not modified:
+        response = Response(status=304)
+
+    elif (header := get_offload_header(file_path)) is not None:
+        response = send_file_offloaded(file_path, header, as_attachment)
+
+    else:
+        ranges = get_requested_ranges(file_stat.st_size, etag, last_modified)
+
+        if ranges == []:
+            return RequestedRangeNotSatisfiable(length=file_stat.st_size).get_response()
+
+        if ranges:
+            mimetype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+            response = send_ranges(file_path, file_stat.st_size, ranges, mimetype)
+            if as_attachment:
+                response.headers.set("Content-Disposition", "attachment", filename=os.path.basename(file_path))
+        else:
+            # Preconditions and ranges are already handled above
+            response = send_file(file_path, as_attachment=as_attachment, conditional=False, etag=False)
+
+    response.set_etag(etag)
+    response.headers["Last-Modified"] = http_date(last_modified)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,52 @@
+from sqlalchemy import event
+
+
+def get_engine_options(config):
+    """
+    SQLAlchemy engine options for the SQLite database.
+    Every worker process has its own pool, threads of one worker take connections from it.
+    """
+    return {'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            # Seconds sqlite3 waits for the write lock of other connections before "database is locked"
+            'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000},
+            }
+
+def set_sqlite_pragmas(connection, busy_timeout, mmap_size):
+    """
+    Applied to every new connection.
+
+    WAL lets readers of all workers run while one connection writes, and with
+    synchronous=NORMAL a commit does not fsync, only checkpoints do.
+    mmap_size lets reads come from the page cache without copying.
+    """
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+    cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+def configure_engine(engine, config):
+    """
+    Values are read from config here, connections are also opened by threads without app context
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    busy_timeout = config['SQLITE_BUSY_TIMEOUT']
+    mmap_size = config['SQLITE_MMAP_SIZE']
+
+    @event.listens_for(engine, "connect")
+    def on_connect(connection, connection_record):
+        set_sqlite_pragmas(connection, busy_timeout, mmap_size)
+
+def get_database_settings(engine):
+    """
+    Settings the connections actually use, for the startup check
+    """
+    with engine.connect() as connection:
+        return {pragma: connection.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+                for pragma in ("journal_mode", "synchronous", "busy_timeout", "mmap_size")}
@@ -0,0 +1,267 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import struct
+import threading
+from collections import OrderedDict
+
+from file_browser.metrics import count_syscall
+
+# Rough memory cost of one cached entry: the DirEntry, its cached stat and the converted row
+ENTRY_SIZE_ESTIMATE = 1024
+
+# Directory mtime this close to the scan start may hide a change made in the same clock tick
+RACY_MTIME_NS = 1_000_000_000
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Minimal inotify binding using
+    :ctypes
+    A daemon thread reads the events and calls on_change(path) for the watched directory.
+    Raises OSError if inotify is not available on this platform.
+    """
+
+    def __init__(self, on_change):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._watches = {}
+
+        thread = threading.Thread(target=self._read_events, name="dircache-inotify", daemon=True)
+        thread.start()
+
+    def add(self, path):
+        with self._lock:
+            if path in self._watches:
+                return True
+
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                return False
+
+            self._watches[path] = wd
+            self._paths[wd] = path
+            return True
+
+    def remove(self, path):
+        with self._lock:
+            wd = self._watches.pop(path, None)
+            if wd is None:
+                return
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError:
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size + length
+
+                with self._lock:
+                    path = self._paths.get(wd)
+                    # Kernel dropped the watch (directory removed or unmounted)
+                    if mask & IN_IGNORED and path is not None:
+                        self._paths.pop(wd, None)
+                        self._watches.pop(path, None)
+
+                if path is not None:
+                    self._on_change(path)
+
+
+class DirectoryCache:
+    """
+    In-process LRU cache of directory listings keyed by absolute directory path.
+
+    Each record keeps the DirEntry list from
+    :os.scandir()
+    (their stat() result is cached by the DirEntry itself) and the rows already
+    converted by convert_file_info, so repeat navigations do not touch the filesystem
+    except for one stat() of the directory itself to compare its mtime.
+
+    Records are dropped when the directory mtime changes, when inotify reports a change
+    or when a view calls
+    :invalidate()
+    """
+
+    def __init__(self, max_bytes=0, use_inotify=True):
+        self.max_bytes = 0
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self._scanning = {}
+        self._used_bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+        self._watcher = None
+        self.configure(max_bytes, use_inotify)
+
+    def configure(self, max_bytes, use_inotify=True):
+        """
+        Set the memory budget, the inotify thread is started once when first needed
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+        if use_inotify and max_bytes > 0 and self._watcher is None:
+            try:
+                self._watcher = InotifyWatcher(self.invalidate)
+            except (OSError, AttributeError):
+                self._watcher = None
+
+    def get(self, abs_path):
+        """
+        Returns (entries, rows) for the directory.
+        :rows is a dict name -> converted row filled lazily by the caller
+        """
+        abs_path = os.path.abspath(abs_path)
+        mtime_ns = os.stat(abs_path).st_mtime_ns
+        count_syscall("stat")
+
+        with self._lock:
+            record = self._records.get(abs_path)
+            if record is not None and record['mtime_ns'] == mtime_ns and not record['racy']:
+                self._records.move_to_end(abs_path)
+                self._stats['hits'] += 1
+                return record['entries'], record['rows']
+
+            self._stats['misses'] += 1
+            if record is not None:
+                self._drop(abs_path)
+            self._scanning[abs_path] = False
+
+        # Watch before scanning so a change during the scan is not lost
+        if self._watcher is not None and self.max_bytes > 0:
+            self._watcher.add(abs_path)
+
+        scanned_ns = time.time_ns()
+        try:
+            count_syscall("scandir")
+            with os.scandir(abs_path) as it:
+                entries = list(it)
+        except OSError:
+            with self._lock:
+                self._scanning.pop(abs_path, None)
+                self._unwatch(abs_path)
+            raise
+
+        rows = {}
+        record = {'mtime_ns': mtime_ns,
+                  'racy': mtime_ns + RACY_MTIME_NS >= scanned_ns,
+                  'entries': entries,
+                  'rows': rows,
+                  'size': ENTRY_SIZE_ESTIMATE * (len(entries) + 1),
+                  }
+
+        with self._lock:
+            changed_while_scanning = self._scanning.pop(abs_path, False)
+            if not changed_while_scanning and record['size'] <= self.max_bytes:
+                self._records[abs_path] = record
+                self._used_bytes += record['size']
+                self._evict()
+            else:
+                self._unwatch(abs_path)
+
+        return entries, rows
+
+    def invalidate(self, abs_path, recursive=False):
+        """
+        Drop cached listing of abs_path.
+        With recursive=True every cached directory under abs_path is dropped too.
+        """
+        abs_path = os.path.abspath(abs_path)
+        prefix = abs_path.rstrip(os.sep) + os.sep
+
+        with self._lock:
+            if abs_path in self._scanning:
+                self._scanning[abs_path] = True
+
+            if recursive:
+                paths = [path for path in self._records if path == abs_path or path.startswith(prefix)]
+            else:
+                paths = [abs_path] if abs_path in self._records else []
+
+            for path in paths:
+                self._drop(path)
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._records):
+                self._drop(path)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['directories'] = len(self._records)
+            stats['used_bytes'] = self._used_bytes
+            stats['max_bytes'] = self.max_bytes
+            stats['inotify'] = self._watcher is not None
+            return stats
+
+    def _drop(self, path):
+        record = self._records.pop(path)
+        self._used_bytes -= record['size']
+        if self._watcher is not None:
+            self._watcher.remove(path)
+
+    def _unwatch(self, path):
+        # Watches are only kept for stored records
+        if self._watcher is not None and path not in self._records:
+            self._watcher.remove(path)
+
+    def _evict(self):
+        while self._used_bytes > self.max_bytes and self._records:
+            path = next(iter(self._records))
+            self._drop(path)
+            self._stats['evictions'] += 1
+
+
+# Disabled until create_app() sizes it from the config
+directory_cache = DirectoryCache()
+
+def invalidate_entry(path):
+    """
+    Drop every cached listing that shows the file or folder at path:
+    its parent (entry added, removed or changed), the grandparent (parent mtime shown there)
+    and the folder itself with its subfolders if path was renamed or deleted.
+    """
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+
+    directory_cache.invalidate(path, recursive=True)
+    directory_cache.invalidate(parent)
+    directory_cache.invalidate(os.path.dirname(parent))
@@ -0,0 +1,175 @@
+import os
+import mmap
+import uuid
+import hashlib
+
+from flask import current_app
+
+from file_browser import db
+from file_browser.models import FileHash
+from file_browser.metrics import timed, count_syscall, count_hashed_bytes
+from file_browser.helpers import UPLOAD_TEMP_PREFIX
+
+# Supported content hash algorithms
+HASH_ALGORITHMS = ("blake2b", "blake2s", "sha256")
+
+# Read buffer for hashing and for saving uploads
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Files at least this big are hashed from a memory map instead of read() calls
+MMAP_THRESHOLD = 8 * 1024 * 1024
+
+
+def get_hash_algorithm():
+    """
+    Configured algorithm from
+    :app.config['FILE_HASH_ALGORITHM']
+    """
+    algorithm = current_app.config['FILE_HASH_ALGORITHM']
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm '{algorithm}'")
+    return algorithm
+
+@timed("hash_file")
+def hash_file(file_path, algorithm=None):
+    """
+    Hash the whole file in one pass.
+    Small files are read into one reusable buffer, big ones are mapped with
+    :mmap
+    so hashlib works on the page cache directly without copying.
+    """
+    hash = hashlib.new(algorithm or get_hash_algorithm())
+
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        count_syscall("open")
+        count_hashed_bytes(hash.name, size)
+
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hash.update(mapped)
+        else:
+            buffer = bytearray(HASH_BUFFER_SIZE)
+            view = memoryview(buffer)
+            while read := f.readinto(buffer):
+                hash.update(view[:read])
+
+    return hash.hexdigest()
+
+def store_file_hash(file_path, digest, algorithm, file_stat=None):
+    """
+    Save digest for the current version of the file
+    """
+    file_stat = file_stat or os.stat(file_path)
+    db.session.merge(FileHash(path=os.path.abspath(file_path),
+                              size=file_stat.st_size,
+                              mtime_ns=file_stat.st_mtime_ns,
+                              inode=file_stat.st_ino,
+                              algorithm=algorithm,
+                              digest=digest))
+    db.session.commit()
+
+def get_stored_file_hash(file_path, file_stat=None):
+    """
+    Returns the stored digest if it still belongs to the file on disk, otherwise None.
+    Costs one stat() and one primary key lookup, the file itself is not read.
+    """
+    if file_stat is None:
+        file_stat = os.stat(file_path)
+        count_syscall("stat")
+    record = db.session.get(FileHash, os.path.abspath(file_path))
+
+    if record is not None and record.matches(file_stat, get_hash_algorithm()):
+        return record.digest
+
+    return None
+
+def get_file_hash(file_path):
+    """
+    Returns the file digest from the store or hashes the file once and stores it
+    """
+    file_stat = os.stat(file_path)
+    count_syscall("stat")
+    digest = get_stored_file_hash(file_path, file_stat)
+
+    if digest is None:
+        algorithm = get_hash_algorithm()
+        digest = hash_file(file_path, algorithm)
+        store_file_hash(file_path, digest, algorithm, file_stat)
+
+    return digest
+
+def save_and_hash_upload(file, file_path):
+    """
+    Write uploaded
+    :werkzeug.datastructures.FileStorage
+    to file_path and hash the bytes while they are written, so the upload
+    is read only once and its digest is ready for the first download.
+    The bytes go to a hidden temp file in the same folder which is renamed over file_path,
+    a failed upload leaves the old file and its stored hash as they were.
+    A replaced file hardlinked from the user template loses only this link, the shared inode is not written.
+    """
+    algorithm = get_hash_algorithm()
+    hash = hashlib.new(algorithm)
+    temp_path = os.path.join(os.path.dirname(file_path), f"{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}.part")
+
+    try:
+        with open(temp_path, 'xb') as f:
+            while chunk := file.stream.read(HASH_BUFFER_SIZE):
+                hash.update(chunk)
+                f.write(chunk)
+                count_hashed_bytes(algorithm, len(chunk))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    digest = hash.hexdigest()
+    store_file_hash(file_path, digest, algorithm)
+    return digest
+
+def move_file_hashes(old_path, new_path):
+    """
+    Keep stored hashes after rename. Rename keeps inode, size and mtime so the rows stay valid.
+    For folders every row under the folder is moved.
+    """
+    old_path = os.path.abspath(old_path)
+    new_path = os.path.abspath(new_path)
+    prefix = old_path.rstrip(os.sep) + os.sep
+
+    records = FileHash.query.filter(db.or_(FileHash.path == old_path,
+                                           FileHash.path.startswith(prefix, autoescape=True))).all()
+    for record in records:
+        moved = FileHash(path=new_path + record.path[len(old_path):],
+                         size=record.size,
+                         mtime_ns=record.mtime_ns,
+                         inode=record.inode,
+                         algorithm=record.algorithm,
+                         digest=record.digest)
+        db.session.delete(record)
+        db.session.merge(moved)
+
+    db.session.commit()
+
+def forget_file_hash(file_path, recursive=False):
+    """
+    Remove stored hash of deleted file.
+    With recursive=True the hashes of every file under the deleted folder are removed.
+    """
+    file_path = os.path.abspath(file_path)
+    condition = FileHash.path == file_path
+
+    if recursive:
+        prefix = file_path.rstrip(os.sep) + os.sep
+        condition = db.or_(condition, FileHash.path.startswith(prefix, autoescape=True))
+
+    FileHash.query.filter(condition).delete(synchronize_session=False)
+    db.session.commit()
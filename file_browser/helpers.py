@@ -1,22 +1,176 @@
 import os
+import fcntl
+import hashlib
+import threading
+import functools
+import contextlib
 from pathlib import Path
 
-from file_browser import app, basedir
-from file_browser import ALLOWED_EXTENSIONS
-from flask import session, flash, url_for, redirect
+from file_browser import basedir, csrf
+from file_browser import ALLOWED_EXTENSIONS, THUMBNAIL_EXTENSIONS
+from file_browser.metrics import timed, count_syscall
+from flask import session, flash, url_for, redirect, current_app, request
+from flask_wtf.csrf import CSRFError, validate_csrf, same_origin
+from wtforms import ValidationError
+from werkzeug.security import safe_join
 import datetime
 import re
-import hashlib
+
+# Temp files of unfinished uploads are hidden in the listing by this prefix
+UPLOAD_TEMP_PREFIX = ".upload-"
+
+# File extensions with their own bootstrap icon, the web client builds icons from the same list
+ICON_FILE_TYPES = ("aac", "ai", "bmp", "cs", "css", "csv", "doc", "docx", "exe", "gif", "heic", "html", "java", "jpg", "js", "json", "jsx", "key", "m4p", "md", "mdx", "mov", "mp3",
+                   "mp4", "otf", "pdf", "php", "png", "pptx", "psd", "py", "raw", "rb", "sass", "scss", "sh", "sql", "svg", "tiff", "tsx", "ttf", "txt", "wav", "woff", "xlsx", "xml", "yml")
 
 def get_user_location_path(parent_path, requested_path):
     """
     This function constructs URL path based on parent and requested paths
     """
     if parent_path == '..':
-        return url_for('index') 
+        return url_for('main.index') 
     else:
-        return url_for('index', requested_path=requested_path)
+        return url_for('main.index', requested_path=requested_path)
+
+def is_upload_temp_path(path):
+    """
+    True if a part of path is an upload temp or quarantine file, those are not user files
+    and are never served, renamed or deleted by the user
+    """
+    return any(name.startswith(UPLOAD_TEMP_PREFIX) for name in path.split(os.sep))
+
+def safe_join_user_path(user_folder, *paths):
+    """
+    :werkzeug.security.safe_join()
+    that also refuses upload temp files, None for both
+    """
+    abs_path = safe_join(user_folder, *paths)
+    if abs_path is None or is_upload_temp_path(abs_path):
+        return None
+    return abs_path
+
+def get_users_root():
+    """
+    Absolute path of the folder that holds all user folders
+    """
+    return os.path.join(basedir, current_app.config['UPLOAD_FOLDER'])
+
+# Layouts of users_space: flat is users_space/<username>, sharded is users_space/<ab>/<cd>/<username>
+USERS_SPACE_LAYOUTS = ("flat", "sharded")
+
+# Hex characters in one shard folder name. Usernames are at least 5 characters,
+# a shard folder never has the name of a flat user folder while both layouts are in use
+SHARD_WIDTH = 2
+
+# Resolved user roots, see get_user_root()
+_user_roots = {}
+_user_roots_lock = threading.Lock()
+USER_ROOTS_MAX_ENTRIES = 100000
+
+@functools.lru_cache(maxsize=4096)
+def get_shard_names(username, levels):
+    """
+    Shard folder names of the user, taken from the hash of the username so users spread evenly
+    """
+    digest = hashlib.blake2b(username.encode(), digest_size=16).hexdigest()
+    return tuple(digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(levels))
+
+def get_layout_user_root(username, layout, users_root=None):
+    """
+    Absolute path the layout puts the user root folder at
+    """
+    users_root = users_root or get_users_root()
+    if layout == "sharded":
+        return os.path.join(users_root, *get_shard_names(username, current_app.config['USERS_SPACE_SHARD_LEVELS']), username)
+    return os.path.join(users_root, username)
+
+def get_user_root(username):
+    """
+    Absolute path of the user root folder in USERS_SPACE_LAYOUT.
+    While users-space-migrate moves the folders a user may still be at the place of the other layout,
+    that place is returned until the folder is moved. Only roots found where the configured layout
+    puts them are cached, a root the migration can still move is looked up again on the next call.
+    """
+    users_root = get_users_root()
+    layout = current_app.config['USERS_SPACE_LAYOUT']
+    key = (users_root, layout, username)
+
+    root = _user_roots.get(key)
+    if root is not None:
+        return root
+
+    root = get_layout_user_root(username, layout, users_root)
+    count_syscall("stat")
+    if os.path.isdir(root):
+        with _user_roots_lock:
+            if len(_user_roots) >= USER_ROOTS_MAX_ENTRIES:
+                _user_roots.clear()
+            _user_roots[key] = root
+        return root
+
+    other_layout = "flat" if layout == "sharded" else "sharded"
+    other_root = get_layout_user_root(username, other_layout, users_root)
+    count_syscall("stat")
+    if os.path.isdir(other_root):
+        return other_root
+
+    # New user, provisioning creates the folder in the configured layout
+    return root
+
+def forget_user_root(username):
+    """
+    Drop the cached root of the user, called after the folder was moved
+    """
+    with _user_roots_lock:
+        for key in [key for key in _user_roots if key[2] == username]:
+            del _user_roots[key]
+
+@contextlib.contextmanager
+def lock_user_folder(username, shared=False, blocking=True):
+    """
+    flock of the user folder, held by all workers and CLI commands. Requests writing into the folder hold it
+    shared, provisioning and users-space-migrate alone so the folder is not created or moved under a request.
+    Without blocking BlockingIOError is raised when the lock is taken.
+    """
+    folder = current_app.config['USER_LOCK_FOLDER']
+    os.makedirs(folder, exist_ok=True)
 
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with open(os.path.join(folder, f"{username}.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+        yield
+
+def holds_user_folder(view):
+    """
+    Run the view with the folder of the logged in user locked shared, for views that write into it
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with lock_user_folder(session['user'], shared=True):
+            return view(*args, **kwargs)
+    return wrapper
+
+def csrf_header_protected(view):
+    """
+    CSRF check for views reading the raw request body. CSRFProtect looks for the token in request.form,
+    which limits the body to MAX_CONTENT_LENGTH before the view runs, here it is only taken from the headers
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_app.config['WTF_CSRF_ENABLED']:
+            token = next(filter(None, map(request.headers.get, current_app.config['WTF_CSRF_HEADERS'])), None)
+            try:
+                validate_csrf(token)
+            except ValidationError as error:
+                raise CSRFError(error.args[0])
+
+            if request.is_secure and current_app.config['WTF_CSRF_SSL_STRICT']:
+                if not request.referrer or not same_origin(request.referrer, f"https://{request.host}/"):
+                    raise CSRFError("The referrer does not match the host.")
+        return view(*args, **kwargs)
+    return csrf.exempt(wrapper)
+
+@timed("get_user_upload_folder")
 def get_user_upload_folder():
     """
     Gets the current user working directory.
@@ -27,30 +181,20 @@ def get_user_upload_folder():
     if session["user"]:
         user = session['user']
         
-        upload_folder = app.config['UPLOAD_FOLDER']
-        default_upload_folder = f"{basedir}/{upload_folder}"
-        #path_to_home = f"{default_upload_folder}/{user}/home/"
-        #user_folder = os.path.join(path_to_home, user)
-        
-        path_to_user_root = f"{default_upload_folder}"
-        user_folder2 = os.path.join(path_to_user_root, user)
-        
-        return user_folder2
+        # Same as get_user_root(), UPLOAD_FOLDER may also be an absolute path
+        return get_user_root(user)
     
     return None
 
 def get_icon_class(file_name):
     """
     This will set bootstrap icon for file_name type if its in
-    :file_types
+    :ICON_FILE_TYPES
     """
     file_extension = Path(file_name).suffix
     file_extension = file_extension[1:] if file_extension.startswith(".") else file_extension
     
-    file_types = ["aac", "ai", "bmp", "cs", "css", "csv", "doc", "docx", "exe", "gif", "heic", "html", "java", "jpg", "js", "json", "jsx", "key", "m4p", "md", "mdx", "mov", "mp3",
-                 "mp4", "otf", "pdf", "php", "png", "pptx", "psd", "py", "raw", "rb", "sass", "scss", "sh", "sql", "svg", "tiff", "tsx", "ttf", "txt", "wav", "woff", "xlsx", "xml", "yml"]
-    
-    file_class_name = f"bi bi-filetype-{file_extension}" if file_extension in file_types else "bi bi-file-earmark"
+    file_class_name = f"bi bi-filetype-{file_extension}" if file_extension in ICON_FILE_TYPES else "bi bi-file-earmark"
     
     return file_class_name
 
@@ -68,24 +212,39 @@ def get_time_stamp(time_seconds):
     time_object = datetime.datetime.fromtimestamp(time_seconds)
     time_string = datetime.datetime.strftime(time_object, '%d-%m-%Y %H:%M:%S')
     return time_string
+
+def get_thumbnail_version(file_name, file_stat):
+    """
+    Version of the thumbnail url from size and mtime, None if file_name is not an image
+    """
+    if Path(file_name).suffix[1:].lower() not in THUMBNAIL_EXTENSIONS:
+        return None
+    return f"{file_stat.st_size:x}{file_stat.st_mtime_ns:x}"
     
+@timed("convert_file_info")
 def convert_file_info(file, user_path):
     """
-    Get each file needed stat using
-    :os.stat()
+    Get each file needed stat using the cached
+    :os.DirEntry.stat()
     Then convert it to human readable information using
     :get_readable_byte_size()
     :get_time_stamp()
     And set file or folder icon and type using
     :get_icon_class()
     """
-    file_stat = os.stat(file)
+    file_stat = file.stat()
+    count_syscall("stat")
     file_bytes = get_readable_byte_size(file_stat.st_size)
     file_time = get_time_stamp(file_stat.st_mtime)
     file_created_time = get_time_stamp(file_stat.st_ctime)
     
-    file_icon = "bi bi-folder-fill" if os.path.isdir(file.path) else get_icon_class(file.name)
-    file_type = "folder" if os.path.isdir(file.path) else "file"
+    # DirEntry.is_dir() is answered from the scandir result without extra syscall
+    is_dir = file.is_dir()
+    file_icon = "bi bi-folder-fill" if is_dir else get_icon_class(file.name)
+    file_type = "folder" if is_dir else "file"
+    
+    # Images get a thumbnail url versioned by size and mtime
+    thumbnail_version = None if is_dir else get_thumbnail_version(file.name, file_stat)
 
     return {'name': file.name,
             'size': file_bytes,
@@ -94,6 +253,9 @@ def convert_file_info(file, user_path):
             'file_icon': file_icon,
             'file_link': os.path.relpath(file.path, user_path),
             'file_type': file_type,
+            'thumbnail_version': thumbnail_version,
+            # Lets the web client keep the row when it patches the table from the listing API
+            'version': f"{file_stat.st_size}-{int(file_stat.st_mtime)}",
             }
 
 def sanitize_folder_name(folder_name):
@@ -114,28 +276,68 @@ def sanitize_folder_name(folder_name):
     
     return folder_name
 
-def redirect_url_to_page_and_path(to_path="", to_page='index'):
+def redirect_url_to_page_and_path(to_path="", to_page='main.index'):
     """
     Function to redirect to index url with or without current path position
     For example if user is in /home/username/my_folder it will return the user to their folder eg my_folder
     """
     return redirect(url_for(to_page, requested_path=to_path))
 
-def calculate_file_hash(file_path):
-    """
-    Helper function to calculate file hash using
-    :hashlib
-    """
-    hash = hashlib.md5()
-    
-    with open(file_path, 'rb') as f:
-        while block := f.read(4096):
-            hash.update(block)
-    return hash.hexdigest()
-
 def allowed_file(filename):
     """
     Allowed extensions
     """
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
\ No newline at end of file
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+# Bytes of the upload start looked at to tell its type
+SNIFF_SIZE = 2048
+
+# Leading bytes of the allowed binary types
+FILE_SIGNATURES = ((b"%PDF-", "application/pdf"),
+                   (b"\x89PNG\r\n\x1a\n", "image/png"),
+                   (b"\xff\xd8\xff", "image/jpeg"),
+                   (b"GIF87a", "image/gif"),
+                   (b"GIF89a", "image/gif"))
+
+# Type the content of each allowed extension must have
+EXTENSION_MIME_TYPES = {'txt': "text/plain",
+                        'pdf': "application/pdf",
+                        'png': "image/png",
+                        'jpg': "image/jpeg",
+                        'jpeg': "image/jpeg",
+                        'gif': "image/gif"}
+
+def sniff_mime_type(head):
+    """
+    MIME type from the first bytes of the file. Anything else without NUL bytes is taken as text,
+    executables and other binary formats have them in their headers.
+    """
+    for signature, mime_type in FILE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+
+    if b"\0" not in head:
+        return "text/plain"
+
+    return "application/octet-stream"
+
+def is_content_allowed(filename, head):
+    """
+    Check that the file starts like the type its extension promises, a renamed executable is refused.
+    Always True when UPLOAD_MIME_CHECK is off.
+    """
+    if not current_app.config['UPLOAD_MIME_CHECK']:
+        return True
+
+    expected = EXTENSION_MIME_TYPES.get(Path(filename).suffix[1:].lower())
+    return expected is None or sniff_mime_type(head[:SNIFF_SIZE]) == expected
+
+def read_upload_head(file):
+    """
+    First bytes of form upload. werkzeug spooled the upload while parsing the form, the stream
+    is rewound and nothing more is read.
+    """
+    head = file.stream.read(SNIFF_SIZE)
+    file.stream.seek(0)
+    return head
@@ -0,0 +1,482 @@
+import os
+import time
+import fcntl
+import uuid
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from file_browser import db, basedir
+from file_browser.models import FileJob
+from file_browser.dircache import invalidate_entry
+from file_browser.hashing import forget_file_hash
+from file_browser.blobstore import release_blob_references
+from file_browser.search import index_entry, unindex_entry
+from file_browser.quota import QuotaExceeded, has_quota_for, add_storage_usage
+from file_browser.helpers import lock_user_folder
+
+# Bytes copied per copy_file_range/sendfile call, progress and cancel are checked between calls
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Finished jobs kept per user for status requests
+JOB_HISTORY = 100
+
+# Seconds between progress saves of a running job, a cancel request is seen within this time
+JOB_SYNC_INTERVAL = 0.5
+
+JOB_KINDS = ("delete", "copy")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# ((pid, lock folder), token, lock file) of this process, see get_worker_token()
+_worker = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Background delete or copy of a folder tree, run in the worker process that started it.
+
+    Progress lives in this object while the job runs and is saved to its
+    :FileJob
+    row every JOB_SYNC_INTERVAL seconds, the status endpoints of every worker read the row.
+    """
+
+    def __init__(self, record):
+        self.id = record.id
+        self.username = record.username
+        self.kind = record.kind
+        self.source = record.source
+        self.destination = record.destination
+        self.status = record.status
+        self.error = None
+        self.total_items = 0
+        self.total_bytes = 0
+        self.done_items = 0
+        self.done_bytes = 0
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._synced = 0.0
+        # Worker threads run the job in a context of this app
+        self.app = current_app._get_current_object()
+
+    def check_cancelled(self):
+        self.sync()
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def sync(self, force=False):
+        """
+        Save progress to the job row and pick up a cancel request made on any worker
+        """
+        now = time.monotonic()
+        if not force and now - self._synced < JOB_SYNC_INTERVAL:
+            return
+        self._synced = now
+
+        db.session.execute(db.update(FileJob)
+                           .where(FileJob.id == self.id)
+                           .values(status=self.status,
+                                   error=self.error,
+                                   total_items=self.total_items,
+                                   total_bytes=self.total_bytes,
+                                   done_items=self.done_items,
+                                   done_bytes=self.done_bytes,
+                                   finished_at=self.finished_at))
+        cancel_requested = db.session.execute(db.select(FileJob.cancel_requested)
+                                              .where(FileJob.id == self.id)).scalar()
+        db.session.commit()
+
+        if cancel_requested:
+            self._cancel.set()
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config['JOB_MAX_WORKERS'],
+                                           thread_name_prefix="file-jobs")
+        return _executor
+
+def get_worker_token():
+    """
+    Token of this process saved with the jobs it starts. The process holds a flock on
+    JOB_LOCK_FOLDER/<token>.lock while it lives, so the sweep can tell which jobs lost their process.
+    """
+    global _worker
+
+    folder = current_app.config['JOB_LOCK_FOLDER']
+    with _executor_lock:
+        if _worker is None or _worker[0] != (os.getpid(), folder):
+            os.makedirs(folder, exist_ok=True)
+
+            # Locked before it gets its name, the sweep never sees the lock file free while the process lives
+            token = uuid.uuid4().hex
+            temp_path = os.path.join(folder, f".{token}.tmp")
+            lock_file = open(temp_path, "w")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            os.rename(temp_path, os.path.join(folder, f"{token}.lock"))
+
+            _worker = ((os.getpid(), folder), token, lock_file)
+        return _worker[1]
+
+def is_worker_alive(token):
+    lock_path = os.path.join(current_app.config['JOB_LOCK_FOLDER'], f"{token}.lock")
+    try:
+        with open(lock_path, "r") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except FileNotFoundError:
+        return False
+    except BlockingIOError:
+        return True
+    return False
+
+def count_tree(path, job):
+    """
+    Count files, folders and bytes under path with
+    :os.scandir()
+    so progress can be reported
+    """
+    items = 1
+    size = 0
+    stack = [path]
+
+    while stack:
+        job.check_cancelled()
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                items += 1
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+
+    return items, size
+
+def copy_file_data(source_fd, destination_fd, size, job):
+    """
+    Copy file content inside the kernel with
+    :os.copy_file_range()
+    falls back to
+    :os.sendfile()
+    and to plain read/write if the filesystem does not support them.
+    """
+    copied = 0
+    method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+
+    while copied < size:
+        job.check_cancelled()
+        count = min(COPY_CHUNK_SIZE, size - copied)
+
+        try:
+            if method == "copy_file_range":
+                sent = os.copy_file_range(source_fd, destination_fd, count)
+            elif method == "sendfile":
+                sent = os.sendfile(destination_fd, source_fd, None, count)
+            else:
+                data = os.read(source_fd, count)
+                sent = os.write(destination_fd, data) if data else 0
+        except OSError:
+            if method == "read":
+                raise
+            # Not supported for these files, continue from the same offset with the next method
+            method = "sendfile" if method == "copy_file_range" else "read"
+            os.lseek(source_fd, copied, os.SEEK_SET)
+            os.lseek(destination_fd, copied, os.SEEK_SET)
+            continue
+
+        # File got shorter while copying
+        if sent == 0:
+            break
+
+        copied += sent
+        job.done_bytes += sent
+
+def copy_file(source, destination, job):
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        file_stat = os.fstat(source_fd)
+        destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, file_stat.st_mode & 0o777)
+        try:
+            copy_file_data(source_fd, destination_fd, file_stat.st_size, job)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+    shutil.copystat(source, destination)
+
+def copy_tree(job):
+    """
+    Copy job.source into job.destination walking the tree with
+    :os.scandir()
+    A cancelled or failed copy is removed.
+    """
+    source = job.source
+    target = os.path.join(job.destination, os.path.basename(source))
+    created = False
+
+    try:
+        if os.path.isdir(source):
+            os.mkdir(target)
+            created = True
+            job.done_items += 1
+            stack = [(source, target)]
+
+            while stack:
+                source_dir, target_dir = stack.pop()
+                with os.scandir(source_dir) as it:
+                    for entry in it:
+                        job.check_cancelled()
+                        entry_target = os.path.join(target_dir, entry.name)
+
+                        if entry.is_symlink():
+                            os.symlink(os.readlink(entry.path), entry_target)
+                        elif entry.is_dir():
+                            os.mkdir(entry_target)
+                            stack.append((entry.path, entry_target))
+                        elif entry.is_file():
+                            copy_file(entry.path, entry_target, job)
+
+                        job.done_items += 1
+        else:
+            copy_file(source, target, job)
+            job.done_items += 1
+
+        index_entry(target, recursive=True)
+        add_storage_usage(job.username, job.done_bytes)
+
+    except BaseException as error:
+        # Target that existed before the job started is not removed
+        if created or not isinstance(error, FileExistsError):
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target, ignore_errors=True)
+            elif os.path.lexists(target):
+                os.remove(target)
+        raise
+
+    finally:
+        invalidate_entry(target)
+
+def delete_tree(job):
+    """
+    Delete job.source bottom up. Cancel stops after the current item, what is deleted stays deleted.
+    """
+    source = job.source
+    # Stat results of deleted files, files linked to the blob store release their blob
+    deleted_stats = []
+
+    try:
+        if os.path.isdir(source) and not os.path.islink(source):
+            # Folders are removed after their content, in reverse order of discovery
+            folders = [source]
+            stack = [source]
+
+            while stack:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        job.check_cancelled()
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                            stack.append(entry.path)
+                        else:
+                            entry_stat = entry.stat(follow_symlinks=False)
+                            os.unlink(entry.path)
+                            deleted_stats.append(entry_stat)
+                            job.done_items += 1
+                            job.done_bytes += entry_stat.st_size
+
+            for folder in reversed(folders):
+                job.check_cancelled()
+                os.rmdir(folder)
+                job.done_items += 1
+        else:
+            source_stat = os.lstat(source)
+            os.unlink(source)
+            deleted_stats.append(source_stat)
+            job.done_items += 1
+            job.done_bytes += source_stat.st_size
+
+    finally:
+        invalidate_entry(source)
+        unindex_entry(source)
+        forget_file_hash(source, recursive=True)
+        # What got deleted before a cancel or error is freed too
+        add_storage_usage(job.username, -job.done_bytes)
+        release_blob_references(deleted_stats)
+
+def run_job(job):
+    with job.app.app_context():
+        # The folder is not moved by users-space-migrate while the job works in it
+        with lock_user_folder(job.username, shared=True):
+            execute_job(job)
+
+def execute_job(job):
+    try:
+        # Cancelled while it waited for a thread
+        job.check_cancelled()
+        job.status = "running"
+        job.sync(force=True)
+
+        job.total_items, job.total_bytes = count_tree(job.source, job) if os.path.isdir(job.source) \
+            else (1, os.lstat(job.source).st_size)
+
+        if job.kind == "copy":
+            if not has_quota_for(job.username, job.total_bytes):
+                raise QuotaExceeded()
+            copy_tree(job)
+        else:
+            delete_tree(job)
+
+        job.status = "done"
+
+    except JobCancelled:
+        job.status = "cancelled"
+
+    except QuotaExceeded:
+        job.status = "failed"
+        job.error = "Storage quota exceeded!"
+
+    except OSError as error:
+        job.status = "failed"
+        job.error = error.strerror or str(error)
+
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Job %s (%s of %s) failed", job.id, job.kind, job.source)
+        job.status = "failed"
+        job.error = "Internal error!"
+
+    finally:
+        job.finished_at = time.time()
+        try:
+            job.sync(force=True)
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("Saving the result of job %s failed", job.id)
+
+def start_job(username, kind, source, destination=None):
+    """
+    Save new job and queue it in this process, returns its
+    :FileJob
+    row
+    """
+    record = FileJob(id=uuid.uuid4().hex,
+                     username=username,
+                     kind=kind,
+                     source=source,
+                     destination=destination,
+                     status="queued",
+                     worker=get_worker_token(),
+                     created_at=time.time())
+    db.session.add(record)
+    db.session.commit()
+    prune_finished_jobs(username)
+
+    get_executor().submit(run_job, Job(record))
+    return record
+
+def get_job(job_id, username):
+    """
+    Returns the job row if it belongs to username, otherwise None
+    """
+    record = db.session.get(FileJob, job_id)
+    if record is None or record.username != username:
+        return None
+    return record
+
+def get_user_jobs(username):
+    return FileJob.query.filter_by(username=username).order_by(FileJob.created_at).all()
+
+def request_cancel(record):
+    """
+    Ask the worker running the job to stop, it sees the request on its next progress save
+    """
+    if record.finished_at is None:
+        record.cancel_requested = True
+        db.session.commit()
+
+def prune_finished_jobs(username):
+    """
+    Keep the JOB_HISTORY most recently finished jobs of the user
+    """
+    kept = (db.select(FileJob.id)
+            .where(FileJob.username == username, FileJob.finished_at.is_not(None))
+            .order_by(FileJob.finished_at.desc())
+            .limit(JOB_HISTORY))
+    db.session.execute(db.delete(FileJob)
+                       .where(FileJob.username == username,
+                              FileJob.finished_at.is_not(None),
+                              FileJob.id.not_in(kept)))
+    db.session.commit()
+
+def sweep_orphaned_jobs():
+    """
+    Jobs run in the process that started them and do not survive its restart. Queued and running
+    jobs of processes that are gone are marked failed, a partial copy they left is counted by the
+    quota reconciler. Lock files of those processes are removed. Returns the number of jobs marked.
+    """
+    workers = db.session.execute(db.select(FileJob.worker)
+                                 .where(FileJob.finished_at.is_(None))
+                                 .distinct()).scalars().all()
+    # Jobs saved before the worker column have no process to wait for
+    gone = [worker for worker in workers if worker is not None and not is_worker_alive(worker)]
+
+    result = db.session.execute(db.update(FileJob)
+                                .where(FileJob.finished_at.is_(None),
+                                       db.or_(FileJob.worker.is_(None), FileJob.worker.in_(gone)))
+                                .values(status="failed", error="Interrupted", finished_at=time.time()))
+    db.session.commit()
+
+    folder = current_app.config['JOB_LOCK_FOLDER']
+    for name in os.listdir(folder) if os.path.isdir(folder) else []:
+        if name.endswith(".lock") and not is_worker_alive(name[:-len(".lock")]):
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
+    if result.rowcount:
+        current_app.logger.warning("Marked %d interrupted jobs failed", result.rowcount)
+    return result.rowcount
+
+def start_job_sweeper():
+    """
+    Run the sweep now and every JOB_SWEEP_INTERVAL seconds in background.
+    Only the process holding the lock file runs it.
+    """
+    interval = current_app.config['JOB_SWEEP_INTERVAL']
+    if interval <= 0:
+        return None
+
+    lock_file = open(os.path.join(basedir, ".job_sweep.lock"), "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+
+    app = current_app._get_current_object()
+
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    sweep_orphaned_jobs()
+            except Exception:
+                app.logger.exception("Job sweep failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="job-sweeper", daemon=True)
+    thread.lock_file = lock_file
+    thread.start()
+    return thread
@@ -0,0 +1,147 @@
+import os
+import time
+import fcntl
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from file_browser import db, basedir
+from file_browser.models import User, UploadSession, UploadScan
+from file_browser.helpers import USERS_SPACE_LAYOUTS, get_users_root, get_layout_user_root, forget_user_root
+from file_browser.helpers import lock_user_folder
+from file_browser.hashing import move_file_hashes
+from file_browser.dircache import directory_cache
+
+# Results of migrate_user()
+MIGRATION_MOVED = "moved"
+MIGRATION_IN_PLACE = "in place"
+MIGRATION_MISSING = "missing"
+# A request is writing into the folder, the next run moves it
+MIGRATION_BUSY = "busy"
+
+
+def get_other_layout(layout):
+    return "flat" if layout == "sharded" else "sharded"
+
+def move_upload_sessions(username, old_root, new_root):
+    """
+    Point unfinished chunked uploads and upload scans of the user to the moved folder, the temp files
+    moved with it. Quarantine files are outside users_space, only those of older versions moved along.
+    """
+    prefix = old_root + os.sep
+    for upload in UploadSession.query.filter_by(username=username).all():
+        if upload.target_path.startswith(prefix):
+            upload.target_path = new_root + upload.target_path[len(old_root):]
+        if upload.temp_path.startswith(prefix):
+            upload.temp_path = new_root + upload.temp_path[len(old_root):]
+    for scan in UploadScan.query.filter_by(username=username).all():
+        if scan.target_path.startswith(prefix):
+            scan.target_path = new_root + scan.target_path[len(old_root):]
+        if scan.quarantine_path.startswith(prefix):
+            scan.quarantine_path = new_root + scan.quarantine_path[len(old_root):]
+    db.session.commit()
+
+def remove_empty_shards(old_root):
+    """
+    Remove shard folders left empty when a user was moved out of the sharded layout
+    """
+    users_root = get_users_root()
+    folder = os.path.dirname(old_root)
+    while folder != users_root and folder.startswith(users_root + os.sep):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            # Other users are still in it
+            return
+        folder = os.path.dirname(folder)
+
+def migrate_user(username, layout):
+    """
+    Move the user folder to the place layout puts it with one rename, the folder is at the old or
+    at the new place at any moment. Stored hashes and upload sessions follow the folder.
+    They are moved again for users already in place, a run stopped between the rename and
+    the database update is finished by the next run.
+    The user folder lock is taken without waiting, while uploads or provisioning of any worker
+    hold it the user is skipped as busy.
+    """
+    old_root = get_layout_user_root(username, get_other_layout(layout))
+    new_root = get_layout_user_root(username, layout)
+
+    try:
+        with lock_user_folder(username, blocking=False):
+            if os.path.isdir(new_root):
+                result = MIGRATION_IN_PLACE
+            elif os.path.isdir(old_root):
+                os.makedirs(os.path.dirname(new_root), exist_ok=True)
+                os.rename(old_root, new_root)
+                result = MIGRATION_MOVED
+            else:
+                return MIGRATION_MISSING
+
+            # Requests waiting for the lock read the moved paths
+            move_file_hashes(old_root, new_root)
+            move_upload_sessions(username, old_root, new_root)
+    except BlockingIOError:
+        return MIGRATION_BUSY
+
+    if result == MIGRATION_MOVED:
+        forget_user_root(username)
+        directory_cache.invalidate(old_root, recursive=True)
+        if layout == "flat":
+            remove_empty_shards(old_root)
+
+    return result
+
+@click.command("users-space-migrate")
+@click.option("--limit", default=0, help="Move at most this many users in this run, 0 moves all.")
+@click.option("--pause", default=0.0, help="Seconds to wait after each moved user, spreads the load on a live server.")
+@click.option("--dry-run", is_flag=True, help="Only count the users that would be moved.")
+@with_appcontext
+def users_space_migrate_command(limit, pause, dry_run):
+    """Move user folders to USERS_SPACE_LAYOUT while the server runs. Safe to stop and run again."""
+    layout = current_app.config['USERS_SPACE_LAYOUT']
+    if layout not in USERS_SPACE_LAYOUTS:
+        raise click.ClickException(f"Unknown USERS_SPACE_LAYOUT '{layout}', use one of {', '.join(USERS_SPACE_LAYOUTS)}")
+
+    lock_file = open(os.path.join(basedir, ".users_space_migrate.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise click.ClickException("Another users-space-migrate is running")
+
+    counts = {MIGRATION_MOVED: 0, MIGRATION_IN_PLACE: 0, MIGRATION_MISSING: 0, MIGRATION_BUSY: 0}
+    started = time.perf_counter()
+
+    with lock_file:
+        usernames = db.session.execute(db.select(User.username).order_by(User.username)).scalars().all()
+        for username in usernames:
+            if limit and counts[MIGRATION_MOVED] >= limit:
+                break
+
+            if dry_run:
+                old_root = get_layout_user_root(username, get_other_layout(layout))
+                new_root = get_layout_user_root(username, layout)
+                if os.path.isdir(new_root):
+                    counts[MIGRATION_IN_PLACE] += 1
+                elif os.path.isdir(old_root):
+                    counts[MIGRATION_MOVED] += 1
+                else:
+                    counts[MIGRATION_MISSING] += 1
+                continue
+
+            try:
+                result = migrate_user(username, layout)
+            except OSError as error:
+                click.echo(f"Moving '{username}' failed: {error}")
+                continue
+
+            counts[result] += 1
+            if result == MIGRATION_MOVED and pause:
+                time.sleep(pause)
+
+    verb = "Would move" if dry_run else "Moved"
+    click.echo(f"{verb} {counts[MIGRATION_MOVED]} users to the {layout} layout in {time.perf_counter() - started:.1f}s, "
+               f"{counts[MIGRATION_IN_PLACE]} already in place, {counts[MIGRATION_MISSING]} without folder, "
+               f"{counts[MIGRATION_BUSY]} busy")
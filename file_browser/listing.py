@@ -0,0 +1,203 @@
+import os
+import time
+import heapq
+import json
+import base64
+import hashlib
+import binascii
+from typing import Optional
+
+import msgspec
+
+from file_browser.helpers import convert_file_info, get_thumbnail_version, UPLOAD_TEMP_PREFIX
+from file_browser.metrics import timed, count_syscall
+from file_browser.dircache import directory_cache, RACY_MTIME_NS
+
+# Sort keys the index view accepts through ?sort=
+SORT_KEYS = ("name", "size", "mtime")
+SORT_ORDERS = ("asc", "desc")
+
+
+class ListingRow(msgspec.Struct, array_like=True):
+    """
+    One entry of the listing API, encoded as array
+    [name, is_dir, size, mtime, ctime, thumbnail_version].
+    Size is in bytes and times are epoch seconds, the client formats them.
+    """
+    name: str
+    is_dir: bool
+    size: int
+    mtime: int
+    ctime: int
+    thumbnail_version: Optional[str] = None
+
+
+class Listing(msgspec.Struct):
+    path: str
+    location: str
+    parent: Optional[str]
+    rows: list[ListingRow]
+    next_cursor: Optional[str]
+    sort: str
+    order: str
+    total: int
+    storage_used: int
+    storage_quota: int
+
+
+# Encoder is reused, it keeps its output buffer between calls
+listing_encoder = msgspec.json.Encoder()
+
+
+def get_sort_key(file, sort_by):
+    """
+    Build the sort key for a single
+    :os.DirEntry
+    The name is always the tie breaker so the order is total and a cursor
+    can point to an exact position.
+    Sorting by name never calls stat(), size and mtime use the DirEntry
+    cached stat() so each entry costs at most one syscall.
+    """
+    if sort_by == "size":
+        return (file.stat().st_size, file.name)
+
+    if sort_by == "mtime":
+        return (file.stat().st_mtime_ns, file.name)
+
+    return (file.name.lower(), file.name)
+
+def encode_cursor(sort_by, order, sort_key):
+    """
+    Encode the sort key of the last listed entry into url safe token.
+    The sort key and order go with it, size and mtime keys look the same.
+    """
+    raw = json.dumps([sort_by, order, *sort_key], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor, sort_by, order):
+    """
+    Decode cursor made by
+    :encode_cursor()
+    Returns None if the cursor is missing, broken or made for another sort key or order
+    so the listing starts from the first page.
+    """
+    if not cursor:
+        return None
+
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (ValueError, binascii.Error):
+        return None
+
+    if not isinstance(value, list) or len(value) != 4 or value[:2] != [sort_by, order]:
+        return None
+
+    # Name keys are (str, str), size and mtime keys (int, str)
+    first_type = str if sort_by == "name" else int
+    sort_key = tuple(value[2:])
+    if type(sort_key[0]) is not first_type or not isinstance(sort_key[1], str):
+        return None
+
+    return sort_key
+
+def get_file_row(file, user_path, rows):
+    """
+    Returns the converted row for file, reusing the one stored in the directory cache
+    """
+    row = rows.get(file.name)
+    if row is None:
+        row = rows[file.name] = convert_file_info(file, user_path)
+    return row
+
+def get_compact_row(file):
+    """
+    Raw values of file from the cached
+    :os.DirEntry.stat()
+    No formatting is done on the server.
+    """
+    file_stat = file.stat()
+    count_syscall("stat")
+    is_dir = file.is_dir()
+
+    return ListingRow(file.name, is_dir, file_stat.st_size, int(file_stat.st_mtime), int(file_stat.st_ctime),
+                      None if is_dir else get_thumbnail_version(file.name, file_stat))
+
+def get_listing_etag(abs_path, *query):
+    """
+    Weak ETag of one listing page keyed by the directory mtime and the query.
+    Adding, removing or renaming an entry changes the directory mtime.
+
+    Returns None when the mtime is so recent that another change in the same
+    clock tick would not change it, the page is then always sent.
+    """
+    mtime_ns = os.stat(abs_path).st_mtime_ns
+    count_syscall("stat")
+
+    if mtime_ns + RACY_MTIME_NS >= time.time_ns():
+        return None
+
+    key = "\0".join(str(value) for value in (abs_path, mtime_ns) + query)
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+@timed("list_directory")
+def list_directory(abs_path, user_path, sort_by="name", order="asc", cursor=None, page_size=500, compact=False):
+    """
+    Returns one page of directory listing sorted on the server.
+
+    Only the DirEntry objects are kept in memory for the whole directory.
+    They come from
+    :directory_cache
+    so a repeated listing of unchanged directory does no scandir or stat calls.
+    The page is selected with
+    :heapq.nsmallest() / heapq.nlargest()
+    and only the entries on the page are converted with
+    :convert_file_info()
+
+    'files' is a generator so the template can stream the rows.
+    With compact=True it yields
+    :ListingRow
+    for the listing API instead.
+    'next_cursor' is None on the last page.
+    """
+    sort_by = sort_by if sort_by in SORT_KEYS else "name"
+    order = order if order in SORT_ORDERS else "asc"
+    descending = order == "desc"
+    after = decode_cursor(cursor, sort_by, order)
+
+    def sort_key(file):
+        return get_sort_key(file, sort_by)
+
+    entries, rows = directory_cache.get(abs_path)
+
+    # Hide temp files of unfinished chunked uploads
+    entries = [file for file in entries if not file.name.startswith(UPLOAD_TEMP_PREFIX)]
+
+    total = len(entries)
+
+    # Skip everything up to and including the cursor position
+    if after is not None:
+        if descending:
+            entries = [file for file in entries if sort_key(file) < after]
+        else:
+            entries = [file for file in entries if sort_key(file) > after]
+
+    select = heapq.nlargest if descending else heapq.nsmallest
+    page = select(page_size + 1, entries, key=sort_key)
+
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = encode_cursor(sort_by, order, sort_key(page[-1]))
+
+    if compact:
+        files = (get_compact_row(file) for file in page)
+    else:
+        files = (get_file_row(file, user_path, rows) for file in page)
+
+    return {'files': files,
+            'next_cursor': next_cursor,
+            'sort_by': sort_by,
+            'order': order,
+            'total': total,
+            }
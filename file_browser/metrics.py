@@ -0,0 +1,496 @@
+import os
+import sys
+import json
+import time
+import atexit
+import uuid
+import fcntl
+import random
+import bisect
+import functools
+import threading
+import contextlib
+from collections import Counter as StackCounter
+
+from flask import request, g, current_app
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+
+# Upper bounds of latency buckets in seconds, the last bucket +Inf is added by the histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prometheus text exposition format served by the metrics endpoint
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Clients allowed to scrape without METRICS_TOKEN
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+# Turned on by init_metrics(), spans and counters are no-ops until then
+enabled = False
+
+# Snapshot of the workers that exited, merged into one file by the server master
+RETIRED_SNAPSHOT = "retired.json"
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """
+    Monotonic counter per label values, kept in memory of the worker process and
+    written to METRICS_FOLDER to be summed with the other workers
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return self.dump(self._values)
+
+    def dump(self, values):
+        return [[list(label_values), value] for label_values, value in values.items()]
+
+    def merge(self, values, snapshot):
+        """
+        Add the series of a snapshot to values, a dict by label values
+        """
+        for label_values, value in snapshot:
+            label_values = tuple(label_values)
+            values[label_values] = values.get(label_values, 0) + value
+
+    def collect(self, values):
+        for label_values, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    """
+    Cumulative histogram per label values with fixed bucket bounds
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if not enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # Count per bucket (+Inf last) and sum of observed values
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return self.dump(self._values)
+
+    def dump(self, values):
+        return [[list(label_values), list(counts), total] for label_values, (counts, total) in values.items()]
+
+    def merge(self, values, snapshot):
+        """
+        Add the series of a snapshot to values, a dict by label values
+        """
+        for label_values, counts, total in snapshot:
+            # Written with other bucket bounds by an older version
+            if len(counts) != len(self.buckets) + 1:
+                continue
+            series = values.setdefault(tuple(label_values), [[0] * (len(self.buckets) + 1), 0.0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+
+    def collect(self, values):
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """
+        Values of all metrics of this process as JSON serializable dict by metric name
+        """
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def merge(self, snapshots):
+        """
+        One snapshot with the values of all snapshots added up, metrics not registered any more are dropped
+        """
+        merged = {}
+        for metric in self._metrics:
+            values = {}
+            for snapshot in snapshots:
+                metric.merge(values, snapshot.get(metric.name, ()))
+            merged[metric.name] = metric.dump(values)
+        return merged
+
+    def render(self, snapshots=None):
+        """
+        All metrics in Prometheus text format, summed over snapshots when given
+        """
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+
+        lines = []
+        for metric in self._metrics:
+            values = {}
+            for snapshot in snapshots:
+                metric.merge(values, snapshot.get(metric.name, ()))
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect(values))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "file_browser_request_duration_seconds", "Time from request start until the response was sent.",
+    ("endpoint", "method", "status")))
+span_duration = registry.register(Histogram(
+    "file_browser_span_duration_seconds", "Time spent in instrumented functions.", ("span",)))
+template_duration = registry.register(Histogram(
+    "file_browser_template_render_seconds", "Template rendering time, streamed templates include sending.", ("template",)))
+query_duration = registry.register(Histogram(
+    "file_browser_db_query_duration_seconds", "SQL statement execution time.", ("statement",)))
+fs_syscalls = registry.register(Counter(
+    "file_browser_fs_syscalls_total", "Filesystem calls made by the listing, download and hashing paths.", ("call",)))
+hashed_bytes = registry.register(Counter(
+    "file_browser_hashed_bytes_total", "Bytes fed to content hash functions.", ("algorithm",)))
+profiles_written = registry.register(Counter(
+    "file_browser_profiles_written_total", "Slow request profiles written to PROFILE_FOLDER."))
+
+
+def count_syscall(call, amount=1):
+    fs_syscalls.inc(amount, call)
+
+def count_hashed_bytes(algorithm, amount):
+    hashed_bytes.inc(amount, algorithm)
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Record the duration of the with block in
+    :span_duration
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_duration.observe(time.perf_counter() - started, name)
+
+def timed(name):
+    """
+    Decorator recording the duration of every call in
+    :span_duration
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                span_duration.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def get_snapshot_path(folder, pid=None):
+    return os.path.join(folder, f"{pid or os.getpid()}.json")
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_snapshot(path, snapshot):
+    """
+    Replace the snapshot file at once, readers see the old or the new one
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+
+@contextlib.contextmanager
+def lock_snapshots(folder, operation):
+    """
+    Readers share the lock, retiring a worker takes it alone so no reader counts the worker twice or not at all
+    """
+    with open(os.path.join(folder, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, operation)
+        yield
+
+def collect_snapshots(folder):
+    """
+    Live values of this worker, the last written ones of the other workers and the sums of the exited workers
+    """
+    own_name = os.path.basename(get_snapshot_path(folder))
+    snapshots = [registry.snapshot()]
+
+    with lock_snapshots(folder, fcntl.LOCK_SH):
+        for entry in os.scandir(folder):
+            if entry.name.endswith(".json") and entry.name != own_name:
+                snapshots.append(read_snapshot(entry.path))
+    return snapshots
+
+def render_metrics(folder):
+    """
+    Metrics of all workers writing to folder in Prometheus text format, of this worker alone without folder
+    """
+    if not folder:
+        return registry.render()
+    return registry.render(collect_snapshots(folder))
+
+def retire_snapshot(folder, pid):
+    """
+    Add the last snapshot of an exited worker to the retired sums, its counts stay in the totals
+    and a new worker with the same pid starts from zero. Called by the server master.
+    """
+    path = get_snapshot_path(folder, pid)
+    if not os.path.exists(path):
+        return
+
+    retired_path = os.path.join(folder, RETIRED_SNAPSHOT)
+    with lock_snapshots(folder, fcntl.LOCK_EX):
+        write_snapshot(retired_path, registry.merge([read_snapshot(retired_path), read_snapshot(path)]))
+        os.remove(path)
+
+def start_metrics_writer(app):
+    """
+    Write the snapshot of this worker to METRICS_FOLDER every METRICS_WRITE_INTERVAL seconds and on exit.
+    Runs in every worker, not only in one.
+    """
+    folder = app.config['METRICS_FOLDER']
+    interval = app.config['METRICS_WRITE_INTERVAL']
+    if not enabled or not folder or interval <= 0:
+        return None
+
+    os.makedirs(folder, exist_ok=True)
+    path = get_snapshot_path(folder)
+    logger = app.logger
+
+    def write():
+        try:
+            write_snapshot(path, registry.snapshot())
+        except OSError as error:
+            logger.warning("Writing metrics snapshot failed: %s", error)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            write()
+
+    # The master retires the snapshot after the worker exited, the counts since the last write go with it
+    atexit.register(write)
+
+    thread = threading.Thread(target=run, name="metrics-writer", daemon=True)
+    thread.start()
+    return thread
+
+
+class StackSampler:
+    """
+    Sampling profiler for request threads.
+
+    One background thread wakes up every interval and records the current stack of each
+    registered thread from
+    :sys._current_frames()
+    The profiled request runs at full speed, the cost is paid by the sampler thread.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._threads = {}
+        self._lock = threading.Lock()
+        # Set while any thread is profiled, the sampler sleeps on it otherwise
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] = StackCounter()
+            self._active.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        """
+        Returns collapsed stacks of the thread and how many samples each got
+        """
+        with self._lock:
+            stacks = self._threads.pop(thread_id, StackCounter())
+            if not self._threads:
+                self._active.clear()
+            return stacks
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                frames = sys._current_frames()
+                for thread_id, stacks in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[collapse_stack(frame)] += 1
+
+
+def collapse_stack(frame):
+    """
+    'module:function;module:function' from the outermost call, the format flamegraph tools read
+    """
+    names = []
+    while frame is not None:
+        # Compiled templates have no module name, their code carries the template file name
+        module = frame.f_globals.get('__name__') or os.path.basename(frame.f_code.co_filename)
+        names.append(f"{module}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+sampler = StackSampler()
+
+
+def write_profile(folder, max_files, endpoint, duration, stacks):
+    """
+    Save collapsed stacks of one slow request and remove the oldest profiles over max_files
+    """
+    os.makedirs(folder, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}-{endpoint}-{int(duration * 1000)}ms.folded"
+
+    with open(os.path.join(folder, name), "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    profiles_written.inc()
+
+    profiles = sorted(os.scandir(folder), key=lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:max(len(profiles) - max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profiled_thread = None
+
+    sample_rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if sample_rate > 0 and random.random() < sample_rate:
+        g.profiled_thread = threading.get_ident()
+        sampler.start(g.profiled_thread)
+
+def finish_request_timer(response):
+    """
+    Observe the latency when the server closes the response, streamed bodies are included
+    """
+    started = g.get('request_started')
+    if started is None:
+        return response
+
+    endpoint = request.endpoint or "unmatched"
+    method = request.method
+    status = str(response.status_code)
+    profiled_thread = g.get('profiled_thread')
+    config = current_app.config
+    logger = current_app.logger
+
+    def on_close():
+        duration = time.perf_counter() - started
+        request_duration.observe(duration, endpoint, method, status)
+
+        if profiled_thread is not None:
+            stacks = sampler.stop(profiled_thread)
+            if stacks and duration >= config['PROFILE_SLOW_REQUEST']:
+                try:
+                    write_profile(config['PROFILE_FOLDER'], config['PROFILE_MAX_FILES'], endpoint, duration, stacks)
+                except OSError as error:
+                    logger.warning("Writing profile failed: %s", error)
+
+    response.call_on_close(on_close)
+    return response
+
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+def finish_template_timer(sender, template, context, **extra):
+    started = g.get('template_started')
+    if started:
+        template_duration.observe(time.perf_counter() - started.pop(), template.name or "string")
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info['query_started'] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info.pop('query_started', None)
+        if started is not None:
+            query_duration.observe(time.perf_counter() - started, statement.split(None, 1)[0].upper())
+
+def init_metrics(app, engine):
+    """
+    Install request, template and SQL timing on the app when METRICS_ENABLED
+    """
+    global enabled
+
+    enabled = app.config['METRICS_ENABLED']
+    if not enabled:
+        return
+
+    sampler.interval = app.config['PROFILE_INTERVAL']
+
+    app.before_request(start_request_timer)
+    app.after_request(finish_request_timer)
+    before_render_template.connect(start_template_timer, app)
+    template_rendered.connect(finish_template_timer, app)
+    instrument_engine(engine)
@@ -2,40 +2,129 @@ import os
  
 from file_browser import db
 from flask_login import UserMixin
-from sqlalchemy.event import listens_for
-from file_browser.default import create_default_files_and_folders
 
 # User model used to store user name and hashed password
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True, nullable=False, unique=True)
     username = db.Column(db.String, nullable=False, unique=True)
     password = db.Column(db.Text, nullable=False)
+    # Bytes stored in the user folder, kept up to date by the file routes
+    storage_used = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    # Per user limit in bytes, None uses app.config['USER_STORAGE_QUOTA']
+    storage_quota = db.Column(db.BigInteger, nullable=True)
+    # User folder is created in background after registration: pending, ready or failed.
+    # deferred users were imported without folders, theirs is made on the first visit
+    provisioning_state = db.Column(db.String, nullable=False, default="pending", server_default="ready")
     
     def __str__(self):
         return self.username
 
-# An event listener after new user registration to create his folder space + some dummy data for testing  
-@listens_for(User, "after_insert")
-def create_home_dir_after_insert(map, con, user):
-    # Create path for new dir
-    root_directory =  f"{user.username}"
-    parent_dir = "file_browser/users_space"
-    path = os.path.join(parent_dir, root_directory)
+# Content hash of a file stored on disk. The row is valid only while size, mtime and inode still match the file
+class FileHash(db.Model):
+    path = db.Column(db.String, primary_key=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    inode = db.Column(db.BigInteger, nullable=False)
+    algorithm = db.Column(db.String, nullable=False)
+    digest = db.Column(db.String, nullable=False)
     
-    # Create user root folder in users_space
-    os.mkdir(path)
-    
-    # Create home dir
-    home = "home"
-    dir2 = f"file_browser/users_space/{root_directory}"
-    path2 = os.path.join(dir2, home)
-    os.mkdir(path2)
-    
-    # Create user folder in home
-    user_folder = user.username
-    dir3 = f"file_browser/users_space/{root_directory}/{home}"
-    path3 = os.path.join(dir3, user_folder)
-    os.mkdir(path3)
-    
-    # Create dummy data and folder structure
-    create_default_files_and_folders(path, path3)
\ No newline at end of file
+    def matches(self, file_stat, algorithm):
+        return (self.size == file_stat.st_size and
+                self.mtime_ns == file_stat.st_mtime_ns and
+                self.inode == file_stat.st_ino and
+                self.algorithm == algorithm)
+
+
+# State of chunked upload. Bytes are written to temp_path and moved to target_path on finalize
+class UploadSession(db.Model):
+    id = db.Column(db.String, primary_key=True, nullable=False)
+    username = db.Column(db.String, nullable=False, index=True)
+    target_path = db.Column(db.String, nullable=False)
+    temp_path = db.Column(db.String, nullable=False)
+    size = db.Column(db.BigInteger, nullable=True)
+    offset = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.Float, nullable=False)
+
+
+# Content stored once in the blob store, refcount is the number of user files linked to it
+class Blob(db.Model):
+    algorithm = db.Column(db.String, primary_key=True, nullable=False)
+    digest = db.Column(db.String, primary_key=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    # Inode of the blob file, hardlinked user files have the same one
+    inode = db.Column(db.BigInteger, nullable=False, index=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+
+# User file reflinked or copied from a blob. It has its own inode, which stays the same on rename and move.
+# Inode numbers are reused once a file is gone, the row is for the file with the same device and mtime.
+# Rows saved before these were kept have them None and match the inode alone
+class BlobReference(db.Model):
+    inode = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    device = db.Column(db.BigInteger, nullable=True)
+    mtime_ns = db.Column(db.BigInteger, nullable=True)
+    algorithm = db.Column(db.String, nullable=False)
+    digest = db.Column(db.String, nullable=False)
+
+    def is_for(self, file_stat):
+        if self.device is None or self.mtime_ns is None:
+            return True
+        return (self.device, self.mtime_ns) == (file_stat.st_dev, file_stat.st_mtime_ns)
+
+
+# Upload waiting for the malware scanner. The file is kept at quarantine_path in QUARANTINE_FOLDER
+# and renamed to target_path once the scan finds nothing. state: pending, scanning, clean, infected or missing
+class UploadScan(db.Model):
+    id = db.Column(db.String, primary_key=True, nullable=False)
+    username = db.Column(db.String, nullable=False, index=True)
+    target_path = db.Column(db.String, nullable=False)
+    quarantine_path = db.Column(db.String, nullable=False)
+    digest = db.Column(db.String, nullable=True)
+    state = db.Column(db.String, nullable=False, default="pending", index=True)
+    # Name of the signature the scanner found
+    signature = db.Column(db.String, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
+
+
+# Background delete or copy of a folder tree. The worker running it saves its progress here,
+# so any worker answers status and cancel requests
+class FileJob(db.Model):
+    id = db.Column(db.String, primary_key=True, nullable=False)
+    username = db.Column(db.String, nullable=False, index=True)
+    kind = db.Column(db.String, nullable=False)
+    source = db.Column(db.String, nullable=False)
+    destination = db.Column(db.String, nullable=True)
+    # queued, running, done, cancelled or failed
+    status = db.Column(db.String, nullable=False, default="queued")
+    error = db.Column(db.String, nullable=True)
+    total_items = db.Column(db.Integer, nullable=False, default=0)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    done_items = db.Column(db.Integer, nullable=False, default=0)
+    done_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    # Set by the cancel request, the running worker sees it on its next progress save
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    # Token of the process running the job, its lock file tells if the process is alive
+    worker = db.Column(db.String, nullable=True)
+    created_at = db.Column(db.Float, nullable=False)
+    finished_at = db.Column(db.Float, nullable=True)
+
+    def to_dict(self, user_folder):
+        def relative(path):
+            return "/" + os.path.relpath(path, user_folder) if path else None
+
+        return {'job_id': self.id,
+                'op': self.kind,
+                'path': relative(self.source),
+                'destination': relative(self.destination),
+                'status': self.status,
+                'error': self.error,
+                'total_items': self.total_items,
+                'total_bytes': self.total_bytes,
+                'done_items': self.done_items,
+                'done_bytes': self.done_bytes,
+                'progress': round(self.done_items / self.total_items, 4) if self.total_items else None,
+                'created_at': self.created_at,
+                'finished_at': self.finished_at,
+                }
@@ -0,0 +1,297 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from file_browser.helpers import sanitize_folder_name, safe_join_user_path
+from file_browser.dircache import invalidate_entry
+from file_browser.hashing import move_file_hashes, forget_file_hash
+from file_browser.blobstore import release_blob_references
+from file_browser.search import index_entry, unindex_entry, move_entry
+from file_browser.quota import QuotaReservation, QuotaExceeded, get_remaining_quota, add_storage_usage, get_tree_size
+
+# Operations the batch endpoint accepts
+BATCH_OPERATIONS = ("delete", "rename", "move", "copy", "mkdir")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class OperationError(Exception):
+    """
+    Raised by a single file operation, the message is returned to the client
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def get_executor():
+    """
+    Shared thread pool for I/O bound file operations, created on first use
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config['BATCH_MAX_WORKERS'],
+                                           thread_name_prefix="file-operations")
+        return _executor
+
+def resolve_user_path(user_folder, path, allow_root=False):
+    """
+    Turn client path like '/home/user/file.txt' into absolute path inside user_folder.
+    The user root itself is valid only as a folder to create in, move or copy to.
+    """
+    if not isinstance(path, str):
+        raise OperationError("Missing path!")
+
+    parts = [part for part in path.split("/") if part]
+    if not parts:
+        abs_path = user_folder if allow_root else None
+    else:
+        abs_path = safe_join_user_path(user_folder, *parts)
+
+    if abs_path is None:
+        raise OperationError("Not allowed!")
+
+    return abs_path
+
+def delete_path(abs_path):
+    """
+    Delete file or empty folder
+    """
+    if os.path.isfile(abs_path):
+        file_stat = os.stat(abs_path)
+        os.remove(abs_path)
+        return {'deleted': abs_path, 'bytes': -file_stat.st_size, 'file_stats': [file_stat]}
+
+    if os.path.isdir(abs_path):
+        if os.listdir(abs_path):
+            raise OperationError("Folder is not empty!")
+        os.rmdir(abs_path)
+        return {'deleted': abs_path}
+
+    raise OperationError("No such file!")
+
+def rename_path(abs_path, new_name):
+    """
+    Rename file or folder in place. Files keep their original extension.
+    """
+    if not os.path.exists(abs_path):
+        raise OperationError("No such file!")
+
+    new_name = sanitize_folder_name(new_name or "")
+    if not new_name:
+        raise OperationError("Name not supported!")
+
+    if os.path.isfile(abs_path):
+        new_name += Path(abs_path).suffix
+
+    new_path = os.path.join(os.path.dirname(abs_path), new_name)
+    if os.path.exists(new_path):
+        raise OperationError(f"File with name '{new_name}' already exists!")
+
+    os.rename(abs_path, new_path)
+    return {'moved': (abs_path, new_path)}
+
+def move_path(abs_path, destination_folder):
+    """
+    Move file or folder into destination folder
+    """
+    if not os.path.exists(abs_path):
+        raise OperationError("No such file!")
+
+    if not os.path.isdir(destination_folder):
+        raise OperationError("No such folder!")
+
+    if Path(destination_folder).is_relative_to(abs_path):
+        raise OperationError("Cannot move folder into itself!")
+
+    new_path = os.path.join(destination_folder, os.path.basename(abs_path))
+    if os.path.exists(new_path):
+        raise OperationError(f"'{os.path.basename(abs_path)}' already exists in destination!")
+
+    os.rename(abs_path, new_path)
+    return {'moved': (abs_path, new_path)}
+
+def copy_path(abs_path, destination_folder, reservation):
+    """
+    Copy file or folder into destination folder.
+    The copied size is reserved from the user quota first.
+    """
+    if not os.path.exists(abs_path):
+        raise OperationError("No such file!")
+
+    if not os.path.isdir(destination_folder):
+        raise OperationError("No such folder!")
+
+    if Path(destination_folder).is_relative_to(abs_path):
+        raise OperationError("Cannot copy folder into itself!")
+
+    new_path = os.path.join(destination_folder, os.path.basename(abs_path))
+    if os.path.exists(new_path):
+        raise OperationError(f"'{os.path.basename(abs_path)}' already exists in destination!")
+
+    size = get_tree_size(abs_path)
+    try:
+        reservation.reserve(size)
+    except QuotaExceeded:
+        raise OperationError("Storage quota exceeded!")
+
+    if os.path.isdir(abs_path):
+        shutil.copytree(abs_path, new_path)
+    else:
+        shutil.copy2(abs_path, new_path)
+
+    return {'created': new_path, 'bytes': size}
+
+def make_folder(parent_folder, folder_name):
+    """
+    Create folder with sanitized name in parent folder
+    """
+    folder_name = sanitize_folder_name(folder_name or "")
+    if not folder_name:
+        raise OperationError("Name not supported!")
+
+    if not os.path.isdir(parent_folder):
+        raise OperationError("No such folder!")
+
+    new_path = os.path.join(parent_folder, folder_name)
+    if os.path.exists(new_path):
+        raise OperationError(f"Folder with name '{folder_name}' already exists")
+
+    os.mkdir(new_path)
+    return {'created': new_path}
+
+def prepare_operation(user_folder, operation, reservation):
+    """
+    Validate one batch item and return (function, args, touched paths)
+    """
+    if not isinstance(operation, dict):
+        raise OperationError("Invalid operation!")
+
+    op = operation.get('op')
+    if op not in BATCH_OPERATIONS:
+        raise OperationError(f"Unknown operation '{op}'!")
+
+    abs_path = resolve_user_path(user_folder, operation.get('path'), allow_root=op == "mkdir")
+
+    if op == "delete":
+        return delete_path, (abs_path,), (abs_path,)
+
+    if op == "rename":
+        new_name = operation.get('new_name')
+        new_path = os.path.join(os.path.dirname(abs_path), sanitize_folder_name(new_name or ""))
+        return rename_path, (abs_path, new_name), (abs_path, new_path, new_path + Path(abs_path).suffix)
+
+    if op == "mkdir":
+        name = operation.get('name')
+        return make_folder, (abs_path, name), (os.path.join(abs_path, sanitize_folder_name(name or "")),)
+
+    destination = resolve_user_path(user_folder, operation.get('destination'), allow_root=True)
+    if op == "move":
+        return move_path, (abs_path, destination), (abs_path, destination)
+
+    return copy_path, (abs_path, destination, reservation), (abs_path, destination)
+
+def paths_overlap(first, second):
+    """
+    True if one path is the same as or inside the other
+    """
+    return first == second or first.startswith(second + os.sep) or second.startswith(first + os.sep)
+
+def split_into_waves(prepared):
+    """
+    Group operations so items in one wave touch independent paths and can run in parallel.
+    An item that touches a path used by an earlier item of the wave starts a new wave,
+    so dependent items (mkdir then move into it) keep their order.
+    """
+    waves = []
+    wave = []
+    wave_paths = []
+
+    for index, function, args, paths in prepared:
+        if any(paths_overlap(path, used) for path in paths for used in wave_paths):
+            waves.append(wave)
+            wave = []
+            wave_paths = []
+
+        wave.append((index, function, args))
+        wave_paths.extend(paths)
+
+    if wave:
+        waves.append(wave)
+
+    return waves
+
+def apply_effects(effects, username):
+    """
+    Update caches, stored hashes, search index and storage usage after successful operation.
+    Runs in the request thread because it uses the database session.
+    """
+    if 'deleted' in effects:
+        invalidate_entry(effects['deleted'])
+        forget_file_hash(effects['deleted'])
+        unindex_entry(effects['deleted'])
+        release_blob_references(effects.get('file_stats'))
+
+    if 'moved' in effects:
+        old_path, new_path = effects['moved']
+        invalidate_entry(old_path)
+        invalidate_entry(new_path)
+        move_file_hashes(old_path, new_path)
+        move_entry(old_path, new_path)
+
+    if 'created' in effects:
+        invalidate_entry(effects['created'])
+        index_entry(effects['created'], recursive=True)
+
+    add_storage_usage(username, effects.get('bytes', 0))
+
+def run_batch(user_folder, operations, username):
+    """
+    Run list of operations and return one result per operation in the same order.
+    Each result has 'success' and either 'path' of the new or changed item relative to
+    the user folder or 'error'.
+    """
+    results = [None] * len(operations)
+    prepared = []
+    # Copies running in parallel take from one snapshot of the free space
+    reservation = QuotaReservation(get_remaining_quota(username))
+
+    for index, operation in enumerate(operations):
+        try:
+            function, args, paths = prepare_operation(user_folder, operation, reservation)
+            prepared.append((index, function, args, paths))
+        except OperationError as error:
+            results[index] = {'success': False, 'error': error.message}
+
+    executor = get_executor()
+
+    for wave in split_into_waves(prepared):
+        futures = [(index, executor.submit(function, *args)) for index, function, args in wave]
+
+        for index, future in futures:
+            try:
+                effects = future.result()
+            except OperationError as error:
+                results[index] = {'success': False, 'error': error.message}
+                continue
+            except OSError:
+                results[index] = {'success': False, 'error': "Operation failed!"}
+                continue
+
+            apply_effects(effects, username)
+
+            changed_path = effects.get('created') or effects.get('deleted') or effects['moved'][1]
+            results[index] = {'success': True, 'path': "/" + os.path.relpath(changed_path, user_folder)}
+
+    for index, operation in enumerate(operations):
+        results[index]['op'] = operation.get('op') if isinstance(operation, dict) else None
+
+    return results
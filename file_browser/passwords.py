@@ -0,0 +1,261 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from file_browser.metrics import span
+
+# Where login limit buckets are kept, see configure_login_limits()
+LOGIN_LIMIT_STORES = ("sqlite", "memory")
+
+# Buckets kept per limiter in memory, least recently used keys are dropped first
+MAX_BUCKETS = 100_000
+
+# Shared buckets refilled to capacity are deleted every this many attempts of a process
+PRUNE_EVERY = 1000
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+
+_method_lock = threading.Lock()
+
+
+class PasswordHashingBusy(Exception):
+    """
+    Raised when all hashing slots are taken, the request is refused instead of queued
+    """
+
+
+class SharedBuckets:
+    """
+    Token buckets in a SQLite file shared by all worker processes of the host, so a limit
+    holds for the whole server and is not multiplied by the number of workers.
+    Each attempt is one short write transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                               "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connect(self):
+        """
+        One connection per thread, sqlite3 connections must not be shared between threads
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Losing recent attempts on power loss only resets their buckets
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, rate):
+        """
+        Take one token for key, False if the bucket is empty.
+        Wall clock time, monotonic clocks are not comparable between processes.
+        """
+        connection = self._connect()
+        now = time.time()
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(now - row[1], 0) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                               (key, tokens, now))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        self._calls += 1
+        if self._calls % PRUNE_EVERY == 0:
+            self.prune(capacity, rate)
+
+        return allowed
+
+    def reset(self, key):
+        self._connect().execute("DELETE FROM buckets WHERE key = ?", (key,))
+
+    def prune(self, capacity, rate):
+        """
+        Drop buckets refilled to capacity, they are the same as no bucket
+        """
+        if rate > 0:
+            self._connect().execute("DELETE FROM buckets WHERE updated < ?", (time.time() - capacity / rate,))
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket per key: up to 'capacity' attempts at once, refilled at 'rate' tokens per second.
+    Buckets are kept in
+    :SharedBuckets
+    when configured with one, otherwise in memory of the process and each worker limits on its own.
+    """
+
+    def __init__(self, name, capacity=0, rate=0):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self.shared = None
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, capacity, rate, shared=None):
+        with self._lock:
+            self.capacity = capacity
+            self.rate = rate
+            self.shared = shared
+            self._buckets.clear()
+
+    def allow(self, key):
+        """
+        Take one token for key, False if the bucket is empty
+        """
+        if self.capacity <= 0:
+            return True
+
+        if self.shared is not None:
+            return self.shared.take(f"{self.name}:{key}", self.capacity, self.rate)
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def reset(self, key):
+        if self.shared is not None:
+            self.shared.reset(f"{self.name}:{key}")
+            return
+
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+# Unlimited until create_app() calls configure_login_limits()
+username_limiter = TokenBucketLimiter("username")
+ip_limiter = TokenBucketLimiter("ip")
+
+
+def configure_login_limits(config):
+    """
+    Buckets of LOGIN_LIMIT_STORE: sqlite shares them between the workers in LOGIN_LIMIT_DATABASE,
+    memory keeps them per worker
+    """
+    store = config['LOGIN_LIMIT_STORE']
+    if store not in LOGIN_LIMIT_STORES:
+        raise ValueError(f"Unknown login limit store '{store}'")
+
+    shared = SharedBuckets(config['LOGIN_LIMIT_DATABASE']) if store == "sqlite" else None
+    username_limiter.configure(config['LOGIN_USERNAME_BURST'], config['LOGIN_USERNAME_PER_MINUTE'] / 60, shared)
+    ip_limiter.configure(config['LOGIN_IP_BURST'], config['LOGIN_IP_PER_MINUTE'] / 60, shared)
+
+def allow_login_attempt(username, ip):
+    """
+    Check both limiters before the user is looked up or any password is hashed.
+    The IP bucket is taken first so attempts on many usernames from one address are caught too.
+    """
+    return ip_limiter.allow(ip) and username_limiter.allow(username.lower())
+
+def get_executor():
+    """
+    Threads for hashing, hashlib scrypt and pbkdf2 release the GIL while they run.
+    Pending hashes are limited by
+    :app.config['PASSWORD_HASH_QUEUE']
+    so a burst of logins cannot pile up work that would starve other requests.
+    """
+    global _executor, _slots
+
+    with _executor_lock:
+        if _executor is None:
+            workers = current_app.config['PASSWORD_HASH_WORKERS']
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hashing")
+            _slots = threading.BoundedSemaphore(workers + current_app.config['PASSWORD_HASH_QUEUE'])
+        return _executor
+
+def run_hashing(function, *args):
+    """
+    Run function in the hashing pool, the span includes time waiting for a thread
+    """
+    executor = get_executor()
+
+    if not _slots.acquire(blocking=False):
+        raise PasswordHashingBusy()
+
+    try:
+        future = executor.submit(function, *args)
+    except BaseException:
+        _slots.release()
+        raise
+
+    future.add_done_callback(lambda _: _slots.release())
+    with span(f"password.{function.__name__}"):
+        return future.result()
+
+def configure_password_method(app):
+    """
+    Forget the method resolved by get_password_method() for this app, it is resolved again on first use
+    so worker startup does not pay for a hash
+    """
+    app.extensions['password_method'] = None
+
+def get_password_method():
+    """
+    Configured method with werkzeug defaults filled in, e.g. 'scrypt' -> 'scrypt:32768:8:1'.
+    This is the prefix stored hashes are compared with. Kept per app in app.extensions.
+    """
+    with _method_lock:
+        method = current_app.extensions.get('password_method')
+        if method is None:
+            method = generate_password_hash("", method=current_app.config['PASSWORD_HASH_METHOD'], salt_length=1).split("$")[0]
+            current_app.extensions['password_method'] = method
+        return method
+
+def make_password_hash(password, method, salt_length):
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+def hash_password(password):
+    """
+    Hash new password with the configured parameters in the hashing pool
+    """
+    return run_hashing(make_password_hash, password,
+                       current_app.config['PASSWORD_HASH_METHOD'],
+                       current_app.config['PASSWORD_SALT_LENGTH'])
+
+def verify_password(password_hash, password):
+    """
+    Check password in the hashing pool
+    """
+    return run_hashing(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+    """
+    True if the hash was made with other method, cost or salt length than configured now
+    """
+    method, _, rest = password_hash.partition("$")
+    salt = rest.partition("$")[0]
+    return method != get_password_method() or len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
@@ -0,0 +1,227 @@
+import os
+import uuid
+import fcntl
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from file_browser import db
+from file_browser.models import User
+from file_browser.default import create_default_files_and_folders
+from file_browser.helpers import get_users_root, get_user_root, lock_user_folder
+from file_browser.user_cache import invalidate_user
+
+# States of User.provisioning_state
+PROVISIONING_PENDING = "pending"
+PROVISIONING_READY = "ready"
+PROVISIONING_FAILED = "failed"
+# Imported with --no-provision, the folder is made when the user first opens it, not on server start
+PROVISIONING_DEFERRED = "deferred"
+
+# Name of the user folder inside template home, renamed to the username on clone
+TEMPLATE_USER_FOLDER = "__user__"
+
+# Staging folders are renamed into place when complete, hidden from the users_space crawlers by the prefix
+STAGING_PREFIX = ".provision-"
+
+# ioctl cloning whole file on copy on write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_template_lock = threading.Lock()
+_template_size = None
+
+# Set when the filesystem refused reflink once, plain copy is used after that
+_reflink_unsupported = False
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config['PROVISION_WORKERS'],
+                                           thread_name_prefix="provisioning")
+        return _executor
+
+def get_template():
+    """
+    Returns (template folder, size in bytes), the template tree is built on first use with
+    :create_default_files_and_folders()
+    Built in a temp folder and renamed so other processes never see half of it.
+    """
+    global _template_size
+
+    template = current_app.config['PROVISION_TEMPLATE_FOLDER']
+
+    with _template_lock:
+        if not os.path.isdir(template):
+            staging = f"{template}{STAGING_PREFIX}{uuid.uuid4().hex}"
+            home_user_folder = os.path.join(staging, "home", TEMPLATE_USER_FOLDER)
+            os.makedirs(home_user_folder)
+            create_default_files_and_folders(staging, home_user_folder)
+
+            try:
+                os.rename(staging, template)
+            except OSError:
+                # Built by another process meanwhile
+                shutil.rmtree(staging, ignore_errors=True)
+
+        if _template_size is None:
+            _template_size = sum(os.path.getsize(os.path.join(folder, name))
+                                 for folder, _, files in os.walk(template) for name in files)
+
+    return template, _template_size
+
+def clone_file(source, destination, mode=None):
+    """
+    Copy file using the cheapest way the filesystem and mode, by default
+    :app.config['PROVISION_LINK_MODE']
+    allow: hardlink, reflink or plain copy
+    """
+    global _reflink_unsupported
+
+    mode = mode or current_app.config['PROVISION_LINK_MODE']
+
+    if mode == "hardlink":
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+
+    if mode == "reflink" and not _reflink_unsupported:
+        with open(source, 'rb') as source_file, open(destination, 'xb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                shutil.copystat(source, destination)
+                return
+            except OSError:
+                _reflink_unsupported = True
+        os.remove(destination)
+
+    shutil.copy2(source, destination)
+
+def clone_tree(source, destination):
+    """
+    Recreate source tree in destination with
+    :os.scandir()
+    and
+    :clone_file()
+    """
+    os.mkdir(destination)
+    stack = [(source, destination)]
+
+    while stack:
+        source_dir, destination_dir = stack.pop()
+        with os.scandir(source_dir) as it:
+            for entry in it:
+                entry_destination = os.path.join(destination_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    os.mkdir(entry_destination)
+                    stack.append((entry.path, entry_destination))
+                elif entry.is_file(follow_symlinks=False):
+                    clone_file(entry.path, entry_destination)
+
+def set_provisioning_state(username, state, storage_used=None):
+    values = {'provisioning_state': state}
+    if storage_used is not None:
+        values['storage_used'] = storage_used
+
+    db.session.execute(db.update(User).where(User.username == username).values(**values))
+    db.session.commit()
+    invalidate_user(username)
+
+def provision_user(username):
+    """
+    Create the user folder from the template. Safe to call any number of times:
+    the tree is built in a staging folder and renamed into place, a user whose
+    folder already exists is only marked ready.
+    Returns the final state.
+    """
+    user_root = get_user_root(username)
+
+    # One provisioning of a user at a time in all processes, not while the folder is moved
+    with lock_user_folder(username):
+        try:
+            if not os.path.isdir(user_root):
+                template, template_size = get_template()
+                os.makedirs(get_users_root(), exist_ok=True)
+                staging = os.path.join(get_users_root(), f"{STAGING_PREFIX}{username}-{uuid.uuid4().hex}")
+
+                try:
+                    clone_tree(template, staging)
+                    os.rename(os.path.join(staging, "home", TEMPLATE_USER_FOLDER),
+                              os.path.join(staging, "home", username))
+                    # Shard folders of the sharded layout, staging stays on the same filesystem
+                    os.makedirs(os.path.dirname(user_root), exist_ok=True)
+                    os.rename(staging, user_root)
+                except OSError:
+                    shutil.rmtree(staging, ignore_errors=True)
+                    # Other process finished first
+                    if not os.path.isdir(user_root):
+                        raise
+
+                set_provisioning_state(username, PROVISIONING_READY, storage_used=template_size)
+            else:
+                set_provisioning_state(username, PROVISIONING_READY)
+
+            return PROVISIONING_READY
+
+        except OSError as error:
+            current_app.logger.warning("Provisioning of '%s' failed: %s", username, error)
+            set_provisioning_state(username, PROVISIONING_FAILED)
+            return PROVISIONING_FAILED
+
+def run_provisioning(app, username):
+    with app.app_context():
+        return provision_user(username)
+
+def queue_provisioning(username):
+    """
+    Provision the user in background, registration does not wait for the filesystem
+    """
+    return get_executor().submit(run_provisioning, current_app._get_current_object(), username)
+
+def ensure_provisioned(user):
+    """
+    Make sure the user folder exists before it is used.
+    The user is provisioned in the calling thread if the queue did not get to it yet.
+    """
+    if user.provisioning_state == PROVISIONING_READY:
+        return True
+
+    state = provision_user(user.username)
+    db.session.refresh(user)
+    return state == PROVISIONING_READY
+
+def resume_pending_provisioning():
+    """
+    Queue users left pending or failed by a previous run, deferred users wait for their first visit.
+    Only the process holding the lock file does it, provisioning is idempotent anyway.
+    """
+    lock_file = open(os.path.join(current_app.config['PROVISION_TEMPLATE_FOLDER'] + ".lock"), "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+
+    try:
+        usernames = db.session.execute(db.select(User.username)
+                                       .where(User.provisioning_state.in_((PROVISIONING_PENDING, PROVISIONING_FAILED)))).scalars().all()
+    except Exception as error:
+        # Table not created yet
+        current_app.logger.warning("Pending provisioning not resumed: %s", error)
+        db.session.rollback()
+        usernames = []
+
+    for username in usernames:
+        queue_provisioning(username)
+
+    return lock_file
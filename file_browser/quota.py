@@ -0,0 +1,217 @@
+import os
+import fcntl
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from file_browser import db, basedir
+from file_browser.models import User, UploadScan
+from file_browser.helpers import get_user_root, lock_user_folder
+from file_browser.user_cache import invalidate_user
+
+# Threads used to walk the top level folders of a user in parallel
+MEASURE_WORKERS = 8
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class QuotaReservation:
+    """
+    Free space snapshot shared by parallel operations of one request.
+    Each operation reserves its size before writing so together they cannot go over the quota.
+    """
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        if self.remaining is None:
+            return
+        with self._lock:
+            if size > self.remaining:
+                raise QuotaExceeded()
+            self.remaining -= size
+
+
+def get_user_quota(user):
+    """
+    Quota in bytes for user, None is unlimited
+    """
+    quota = user.storage_quota if user.storage_quota is not None else current_app.config['USER_STORAGE_QUOTA']
+    return quota or None
+
+def get_remaining_quota(username):
+    """
+    Bytes the user can still store, None is unlimited
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return 0
+
+    quota = get_user_quota(user)
+    if quota is None:
+        return None
+
+    return max(quota - user.storage_used, 0)
+
+def has_quota_for(username, size):
+    remaining = get_remaining_quota(username)
+    return remaining is None or size <= remaining
+
+def add_storage_usage(username, delta):
+    """
+    Add delta bytes (negative to free) to the user counter.
+    One UPDATE statement so concurrent requests do not overwrite each other.
+    """
+    if not delta:
+        return
+
+    db.session.execute(db.update(User)
+                       .where(User.username == username)
+                       .values(storage_used=db.func.max(User.storage_used + delta, 0)))
+    db.session.commit()
+    invalidate_user(username)
+
+def get_tree_size(path):
+    """
+    Size of regular files under path walked with
+    :os.scandir()
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size if os.path.isfile(path) else 0
+
+    size = 0
+    stack = [path]
+
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            size += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+    return size
+
+def measure_user_storage(username):
+    """
+    Walk the user folder and return used bytes.
+    Top level folders are walked in parallel threads, scandir and stat release the GIL.
+    """
+    user_root = get_user_root(username)
+    size = 0
+    folders = []
+
+    with os.scandir(user_root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+
+    with ThreadPoolExecutor(max_workers=MEASURE_WORKERS) as executor:
+        size += sum(executor.map(get_tree_size, folders))
+
+    return size
+
+def measure_quarantined_storage(username):
+    """
+    Bytes of uploads of the user waiting in quarantine, they are counted when the upload is received
+    """
+    from file_browser.scanning import SCAN_PENDING, SCAN_RUNNING, SCAN_FAILED
+
+    paths = db.session.execute(db.select(UploadScan.quarantine_path)
+                               .where(UploadScan.username == username,
+                                      UploadScan.state.in_((SCAN_PENDING, SCAN_RUNNING, SCAN_FAILED)))).scalars()
+    size = 0
+    for path in paths:
+        try:
+            size += os.lstat(path).st_size
+        except FileNotFoundError:
+            continue
+    return size
+
+def reconcile_user_storage(username, blocking=True):
+    """
+    Replace the usage counter with the size measured on disk and in quarantine.
+    The user folder is locked while measuring, so no request changes the usage meanwhile.
+    Without blocking None is returned when the folder is in use.
+    """
+    try:
+        with lock_user_folder(username, blocking=blocking):
+            size = measure_user_storage(username) + measure_quarantined_storage(username)
+            db.session.execute(db.update(User).where(User.username == username).values(storage_used=size))
+            db.session.commit()
+    except BlockingIOError:
+        return None
+
+    invalidate_user(username)
+    return size
+
+def reconcile_all_users():
+    """
+    Users whose folder is in use are skipped, the next run counts them
+    """
+    reconciled = 0
+    for (username,) in db.session.execute(db.select(User.username)).all():
+        if os.path.isdir(get_user_root(username)) and reconcile_user_storage(username, blocking=False) is not None:
+            reconciled += 1
+    return reconciled
+
+def start_quota_reconciler():
+    """
+    Recount usage of all users every QUOTA_RECONCILE_INTERVAL seconds in background.
+    Only the process holding the lock file runs it.
+    """
+    interval = current_app.config['QUOTA_RECONCILE_INTERVAL']
+    if interval <= 0:
+        return None
+
+    lock_file = open(os.path.join(basedir, ".quota_reconcile.lock"), "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+
+    app = current_app._get_current_object()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    reconcile_all_users()
+            except Exception:
+                app.logger.exception("Quota reconcile failed")
+
+    thread = threading.Thread(target=run, name="quota-reconciler", daemon=True)
+    thread.lock_file = lock_file
+    thread.start()
+    return thread
+
+@click.command("quota-reconcile")
+@click.option("--user", "username", default=None, help="Recount only this user.")
+@with_appcontext
+def quota_reconcile_command(username):
+    """Recount storage usage of users from disk."""
+    started = time.perf_counter()
+    if username:
+        click.echo(f"{username}: {reconcile_user_storage(username)} bytes")
+    else:
+        click.echo(f"Reconciled {reconcile_all_users()} users")
+    click.echo(f"Done in {time.perf_counter() - started:.2f}s")
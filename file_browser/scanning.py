@@ -0,0 +1,471 @@
+import os
+import time
+import uuid
+import fcntl
+import socket
+import struct
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.utils import import_string
+
+from file_browser import db, basedir
+from file_browser.models import UploadScan
+from file_browser.hashing import move_file_hashes, forget_file_hash
+from file_browser.blobstore import release_blob_references
+from file_browser.dircache import invalidate_entry
+from file_browser.search import index_entry
+from file_browser.quota import add_storage_usage
+from file_browser.thumbnails import queue_thumbnail
+from file_browser.helpers import lock_user_folder
+
+# States of UploadScan.state
+SCAN_PENDING = "pending"
+SCAN_RUNNING = "scanning"
+SCAN_CLEAN = "clean"
+SCAN_INFECTED = "infected"
+# Scanner failed UPLOAD_SCAN_MAX_ATTEMPTS times, the file stays in quarantine
+SCAN_FAILED = "failed"
+# Quarantined file was deleted, or its folder renamed, before the scan finished
+SCAN_MISSING = "missing"
+
+SCAN_FINISHED = (SCAN_CLEAN, SCAN_INFECTED, SCAN_FAILED, SCAN_MISSING)
+
+# Bytes sent to clamd in one INSTREAM chunk
+CLAMD_CHUNK_SIZE = 64 * 1024
+
+# Test string every virus scanner reports, the only thing the fake clamd detects
+EICAR_TEST_STRING = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!H+H*"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Scans queued or running in this process, bounded by UPLOAD_SCAN_WORKERS + UPLOAD_SCAN_QUEUE
+_queue_slots = None
+
+
+class ScanError(Exception):
+    pass
+
+
+class ClamdScanner:
+    """
+    Scanner talking to clamd over its socket. The file is streamed with INSTREAM so clamd
+    does not need access to users_space and may run on another host.
+    Scanners set by an import path in UPLOAD_SCANNER need the same from_config() and scan().
+    """
+
+    def __init__(self, address, timeout=60):
+        self.address = address
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['CLAMD_ADDRESS'], config['UPLOAD_SCAN_TIMEOUT'])
+
+    def connect(self):
+        """
+        CLAMD_ADDRESS is a unix socket path or host:port
+        """
+        if not self.address.startswith("/") and ":" in self.address:
+            host, port = self.address.rsplit(":", 1)
+            return socket.create_connection((host, int(port)), timeout=self.timeout)
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.address)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def scan(self, file_path):
+        """
+        Returns None for a clean file or the name of the signature clamd found.
+        Raises ScanError when clamd cannot be reached or does not give an answer.
+        """
+        with open(file_path, "rb") as f:
+            try:
+                with self.connect() as connection:
+                    connection.sendall(b"zINSTREAM\0")
+                    while chunk := f.read(CLAMD_CHUNK_SIZE):
+                        connection.sendall(struct.pack("!L", len(chunk)) + chunk)
+                    connection.sendall(struct.pack("!L", 0))
+                    reply = read_reply(connection)
+            except OSError as error:
+                raise ScanError(f"clamd at {self.address}: {error}")
+
+        # 'stream: OK', 'stream: <signature> FOUND' or '<message> ERROR'
+        if reply == "stream: OK":
+            return None
+        if reply.startswith("stream: ") and reply.endswith(" FOUND"):
+            return reply[len("stream: "):-len(" FOUND")]
+        raise ScanError(f"clamd at {self.address}: {reply}")
+
+
+# UPLOAD_SCANNER names, other values are import paths like 'package.module:Scanner'
+SCANNERS = {'clamd': ClamdScanner}
+
+
+def read_reply(connection):
+    reply = b""
+    while not reply.endswith(b"\0"):
+        data = connection.recv(4096)
+        if not data:
+            break
+        reply += data
+    return reply.rstrip(b"\0\n").decode("utf-8", "replace")
+
+def get_scanner():
+    name = current_app.config['UPLOAD_SCANNER']
+    scanner_class = SCANNERS.get(name) or import_string(name)
+    return scanner_class.from_config(current_app.config)
+
+def is_upload_scan_enabled():
+    return current_app.config['UPLOAD_SCAN_ENABLED']
+
+def get_quarantine_path(scan_id):
+    """
+    Quarantined uploads are kept in QUARANTINE_FOLDER outside users_space, no request of the user reaches them.
+    The folder is on the filesystem of users_space, releasing an upload is a rename.
+    """
+    folder = current_app.config['QUARANTINE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{scan_id}.quarantine")
+
+def new_upload_scan():
+    """
+    Returns (scan id, quarantine path) for a new upload
+    """
+    scan_id = uuid.uuid4().hex
+    return scan_id, get_quarantine_path(scan_id)
+
+def get_executor():
+    global _executor, _queue_slots
+
+    with _executor_lock:
+        if _executor is None:
+            workers = current_app.config['UPLOAD_SCAN_WORKERS']
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-scan")
+            _queue_slots = threading.BoundedSemaphore(workers + current_app.config['UPLOAD_SCAN_QUEUE'])
+        return _executor
+
+def submit_scan(scan_id):
+    """
+    Scan in background. Returns False when the pool of this process is full, the scan then
+    stays pending until the sweeper queues it. The upload request never waits for the scanner.
+    """
+    executor = get_executor()
+    if not _queue_slots.acquire(blocking=False):
+        return False
+
+    future = executor.submit(run_scan, current_app._get_current_object(), scan_id)
+    future.add_done_callback(lambda future: _queue_slots.release())
+    return True
+
+def queue_upload_scan(scan_id, username, target_path, quarantine_path, digest):
+    """
+    Record the quarantined upload and hand it to the scanner pool
+    """
+    now = time.time()
+    db.session.add(UploadScan(id=scan_id,
+                              username=username,
+                              target_path=target_path,
+                              quarantine_path=quarantine_path,
+                              digest=digest,
+                              state=SCAN_PENDING,
+                              attempts=0,
+                              created_at=now,
+                              updated_at=now))
+    db.session.commit()
+    submit_scan(scan_id)
+
+def get_user_scan(scan_id, username):
+    """
+    Returns the scan if it belongs to username, otherwise None
+    """
+    scan = db.session.get(UploadScan, scan_id)
+    if scan is None or scan.username != username:
+        return None
+    return scan
+
+def get_stale_before():
+    # A scan running longer than this was left by a stopped worker
+    return time.time() - 2 * current_app.config['UPLOAD_SCAN_TIMEOUT']
+
+def claim_scan(scan_id):
+    """
+    Mark the scan running. One statement, so of the workers and the sweeper only one scans it.
+    """
+    claimed = db.session.execute(db.update(UploadScan)
+                                 .where(UploadScan.id == scan_id,
+                                        db.or_(UploadScan.state == SCAN_PENDING,
+                                               db.and_(UploadScan.state == SCAN_RUNNING,
+                                                       UploadScan.updated_at < get_stale_before())))
+                                 .values(state=SCAN_RUNNING, attempts=UploadScan.attempts + 1,
+                                         updated_at=time.time())).rowcount
+    db.session.commit()
+    return claimed == 1
+
+def finish_scan(scan_id, state, signature=None):
+    # Only the running scan is finished, a second scan of a stale claim does not overwrite the result
+    db.session.execute(db.update(UploadScan)
+                       .where(UploadScan.id == scan_id, UploadScan.state == SCAN_RUNNING)
+                       .values(state=state, signature=signature, updated_at=time.time()))
+    db.session.commit()
+    return state
+
+def drop_quarantined_file(scan, file_stat):
+    """
+    Remove the quarantined file and everything counted for it
+    """
+    os.remove(scan.quarantine_path)
+    forget_file_hash(scan.quarantine_path)
+    release_blob_references([file_stat])
+    add_storage_usage(scan.username, -file_stat.st_size)
+
+def release_upload(scan):
+    """
+    Rename the scanned file to its target, replacing a file that is there.
+    Usage was counted for the whole quarantined file, the replaced file is subtracted now.
+    Returns the final state of the scan.
+    """
+    quarantine_stat = os.lstat(scan.quarantine_path)
+    try:
+        replaced_stat = os.lstat(scan.target_path)
+    except FileNotFoundError:
+        replaced_stat = None
+
+    if replaced_stat is not None and os.path.samestat(replaced_stat, quarantine_stat):
+        # Same stored blob uploaded again, rename() between two links of one inode would do nothing
+        drop_quarantined_file(scan, quarantine_stat)
+        return SCAN_CLEAN
+
+    try:
+        os.replace(scan.quarantine_path, scan.target_path)
+    except FileNotFoundError:
+        if not os.path.exists(scan.quarantine_path):
+            raise
+        # The target folder was renamed or deleted during the scan, nothing is left to put the upload in
+        drop_quarantined_file(scan, quarantine_stat)
+        return SCAN_MISSING
+    move_file_hashes(scan.quarantine_path, scan.target_path)
+
+    if replaced_stat is not None:
+        release_blob_references([replaced_stat])
+        add_storage_usage(scan.username, -replaced_stat.st_size)
+
+    invalidate_entry(scan.target_path)
+    index_entry(scan.target_path)
+    if scan.digest:
+        queue_thumbnail(scan.target_path, scan.digest)
+    return SCAN_CLEAN
+
+def scan_upload(scan_id):
+    """
+    Scan one quarantined upload, release it when it is clean and remove it when it is not.
+    A scanner error leaves it pending for the next sweep, after UPLOAD_SCAN_MAX_ATTEMPTS it is failed.
+    Returns the new state or None if the scan is finished or running elsewhere.
+    """
+    if not claim_scan(scan_id):
+        return None
+
+    scan = db.session.get(UploadScan, scan_id)
+
+    try:
+        signature = get_scanner().scan(scan.quarantine_path)
+    except FileNotFoundError:
+        return finish_scan(scan_id, SCAN_MISSING)
+    except ScanError as error:
+        current_app.logger.warning("Scan of '%s' failed: %s", scan.target_path, error)
+        gave_up = scan.attempts >= current_app.config['UPLOAD_SCAN_MAX_ATTEMPTS']
+        return finish_scan(scan_id, SCAN_FAILED if gave_up else SCAN_PENDING)
+
+    # The folder is not moved by users-space-migrate while the file is renamed into it
+    with lock_user_folder(scan.username, shared=True):
+        # Paths are rewritten when the folder was moved during the scan
+        db.session.refresh(scan)
+
+        try:
+            if signature is not None:
+                drop_quarantined_file(scan, os.lstat(scan.quarantine_path))
+                current_app.logger.warning("Upload '%s' of '%s' has %s, removed", scan.target_path, scan.username, signature)
+                return finish_scan(scan_id, SCAN_INFECTED, signature)
+
+            return finish_scan(scan_id, release_upload(scan))
+
+        except FileNotFoundError:
+            # Deleted meanwhile, or the other scan of a stale claim was faster
+            return finish_scan(scan_id, SCAN_MISSING)
+        except OSError as error:
+            # Target became a folder
+            current_app.logger.warning("Release of '%s' failed: %s", scan.target_path, error)
+            return finish_scan(scan_id, SCAN_FAILED)
+
+def run_scan(app, scan_id):
+    with app.app_context():
+        try:
+            return scan_upload(scan_id)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Scan of upload %s failed", scan_id)
+
+def sweep_upload_scans():
+    """
+    Queue pending scans and scans left running by a stopped worker and remove finished
+    records older than UPLOAD_SESSION_MAX_AGE. Returns the number of queued scans.
+    """
+    scan_ids = db.session.execute(db.select(UploadScan.id)
+                                  .where(db.or_(UploadScan.state == SCAN_PENDING,
+                                                db.and_(UploadScan.state == SCAN_RUNNING,
+                                                        UploadScan.updated_at < get_stale_before())))
+                                  .order_by(UploadScan.created_at)).scalars().all()
+    queued = 0
+    for scan_id in scan_ids:
+        if not submit_scan(scan_id):
+            break
+        queued += 1
+
+    expired_before = time.time() - current_app.config['UPLOAD_SESSION_MAX_AGE']
+    db.session.execute(db.delete(UploadScan).where(UploadScan.state.in_(SCAN_FINISHED),
+                                                   UploadScan.updated_at < expired_before))
+    db.session.commit()
+    return queued
+
+def start_scan_sweeper():
+    """
+    Run the sweep every UPLOAD_SCAN_RETRY_INTERVAL seconds in background.
+    Only the process holding the lock file runs it.
+    """
+    interval = current_app.config['UPLOAD_SCAN_RETRY_INTERVAL']
+    if not is_upload_scan_enabled() or interval <= 0:
+        return None
+
+    lock_file = open(os.path.join(basedir, ".upload_scan_sweep.lock"), "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+
+    app = current_app._get_current_object()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    sweep_upload_scans()
+            except Exception:
+                app.logger.exception("Upload scan sweep failed")
+
+    thread = threading.Thread(target=run, name="upload-scan-sweeper", daemon=True)
+    thread.lock_file = lock_file
+    thread.start()
+    return thread
+
+
+class FakeClamdHandler(socketserver.StreamRequestHandler):
+    """
+    Answers PING and INSTREAM like clamd. A stream holding the EICAR test string is
+    reported infected, anything else is clean. Each scan takes server.delay seconds.
+    """
+
+    def handle(self):
+        # zCOMMAND\0 or nCOMMAND\n, the reply ends the same way
+        prefix = self.rfile.read(1)
+        terminator = b"\0" if prefix == b"z" else b"\n"
+        command = b""
+        while (byte := self.rfile.read(1)) and byte != terminator:
+            command += byte
+
+        if command == b"PING":
+            reply = "PONG"
+        elif command == b"INSTREAM":
+            reply = "stream: Eicar-Test-Signature FOUND" if self.read_stream() else "stream: OK"
+            time.sleep(self.server.delay)
+        else:
+            reply = "UNKNOWN COMMAND"
+
+        self.wfile.write(reply.encode() + terminator)
+
+    def read_stream(self):
+        found = False
+        # End of the previous chunk, the test string may be split over two chunks
+        tail = b""
+        while True:
+            size = struct.unpack("!L", self.rfile.read(4))[0]
+            if size == 0:
+                return found
+            data = tail + self.rfile.read(size)
+            found = found or EICAR_TEST_STRING in data
+            tail = data[-len(EICAR_TEST_STRING):]
+
+
+class FakeClamdUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class FakeClamdTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def create_fake_clamd(address, delay=0.0):
+    """
+    Stand-in clamd on a unix socket path or host:port for development and tests
+    """
+    if not address.startswith("/") and ":" in address:
+        host, port = address.rsplit(":", 1)
+        server = FakeClamdTCPServer((host, int(port)), FakeClamdHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = FakeClamdUnixServer(address, FakeClamdHandler)
+
+    server.delay = delay
+    return server
+
+@click.command("fake-clamd")
+@click.option("--address", default=None, help="Unix socket path or host:port, CLAMD_ADDRESS by default.")
+@click.option("--delay", default=0.0, help="Seconds each scan takes.")
+@with_appcontext
+def fake_clamd_command(address, delay):
+    """Run a stand-in clamd that only detects the EICAR test file."""
+    address = address or current_app.config['CLAMD_ADDRESS']
+    server = create_fake_clamd(address, delay)
+    click.echo(f"Fake clamd listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server, FakeClamdUnixServer):
+            os.remove(address)
+
+@click.command("upload-scan")
+@click.option("--retry-failed", is_flag=True, help="Also scan again uploads the scanner gave up on.")
+@with_appcontext
+def upload_scan_command(retry_failed):
+    """Scan quarantined uploads now in this process."""
+    if retry_failed:
+        db.session.execute(db.update(UploadScan).where(UploadScan.state == SCAN_FAILED)
+                           .values(state=SCAN_PENDING, attempts=0))
+        db.session.commit()
+
+    scan_ids = db.session.execute(db.select(UploadScan.id).where(UploadScan.state == SCAN_PENDING)
+                                  .order_by(UploadScan.created_at)).scalars().all()
+    results = {}
+    for scan_id in scan_ids:
+        state = scan_upload(scan_id)
+        if state is not None:
+            results[state] = results.get(state, 0) + 1
+
+    click.echo(f"Scanned {len(scan_ids)} uploads" + "".join(f", {count} {state}" for state, count in sorted(results.items())))
@@ -0,0 +1,375 @@
+import os
+import fcntl
+import sqlite3
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from file_browser import db
+from file_browser.models import User
+from file_browser.helpers import get_users_root, get_user_root, get_shard_names, UPLOAD_TEMP_PREFIX
+
+# Per user index schema. files_fts is trigram full text index over the names in files
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL COLLATE NOCASE,
+    extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    is_dir INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE INDEX IF NOT EXISTS files_extension ON files(extension, name);
+CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(name, content='files', content_rowid='id', tokenize='trigram');
+"""
+
+TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+           INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+           INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE OF name ON files BEGIN
+           INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+           INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+       END""",
+)
+
+DROP_TRIGGERS = (
+    "DROP TRIGGER IF EXISTS files_ai",
+    "DROP TRIGGER IF EXISTS files_ad",
+    "DROP TRIGGER IF EXISTS files_au",
+)
+
+SEARCH_TYPES = ("prefix", "substring", "ext")
+
+# Rows inserted per executemany() call while rebuilding
+REBUILD_BATCH_SIZE = 5000
+
+_rebuilding = set()
+_rebuilding_lock = threading.Lock()
+
+
+def get_index_path(username):
+    return os.path.join(current_app.config['SEARCH_INDEX_FOLDER'], f"{username}.db")
+
+def connect(username, create=False):
+    """
+    Open the user index. Returns None if it does not exist yet and create is False.
+    """
+    index_path = get_index_path(username)
+
+    if not os.path.exists(index_path):
+        if not create:
+            return None
+        create_index(index_path)
+
+    con = sqlite3.connect(index_path, timeout=30, isolation_level=None)
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+def create_index(index_path):
+    """
+    Create empty index next to index_path and move it in place,
+    so other connections never see a file without the schema
+    """
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    new_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.new"
+
+    con = sqlite3.connect(new_path, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.executescript(SCHEMA)
+        for statement in TRIGGERS:
+            con.execute(statement)
+    finally:
+        con.close()
+
+    os.replace(new_path, index_path)
+
+def split_user_path(abs_path):
+    """
+    Split absolute path inside users_space into (username, '/path/in/user/root').
+    Returns (None, None) for paths outside users_space.
+    Both layouts are understood, a path is sharded when its first folders are the shard names of the next one.
+    """
+    relative = os.path.relpath(os.path.abspath(abs_path), get_users_root())
+    if relative.startswith(os.pardir):
+        return None, None
+
+    parts = relative.split(os.sep)
+    levels = current_app.config['USERS_SPACE_SHARD_LEVELS']
+    if len(parts) > levels and tuple(parts[:levels]) == get_shard_names(parts[levels], levels):
+        parts = parts[levels:]
+
+    username, rest = parts[0], "/".join(parts[1:])
+    return username, "/" + rest if rest else None
+
+def make_row(path, name, file_stat, is_dir):
+    extension = os.path.splitext(name)[1][1:].lower() if not is_dir else ""
+    return (path, name, extension, file_stat.st_size, int(file_stat.st_mtime), int(is_dir))
+
+def walk_rows(abs_path, path):
+    """
+    Yield index rows for everything under abs_path using
+    :os.scandir()
+    """
+    stack = [(abs_path, path)]
+
+    while stack:
+        folder, folder_path = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.name.startswith(UPLOAD_TEMP_PREFIX):
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        entry_path = f"{folder_path.rstrip('/')}/{entry.name}"
+                        yield make_row(entry_path, entry.name, entry.stat(follow_symlinks=False), is_dir)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        stack.append((entry.path, entry_path))
+        except OSError:
+            continue
+
+def index_entry(abs_path, recursive=False):
+    """
+    Add or update file or folder in the index of its owner.
+    With recursive=True the content of the folder is indexed too (copied folders).
+    Does nothing until the user index was built once.
+    """
+    username, path = split_user_path(abs_path)
+    con = connect(username) if path else None
+    if con is None:
+        return
+
+    upsert = """INSERT INTO files(path, name, extension, size, mtime, is_dir) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET size=excluded.size, mtime=excluded.mtime, is_dir=excluded.is_dir"""
+    try:
+        file_stat = os.lstat(abs_path)
+        is_dir = os.path.isdir(abs_path)
+
+        with con:
+            con.execute("BEGIN")
+            con.execute(upsert, make_row(path, os.path.basename(abs_path), file_stat, is_dir))
+            if recursive and is_dir:
+                con.executemany(upsert, walk_rows(abs_path, path))
+    except OSError:
+        pass
+    finally:
+        con.close()
+
+def like_prefix(path):
+    """
+    LIKE pattern matching everything under path
+    """
+    escaped = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.rstrip("/") + "/%"
+
+def unindex_entry(abs_path):
+    """
+    Remove file or folder with all its content from the index
+    """
+    username, path = split_user_path(abs_path)
+    con = connect(username) if path else None
+    if con is None:
+        return
+
+    try:
+        with con:
+            con.execute("BEGIN")
+            con.execute("DELETE FROM files WHERE path = ? OR path LIKE ? ESCAPE '\\'", (path, like_prefix(path)))
+    finally:
+        con.close()
+
+def move_entry(old_abs_path, new_abs_path):
+    """
+    Update index after rename or move inside the same user root
+    """
+    username, old_path = split_user_path(old_abs_path)
+    new_username, new_path = split_user_path(new_abs_path)
+    con = connect(username) if old_path and new_path and username == new_username else None
+    if con is None:
+        return
+
+    new_name = os.path.basename(new_abs_path)
+    new_extension = os.path.splitext(new_name)[1][1:].lower()
+
+    try:
+        with con:
+            con.execute("BEGIN")
+            con.execute("UPDATE files SET path = ?, name = ?, extension = CASE is_dir WHEN 1 THEN '' ELSE ? END WHERE path = ?",
+                        (new_path, new_name, new_extension, old_path))
+            con.execute("UPDATE files SET path = ? || substr(path, ?) WHERE path LIKE ? ESCAPE '\\'",
+                        (new_path, len(old_path) + 1, like_prefix(old_path)))
+    finally:
+        con.close()
+
+def rebuild_user_index(username):
+    """
+    Crawl the whole user root and replace the index content in one transaction.
+    Readers keep seeing the old content until it is committed (WAL).
+    Triggers are dropped during the bulk insert and the full text index is rebuilt once.
+    """
+    user_root = get_user_root(username)
+    if not os.path.isdir(user_root):
+        return 0
+
+    con = connect(username, create=True)
+    count = 0
+
+    try:
+        rows = walk_rows(user_root, "/")
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            for statement in DROP_TRIGGERS:
+                con.execute(statement)
+            con.execute("DELETE FROM files")
+
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    con.executemany("INSERT OR REPLACE INTO files(path, name, extension, size, mtime, is_dir) VALUES (?, ?, ?, ?, ?, ?)", batch)
+                    count += len(batch)
+                    batch = []
+
+            con.executemany("INSERT OR REPLACE INTO files(path, name, extension, size, mtime, is_dir) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            count += len(batch)
+
+            con.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+            for statement in TRIGGERS:
+                con.execute(statement)
+    finally:
+        con.close()
+
+    return count
+
+def rebuild_user_index_in_background(username):
+    """
+    Start rebuild thread for the user unless one is already running
+    """
+    with _rebuilding_lock:
+        if username in _rebuilding:
+            return
+        _rebuilding.add(username)
+
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            with app.app_context():
+                rebuild_user_index(username)
+        except Exception:
+            app.logger.exception("Search index rebuild of '%s' failed", username)
+        finally:
+            with _rebuilding_lock:
+                _rebuilding.discard(username)
+
+    threading.Thread(target=run, name=f"search-rebuild-{username}", daemon=True).start()
+
+def is_rebuilding(username):
+    with _rebuilding_lock:
+        return username in _rebuilding
+
+def search_files(username, query, search_type="substring", limit=100):
+    """
+    Search the user index.
+    prefix - name starts with query, uses the name b-tree index
+    substring - name contains query, uses the trigram index for 3+ characters
+    ext - files with extension
+    Returns list of dicts sorted by name, or None if the index is not built yet.
+    """
+    con = connect(username)
+    if con is None:
+        return None
+
+    columns = "f.path, f.name, f.size, f.mtime, f.is_dir"
+
+    try:
+        if search_type == "ext":
+            rows = con.execute(f"SELECT {columns} FROM files f WHERE f.extension = ? ORDER BY f.name LIMIT ?",
+                               (query.lstrip(".").lower(), limit))
+
+        elif search_type == "prefix":
+            pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            rows = con.execute(f"SELECT {columns} FROM files f WHERE f.name LIKE ? ESCAPE '\\' ORDER BY f.name LIMIT ?",
+                               (pattern, limit))
+
+        elif len(query) >= 3:
+            phrase = '"' + query.replace('"', '""') + '"'
+            rows = con.execute(f"""SELECT {columns} FROM files_fts JOIN files f ON f.id = files_fts.rowid
+                                   WHERE files_fts MATCH ? ORDER BY f.name LIMIT ?""", (phrase, limit))
+
+        else:
+            # Trigram index needs at least 3 characters
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            rows = con.execute(f"SELECT {columns} FROM files f WHERE f.name LIKE ? ESCAPE '\\' ORDER BY f.name LIMIT ?",
+                               (pattern, limit))
+
+        return [{'path': path, 'name': name, 'size': size, 'mtime': mtime, 'is_dir': bool(is_dir)}
+                for path, name, size, mtime, is_dir in rows]
+    finally:
+        con.close()
+
+def crawl_all_users():
+    """
+    Rebuild index of every user folder in users_space.
+    Users come from the database, their folders may be in either layout while they are migrated.
+    """
+    total = 0
+    for (username,) in db.session.execute(db.select(User.username)).all():
+        if os.path.isdir(get_user_root(username)):
+            total += rebuild_user_index(username)
+    return total
+
+def start_search_crawler():
+    """
+    Rebuild all indexes every SEARCH_CRAWL_INTERVAL seconds in background.
+    Only one process crawls, the others fail to take the lock file and skip it.
+    """
+    interval = current_app.config['SEARCH_CRAWL_INTERVAL']
+    if interval <= 0:
+        return None
+
+    os.makedirs(current_app.config['SEARCH_INDEX_FOLDER'], exist_ok=True)
+    lock_file = open(os.path.join(current_app.config['SEARCH_INDEX_FOLDER'], "crawler.lock"), "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+
+    app = current_app._get_current_object()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    crawl_all_users()
+            except Exception:
+                app.logger.exception("Search crawl failed")
+
+    thread = threading.Thread(target=run, name="search-crawler", daemon=True)
+    thread.lock_file = lock_file
+    thread.start()
+    return thread
+
+@click.command("search-rebuild")
+@click.option("--user", "username", default=None, help="Rebuild only this user index.")
+@with_appcontext
+def search_rebuild_command(username):
+    """Rebuild filename search index from the users_space folders."""
+    started = time.perf_counter()
+    count = rebuild_user_index(username) if username else crawl_all_users()
+    click.echo(f"Indexed {count} entries in {time.perf_counter() - started:.2f}s")
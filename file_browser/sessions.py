@@ -0,0 +1,221 @@
+import os
+import time
+import fcntl
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import click
+from cachelib.file import FileSystemCache
+from flask import request, current_app
+from flask.cli import with_appcontext
+from flask.sessions import SecureCookieSessionInterface
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from flask_session.cachelib import CacheLibSessionInterface
+
+# Backends selectable with SESSION_BACKEND
+SESSION_BACKENDS = ("cookie", "filesystem", "sqlite", "shm")
+
+# Shared memory filesystem the shm backend keeps its database on
+SHM_FOLDER = "/dev/shm"
+
+
+class SQLiteSession(ServerSideSession):
+    pass
+
+
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    """
+    Sessions in a separate SQLite database, not in the app database, so session writes
+    never wait for the app write lock.
+
+    WAL mode lets all workers read at the same time. Put on tmpfs (/dev/shm) it is a
+    shared memory store for every worker process of one host, losing sessions on reboot
+    is the price.
+    """
+
+    session_class = SQLiteSession
+    # Expired rows are skipped on read and deleted by the background cleaner
+    ttl = True
+
+    def __init__(self, path, synchronous="NORMAL", **kwargs):
+        self.path = path
+        self.synchronous = synchronous
+        self._local = threading.local()
+        super().__init__(None, **kwargs)
+
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                               "id TEXT PRIMARY KEY, data BLOB NOT NULL, expiry REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)")
+
+    def _connect(self):
+        """
+        One connection per thread, sqlite3 connections must not be shared between threads
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.connection = connection
+        return connection
+
+    def _retrieve_session_data(self, store_id):
+        row = self._connect().execute("SELECT data FROM sessions WHERE id = ? AND expiry > ?",
+                                      (store_id, time.time())).fetchone()
+        return self.serializer.decode(row[0]) if row else None
+
+    def _delete_session(self, store_id):
+        self._connect().execute("DELETE FROM sessions WHERE id = ?", (store_id,))
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        self._connect().execute("INSERT INTO sessions (id, data, expiry) VALUES (?, ?, ?) "
+                                "ON CONFLICT (id) DO UPDATE SET data = excluded.data, expiry = excluded.expiry",
+                                (store_id, self.serializer.encode(session),
+                                 time.time() + session_lifetime.total_seconds()))
+
+    def _delete_expired_sessions(self):
+        return self._connect().execute("DELETE FROM sessions WHERE expiry <= ?", (time.time(),)).rowcount
+
+
+class FileSystemSessionInterface(CacheLibSessionInterface):
+    """
+    Sessions as files through
+    :cachelib.FileSystemCache
+    cachelib removes expired files only when over its threshold, the background cleaner does it always
+    """
+
+    def _delete_expired_sessions(self):
+        self.cache._remove_expired(time.time())
+
+
+def create_session_interface(backend, folder, **kwargs):
+    """
+    Returns session interface of backend storing in folder, None for Flask signed cookie sessions
+    """
+    if backend == "cookie":
+        return None
+
+    if backend == "filesystem":
+        return FileSystemSessionInterface(client=FileSystemCache(folder, threshold=0, mode=0o600), **kwargs)
+
+    if backend == "sqlite":
+        return SQLiteSessionInterface(os.path.join(folder, "sessions.db"), **kwargs)
+
+    if backend == "shm":
+        # On tmpfs the data never reaches a disk, fsync is not needed
+        return SQLiteSessionInterface(os.path.join(folder, "sessions.db"), synchronous="OFF", **kwargs)
+
+    raise ValueError(f"Unknown session backend '{backend}'")
+
+def regenerate_session(session):
+    """
+    Give the session a new id and delete the stored old one, an id known before login or logout stays useless.
+    Flask signed cookie sessions have no id, their cookie changes with the content.
+    """
+    interface = current_app.session_interface
+    if isinstance(interface, ServerSideSessionInterface):
+        interface.regenerate(session)
+
+def get_session_folder(config):
+    if config['SESSION_BACKEND'] == "shm":
+        return config['SESSION_SHM_FOLDER']
+    return config['SESSION_FOLDER']
+
+def start_session_cleaner():
+    """
+    Delete expired sessions of the app session store every SESSION_CLEANUP_INTERVAL seconds in background.
+    Only the worker holding the lock file runs it.
+    """
+    interface = current_app.session_interface
+    interval = current_app.config['SESSION_CLEANUP_INTERVAL']
+    if not isinstance(interface, ServerSideSessionInterface) or interval <= 0:
+        return None
+
+    folder = get_session_folder(current_app.config)
+
+    # Next to the folder, the filesystem backend treats every file inside as a session
+    lock_file = open(f"{folder.rstrip(os.sep)}.lock", "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+
+    app = current_app._get_current_object()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                interface._delete_expired_sessions()
+            except Exception:
+                app.logger.exception("Deleting expired sessions failed")
+
+    thread = threading.Thread(target=run, name="session-cleaner", daemon=True)
+    thread.lock_file = lock_file
+    thread.start()
+    return thread
+
+def init_sessions(app):
+    """
+    Install the configured server side session interface.
+    The cookie then holds only the random session id.
+    """
+    backend = app.config['SESSION_BACKEND']
+    if backend not in SESSION_BACKENDS:
+        raise ValueError(f"Unknown session backend '{backend}'")
+
+    if backend == "cookie":
+        return None
+
+    folder = get_session_folder(app.config)
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+
+    interface = create_session_interface(backend, folder,
+                                         key_prefix=app.config['SESSION_KEY_PREFIX'],
+                                         permanent=app.config['SESSION_PERMANENT'],
+                                         sid_length=app.config['SESSION_ID_LENGTH'])
+    app.session_interface = interface
+    return interface
+
+@click.command("session-benchmark")
+@click.option("--requests", "count", default=2000, show_default=True, help="Requests per backend.")
+@with_appcontext
+def session_benchmark_command(count):
+    """Measure session load and save cost per request of every backend."""
+    app = current_app._get_current_object()
+    values = {'user': "benchmark", '_user_id': "1", '_fresh': True, 'csrf_token': "x" * 40}
+
+    for backend in SESSION_BACKENDS:
+        parent = SHM_FOLDER if backend == "shm" and os.path.isdir(SHM_FOLDER) else None
+        folder = tempfile.mkdtemp(prefix="session-benchmark-", dir=parent)
+
+        try:
+            interface = create_session_interface(backend, folder) or SecureCookieSessionInterface()
+
+            # First request creates the session and gives the cookie the others send back
+            with app.test_request_context("/"):
+                session = interface.open_session(app, request)
+                session.update(values)
+                response = app.response_class()
+                interface.save_session(app, session, response)
+                cookie = response.headers.get("Set-Cookie", "").split(";")[0]
+
+            started = time.perf_counter()
+            for number in range(count):
+                with app.test_request_context("/", headers={'Cookie': cookie}):
+                    session = interface.open_session(app, request)
+                    # Every fourth request changes the session like a flash message would
+                    if number % 4 == 0:
+                        session['_flashes'] = [("message", "Saved!")]
+                    interface.save_session(app, session, app.response_class())
+            elapsed = time.perf_counter() - started
+
+            click.echo(f"{backend:>10}: {elapsed / count * 1e6:8.1f} us per request, cookie {len(cookie)} bytes")
+
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
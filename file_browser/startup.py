@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import subprocess
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from file_browser import db
+from file_browser.database import get_database_settings
+
+# Child process measuring what a new worker does before it can serve: imports and create_app()
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+from file_browser import create_app
+create_app()
+print(time.perf_counter() - started)
+"""
+
+
+def measure_startup(import_times=False):
+    """
+    Start a fresh interpreter that builds the app and return
+    (process seconds, create seconds, -X importtime report or None).
+    Background services are off in the child, they do not delay serving.
+    """
+    env = dict(os.environ, BACKGROUND_SERVICES="0")
+    command = [sys.executable] + (["-X", "importtime"] if import_times else []) + ["-c", STARTUP_SCRIPT]
+
+    started = time.perf_counter()
+    result = subprocess.run(command, env=env, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    process_seconds = time.perf_counter() - started
+
+    return process_seconds, float(result.stdout.strip().splitlines()[-1]), result.stderr if import_times else None
+
+def get_slowest_imports(report, count):
+    """
+    Returns [(cumulative microseconds, module)] of top level imports and their direct
+    imports from -X importtime output
+    """
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented two spaces per level, their time is included in the parent
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+@click.command("startup-time")
+@click.option("--runs", default=5, show_default=True, help="Fresh processes started.")
+@click.option("--imports", "top_imports", default=0, help="Also list this many slowest imports.")
+@with_appcontext
+def startup_time_command(runs, top_imports):
+    """Measure cold start of a worker and check it against STARTUP_TIME_BUDGET."""
+    budget = current_app.config['STARTUP_TIME_BUDGET']
+    results = [measure_startup() for _ in range(runs)]
+    best_process = min(process for process, _, _ in results)
+    best_create = min(create for _, create, _ in results)
+
+    click.echo(f"Process start to app ready: best {best_process:.3f}s of {runs} runs")
+    click.echo(f"Imports and create_app(): best {best_create:.3f}s, budget {budget:.3f}s")
+    click.echo("Database: " + ", ".join(f"{name}={value}" for name, value in get_database_settings(db.engine).items()))
+
+    if top_imports:
+        _, _, report = measure_startup(import_times=True)
+        for cumulative, name in get_slowest_imports(report, top_imports):
+            click.echo(f"{cumulative / 1000:9.1f} ms  {name}")
+
+    if best_create > budget:
+        raise click.ClickException(f"Startup is over the budget by {best_create - budget:.3f}s")
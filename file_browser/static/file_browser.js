@@ -8,138 +8,585 @@ function confirmDeletion(displayName) {
       }
 }
 
-// Handle renaming files and folders
+// Url path of file or folder relative to the user root, every segment encoded
+function encodePath(path) {
+    return path.split('/').map(encodeURIComponent).join('/');
+}
+
+function joinPath(folder, name) {
+    return folder ? `${folder}/${name}` : name;
+}
+
+// Same format as get_readable_byte_size() on the server
+function readableByteSize(num) {
+    for (const unit of ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']) {
+        if (Math.abs(num) < 1024) {
+            return `${num.toFixed(1)}${unit}B`;
+        }
+        num /= 1024;
+    }
+    return `${num.toFixed(1)}YiB`;
+}
+
+// Same format as get_time_stamp() on the server, in the browser time zone
+function timeStamp(seconds) {
+    const date = new Date(seconds * 1000);
+    const pad = value => String(value).padStart(2, '0');
+    return `${pad(date.getDate())}-${pad(date.getMonth() + 1)}-${date.getFullYear()} ` +
+           `${pad(date.getHours())}:${pad(date.getMinutes())}:${pad(date.getSeconds())}`;
+}
+
+// Listing API responses by url with their ETag, a 304 answer reuses the stored one
+const listingCache = new Map();
+
+// Fetch one page of folder listing, rows are [name, is_dir, size, mtime, ctime, thumbnail_version]
+async function fetchListing(path, sort, order, cursor) {
+    const params = new URLSearchParams({sort: sort, order: order});
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+    const url = `${path ? '/api/listing/' + encodePath(path) : '/api/listing'}?${params}`;
+
+    const cached = listingCache.get(url);
+    const headers = cached ? {'If-None-Match': cached.etag} : {};
+    const response = await fetch(url, {headers: headers, cache: 'no-store'});
+
+    if (response.status === 304 && cached) {
+        return cached.listing;
+    }
+    if (!response.ok) {
+        throw new Error(`Listing failed with ${response.status}`);
+    }
+
+    const listing = await response.json();
+    const etag = response.headers.get('ETag');
+    if (etag) {
+        listingCache.set(url, {etag: etag, listing: listing});
+    } else {
+        listingCache.delete(url);
+    }
+    return listing;
+}
+
+// Index page url of folder, the same page is rendered by the server on reload
+function indexUrl(path, params) {
+    const query = new URLSearchParams(params);
+    for (const [key, value] of Array.from(query.entries())) {
+        if (!value) {
+            query.delete(key);
+        }
+    }
+    const search = query.toString();
+    return `/${encodePath(path)}${search ? '?' + search : ''}`;
+}
+
 document.addEventListener('DOMContentLoaded', function () {
 
     const csrfTokenMeta = document.querySelector('meta[name="csrf-token"]');
     const csrfToken = csrfTokenMeta ? csrfTokenMeta.content : '';
-    
-    let editFilaNameBtns = document.querySelectorAll(".edit_file_name");
-    let deleteBtns = document.querySelectorAll(".delete_file");
-
-    editFilaNameBtns.forEach(function (button) {
-        button.addEventListener('click', function () {
-
-            const parentTr = this.closest('tr');
-            let fileNameInput = parentTr.querySelector('.new_file_name');
-            let displayName = parentTr.querySelector('.display_name');
-            let hideDisplayName = parentTr.querySelector('.hide_display_name');
-            let saveButton = parentTr.querySelector('.save_btn');
-            let cancelButton = parentTr.querySelector('.cancel_btn');
-            let pathToFile = saveButton.value;
-
-            fileNameInput.value = displayName.value;
-
-            let fileNameToSplit = fileNameInput.value; 
-            
-            // Split the file from the dot
-            if (fileNameToSplit.indexOf(".") !== -1) {
-                fileNameAndSuffix = fileNameToSplit.split(".");
-                fileNameInput.value = fileNameAndSuffix[0];
-                fileNameSuffix = fileNameAndSuffix[1];
-            } else {
-                // Handle filenames without dot
-                fileNameInput.value = fileNameToSplit;
-                fileNameSuffix = ""; 
+
+    const table = document.querySelector('#file_table');
+    if (!table) {
+        return;
+    }
+
+    const tbody = table.querySelector('tbody');
+    const rowTemplate = document.querySelector('#file_row_template');
+    const iconTypes = new Set(table.dataset.iconTypes.split(','));
+    const selectAll = document.querySelector('#select_all_files');
+    const deleteSelectedBtn = document.querySelector('#delete_selected_btn');
+
+    // Folder and page shown in the table
+    let current = {
+        path: table.dataset.path.replace(/^\/+|\/+$/g, ''),
+        sort: table.dataset.sort,
+        order: table.dataset.order,
+        cursor: new URLSearchParams(location.search).get('cursor') || ''
+    };
+
+    const iconClass = (name) => {
+        const dot = name.lastIndexOf('.');
+        const extension = dot > 0 ? name.slice(dot + 1) : '';
+        return iconTypes.has(extension) ? `bi bi-filetype-${extension}` : 'bi bi-file-earmark';
+    };
+
+    // Build table row from the row template for one listing API row
+    const createRow = (row, listing) => {
+        const [name, isDir, size, mtime, ctime, thumbnailVersion] = row;
+        const filePath = joinPath(listing.path, name);
+        const tr = rowTemplate.content.firstElementChild.cloneNode(true);
+
+        tr.dataset.path = `/${filePath}`;
+        tr.dataset.type = isDir ? 'folder' : 'file';
+        tr.dataset.version = `${size}-${mtime}`;
+
+        tr.querySelector('.select_file').setAttribute('aria-label', `Select ${name}`);
+        tr.querySelector('.file_link').href = indexUrl(filePath);
+        tr.querySelector('.file_name').textContent = name;
+
+        const icon = tr.querySelector('.file_icon');
+        if (thumbnailVersion) {
+            const thumbnail = tr.querySelector('.file_thumbnail');
+            thumbnail.src = `/thumbnail/${encodePath(filePath)}?v=${thumbnailVersion}`;
+            thumbnail.hidden = false;
+            icon.remove();
+        } else {
+            icon.className = `${isDir ? 'bi bi-folder-fill' : iconClass(name)} text-primary file_icon`;
+        }
+
+        tr.querySelector('.new_file_name').value = name;
+        tr.querySelector('.display_name').value = name;
+        tr.querySelector('.save_btn').value = listing.location;
+        tr.querySelector('.delete_btn').setAttribute('value', listing.location);
+
+        tr.querySelector('.file_created_time').textContent = timeStamp(ctime);
+        tr.querySelector('.file_modified_time').textContent = timeStamp(mtime);
+        tr.querySelector('.file_size').textContent = readableByteSize(size);
+
+        if (isDir) {
+            tr.querySelector('.file_download').remove();
+            tr.querySelector('.file_open').href = indexUrl(filePath);
+            tr.querySelector('.file_archive').href = `/download/${encodePath(filePath)}`;
+        } else {
+            tr.querySelector('.file_open').remove();
+            tr.querySelector('.file_archive').remove();
+            tr.querySelector('.file_download').href = `/download/${encodePath(filePath)}`;
+        }
+        return tr;
+    };
+
+    // Patch the table with the listing, unchanged rows are kept with their selection
+    const showListing = (listing) => {
+        const parentRow = document.querySelector('#parent_row');
+        const existing = new Map(Array.from(tbody.querySelectorAll('tr[data-path]')).map(tr => [tr.dataset.path, tr]));
+
+        const rows = listing.rows.map(row => {
+            const tr = existing.get(`/${joinPath(listing.path, row[0])}`);
+            if (tr && tr.dataset.version === `${row[2]}-${row[3]}` && !tr.classList.contains('renaming')) {
+                return tr;
             }
-            
-            // Hide/show and focus rename input 
-            hideDisplayName.hidden = true;
-            fileNameInput.hidden = false;
-            fileNameInput.readOnly= false;
-            saveButton.hidden = false;
-            cancelButton.hidden = false;
-            console.log(fileNameInput.value);
-            
-            fileNameInput.focus();
-
-            // If save button is clicked
-            saveButton.addEventListener('click', () => {
-                let oldFileName = displayName.value;
-                let newFileName = fileNameInput.value;
-                
-                fetch('/rename_file', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-CSRFToken': csrfToken
-                    },
-                    body: JSON.stringify({
-                        old_file_name: oldFileName,
-                        new_file_name: newFileName,
-                        file_suffix: fileNameSuffix,
-                        path_to_file: pathToFile
-                    })
-                })
-                .then(response => {
-                    if (response.ok) {
-                        return response.json();
-                    } else {
-                        throw new Error('Failed to rename file');
-                    }
-                })
-                .then(data => {
-                    // Update file name displayed on the page
-                    displayName = data.new_file_name;
-                    fileNameInput.value = data.new_file_name;
-                    // Hide input field and buttons
-                    fileNameInput.hidden = true;
-                    fileNameInput.readOnly = true;
-                    saveButton.hidden = true;
-                    cancelButton.hidden = true;
-                    location.reload();
-                })
-                .catch(error => {
-                    console.log('Error', error);
-                });
-            });
+            return createRow(row, listing);
+        });
+        tbody.replaceChildren(parentRow, ...rows);
 
-            // If cancel button is clicked
-            cancelButton.addEventListener('click', () => {
-                location.reload();
-            });
+        current = {path: listing.path, sort: listing.sort, order: listing.order, cursor: current.cursor};
+
+        parentRow.hidden = listing.parent === null;
+        if (listing.parent !== null) {
+            document.querySelector('#parent_link').href = indexUrl(listing.parent);
+        }
+
+        document.querySelector('#path_indicator').value = listing.location;
+        document.querySelectorAll('input[name="folder_path"]').forEach(input => { input.value = listing.location; });
+
+        table.querySelectorAll('.sort_link').forEach(link => {
+            const key = link.dataset.sort;
+            const nextOrder = listing.sort === key && listing.order === 'asc' ? 'desc' : 'asc';
+            const caret = link.querySelector('i');
+            link.href = indexUrl(listing.path, {sort: key, order: nextOrder});
+            caret.className = `bi bi-caret-${listing.order === 'asc' ? 'up' : 'down'}-fill`;
+            caret.hidden = listing.sort !== key;
+        });
+
+        const firstPageLink = document.querySelector('#first_page_link');
+        const nextPageLink = document.querySelector('#next_page_link');
+        firstPageLink.href = indexUrl(listing.path, {sort: listing.sort, order: listing.order});
+        firstPageLink.hidden = !current.cursor;
+        nextPageLink.href = indexUrl(listing.path, {sort: listing.sort, order: listing.order, cursor: listing.next_cursor});
+        nextPageLink.hidden = !listing.next_cursor;
+
+        document.querySelector('#total_files').textContent = `${listing.total} items`;
+        document.querySelector('#storage_usage').textContent = `Used ${readableByteSize(listing.storage_used)}` +
+            (listing.storage_quota ? ` of ${readableByteSize(listing.storage_quota)}` : '');
+
+        if (selectAll) {
+            selectAll.checked = false;
+        }
+        updateDeleteSelectedBtn();
+    };
+
+    // Reload the current page of the table after a change, falls back to full page reload
+    const refreshListing = () => {
+        return fetchListing(current.path, current.sort, current.order, current.cursor)
+        .then(showListing)
+        .catch(error => {
+            console.log('Error refreshing listing', error);
+            location.reload();
+        });
+    };
+
+    // Show folder or page given by index url without reloading the page
+    const navigate = (url, push) => {
+        const target = new URL(url, location.href);
+        const path = decodeURIComponent(target.pathname).replace(/^\/+|\/+$/g, '');
+        const params = target.searchParams;
+        const cursor = params.get('cursor') || '';
+
+        return fetchListing(path, params.get('sort') || 'name', params.get('order') || 'asc', cursor)
+        .then(listing => {
+            current.cursor = cursor;
+            showListing(listing);
+            if (push) {
+                history.pushState(null, '', target.pathname + target.search);
+            }
+        })
+        .catch(error => {
+            console.log('Error loading folder', error);
+            location.href = target.href;
         });
+    };
+
+    window.addEventListener('popstate', () => navigate(location.href, false));
+
+    // Folder, sort and page links are loaded through the listing API, files still open as before
+    document.addEventListener('click', function (event) {
+        const link = event.target.closest('a[href]');
+        if (!link || event.button !== 0 || event.ctrlKey || event.metaKey || event.shiftKey || event.altKey) {
+            return;
+        }
+
+        const row = link.closest('tr[data-path]');
+        const isFolderLink = row && row.dataset.type === 'folder' && tbody.contains(row) &&
+                             !link.classList.contains('file_archive');
+        const isTableLink = link.classList.contains('sort_link') ||
+                            ['parent_link', 'first_page_link', 'next_page_link'].includes(link.id);
+
+        if (isFolderLink || isTableLink) {
+            event.preventDefault();
+            navigate(link.href, true);
+        }
     });
 
+    // Handle renaming files and folders
+    const startRename = (parentTr) => {
+        let fileNameInput = parentTr.querySelector('.new_file_name');
+        let displayName = parentTr.querySelector('.display_name');
+
+        let fileNameToSplit = displayName.value;
+
+        // Split the file from the dot
+        if (fileNameToSplit.indexOf(".") !== -1) {
+            let fileNameAndSuffix = fileNameToSplit.split(".");
+            fileNameInput.value = fileNameAndSuffix[0];
+            parentTr.dataset.suffix = fileNameAndSuffix[1];
+        } else {
+            // Handle filenames without dot
+            fileNameInput.value = fileNameToSplit;
+            parentTr.dataset.suffix = "";
+        }
+
+        // Hide/show and focus rename input
+        toggleRename(parentTr, true);
+        fileNameInput.focus();
+    };
+
+    const toggleRename = (parentTr, renaming) => {
+        let fileNameInput = parentTr.querySelector('.new_file_name');
+
+        parentTr.classList.toggle('renaming', renaming);
+        parentTr.querySelector('.hide_display_name').hidden = renaming;
+        fileNameInput.hidden = !renaming;
+        fileNameInput.readOnly = !renaming;
+        parentTr.querySelector('.save_btn').hidden = !renaming;
+        parentTr.querySelector('.cancel_btn').hidden = !renaming;
+    };
+
+    const saveRename = (parentTr) => {
+        let displayName = parentTr.querySelector('.display_name');
+        let fileNameInput = parentTr.querySelector('.new_file_name');
+
+        fetch('/rename_file', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken
+            },
+            body: JSON.stringify({
+                old_file_name: displayName.value,
+                new_file_name: fileNameInput.value,
+                file_suffix: parentTr.dataset.suffix,
+                path_to_file: parentTr.querySelector('.save_btn').value
+            })
+        })
+        .then(response => {
+            if (response.ok) {
+                return response.json();
+            } else {
+                throw new Error('Failed to rename file');
+            }
+        })
+        .catch(error => {
+            console.log('Error', error);
+        })
+        .finally(() => {
+            // Renamed row comes back from the listing under its new name
+            toggleRename(parentTr, false);
+            refreshListing();
+        });
+    };
+
     // Handle deleting files and folders
-    deleteBtns.forEach( function (button_d) {
-        button_d.addEventListener('click', function () {
-            
-            const parentTr = this.closest('tr');
-            let displayName = parentTr.querySelector('.display_name');
-            let deleteBtn = parentTr.querySelector('.save_btn');
-            let pathToDeleteFile = deleteBtn.value;
-
-            let deleteFileConfirmation = confirmDeletion(displayName.value);
-
-            if (!deleteFileConfirmation) {
-                location.reload();
-            };
-            
-            fetch('/delete_file', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'X-CSRFToken': csrfToken
-                },
-                body: JSON.stringify({
-                    delete_file: displayName.value,
-                    path_to_delete_file: pathToDeleteFile
-                })
+    const deleteRow = (parentTr) => {
+        let displayName = parentTr.querySelector('.display_name');
+        let pathToDeleteFile = parentTr.querySelector('.save_btn').value;
+
+        if (!confirmDeletion(displayName.value)) {
+            return;
+        }
+
+        fetch('/delete_file', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken
+            },
+            body: JSON.stringify({
+                delete_file: displayName.value,
+                path_to_delete_file: pathToDeleteFile
             })
-            .then(response => {
-                if (response.ok) {
-                    return response.json();
-                } else {
-                    throw new Error('Failed to delete file');
+        })
+        .then(async response => {
+            if (response.ok) {
+                return response.json();
+            }
+
+            const data = await response.json();
+            // Non empty folders are deleted with their content by a background job
+            if (data.error === 'Folder is not empty!' &&
+                confirm(`${displayName.value} is not empty. Delete it with all its content?`)) {
+                return runJob({op: 'delete', path: parentTr.dataset.path}, csrfToken);
+            }
+            throw new Error('Failed to delete file');
+        })
+        .then(data => {
+            parentTr.remove();
+            refreshListing();
+        })
+        .catch(error => {
+            console.log('Error deleting file', error);
+        })
+    };
+
+    // Rows are replaced when the table is patched, so their buttons are handled here
+    tbody.addEventListener('click', function (event) {
+        const parentTr = event.target.closest('tr[data-path]');
+        if (!parentTr) {
+            return;
+        }
+
+        if (event.target.closest('.edit_file_name')) {
+            startRename(parentTr);
+        } else if (event.target.closest('.save_btn')) {
+            saveRename(parentTr);
+        } else if (event.target.closest('.cancel_btn')) {
+            toggleRename(parentTr, false);
+        } else if (event.target.closest('.delete_file')) {
+            deleteRow(parentTr);
+        }
+    });
+
+    // Multi select and batch delete
+    const selectBoxes = () => tbody.querySelectorAll('.select_file');
+
+    function updateDeleteSelectedBtn() {
+        if (deleteSelectedBtn) {
+            deleteSelectedBtn.disabled = !tbody.querySelector('.select_file:checked');
+        }
+    }
+
+    if (selectAll) {
+        selectAll.addEventListener('change', function () {
+            selectBoxes().forEach(box => { box.checked = selectAll.checked; });
+            updateDeleteSelectedBtn();
+        });
+    }
+
+    tbody.addEventListener('change', function (event) {
+        if (event.target.classList.contains('select_file')) {
+            updateDeleteSelectedBtn();
+        }
+    });
+
+    if (deleteSelectedBtn) {
+        deleteSelectedBtn.addEventListener('click', function () {
+            const rows = Array.from(tbody.querySelectorAll('.select_file:checked')).map(box => box.closest('tr'));
+
+            if (!rows.length || !confirmDeletion(`${rows.length} items`)) {
+                return;
+            }
+
+            runBatch(rows.map(row => ({op: 'delete', path: row.dataset.path})), csrfToken)
+            .then(results => {
+                let errors = [];
+                results.forEach((result, index) => {
+                    if (!result.success) {
+                        errors.push(`${rows[index].dataset.path}: ${result.error}`);
+                    }
+                });
+                if (errors.length) {
+                    alert(errors.join('\n'));
                 }
-            })
-            .then(data => {
-                location.reload();
+                return refreshListing();
             })
             .catch(error => {
-                console.log('Error deleting file', error);
+                console.log('Error deleting files', error);
+            });
+        });
+    }
+
+    // Big files are sent in chunks through the resumable upload API
+    const uploadForm = document.querySelector('form[action="/upload_file"]');
+
+    if (uploadForm) {
+        uploadForm.addEventListener('submit', function (event) {
+            const fileInput = uploadForm.querySelector('#upload_file_name');
+            const file = fileInput.files[0];
+
+            if (!file || file.size <= CHUNKED_UPLOAD_THRESHOLD) {
+                return;
+            }
+
+            event.preventDefault();
+            const folderPath = uploadForm.querySelector('input[name="folder_path"]').value;
+
+            chunkedUpload(file, folderPath, csrfToken)
+            .then(() => {
+                fileInput.value = '';
+                return refreshListing();
             })
+            .catch(error => {
+                console.log('Error uploading file', error);
+                alert(`Upload of ${file.name} failed! ${error.message}`);
+            });
         });
-    });
+    }
 });
+
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 5;
+
+// Upload file in chunks, a failed chunk is retried from the offset the server has
+async function chunkedUpload(file, folderPath, csrfToken) {
+    const headers = {'X-CSRFToken': csrfToken};
+
+    let response = await fetch('/uploads', {
+        method: 'POST',
+        headers: {...headers, 'Content-Type': 'application/json'},
+        body: JSON.stringify({file_name: file.name, folder_path: folderPath, size: file.size})
+    });
+    let upload = await response.json();
+
+    if (!response.ok) {
+        throw new Error(upload.error);
+    }
+
+    const uploadId = upload.upload_id;
+    let offset = 0;
+    let retries = 0;
+
+    while (offset < file.size) {
+        try {
+            response = await fetch(`/uploads/${uploadId}?offset=${offset}`, {
+                method: 'PUT',
+                headers: {...headers, 'Content-Type': 'application/octet-stream'},
+                body: file.slice(offset, offset + CHUNK_SIZE)
+            });
+        } catch (error) {
+            // Connection lost, ask the server how much it has
+            if (++retries > CHUNK_RETRIES) {
+                throw error;
+            }
+            response = await fetch(`/uploads/${uploadId}`);
+        }
+
+        upload = await response.json();
+        if (!response.ok && response.status !== 409) {
+            throw new Error(upload.error);
+        }
+        offset = upload.offset;
+    }
+
+    response = await fetch(`/uploads/${uploadId}/finalize`, {
+        method: 'POST',
+        headers: {...headers, 'Content-Type': 'application/json'},
+        body: JSON.stringify({})
+    });
+    const result = await response.json();
+
+    if (!response.ok) {
+        throw new Error(result.error);
+    }
+
+    // 202: the file is in quarantine until the malware scan passes
+    if (result.scan_id) {
+        await waitForScan(result.scan_id);
+    }
+}
+
+// Wait until the scanner released or removed the quarantined upload
+async function waitForScan(scanId) {
+    let scan = {state: 'pending'};
+
+    while (scan.state === 'pending' || scan.state === 'scanning') {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        const response = await fetch(`/uploads/scans/${scanId}`);
+        scan = await response.json();
+        if (!response.ok) {
+            throw new Error(scan.error);
+        }
+    }
+
+    if (scan.state === 'infected') {
+        throw new Error(`${scan.file_name} was removed, the scanner found ${scan.signature}`);
+    }
+    if (scan.state !== 'clean') {
+        throw new Error(`${scan.file_name} could not be checked (${scan.state})`);
+    }
+}
+
+// Run list of file operations in one request, resolves to per operation results
+async function runBatch(operations, csrfToken) {
+    const response = await fetch('/batch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': csrfToken
+        },
+        body: JSON.stringify({operations: operations})
+    });
+
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error);
+    }
+    return data.results;
+}
+
+// Start background job and wait until it is finished
+async function runJob(job, csrfToken) {
+    let response = await fetch('/jobs', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': csrfToken
+        },
+        body: JSON.stringify(job)
+    });
+    let status = await response.json();
+
+    if (!response.ok) {
+        throw new Error(status.error);
+    }
+
+    while (status.status === 'queued' || status.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 500));
+        response = await fetch(`/jobs/${status.job_id}`);
+        status = await response.json();
+    }
+
+    if (status.status !== 'done') {
+        throw new Error(status.error || `Job ${status.status}`);
+    }
+    return status;
+}
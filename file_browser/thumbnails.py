@@ -0,0 +1,210 @@
+import os
+import uuid
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+from file_browser import THUMBNAIL_EXTENSIONS
+from file_browser.hashing import get_file_hash
+
+THUMBNAIL_MIMETYPE = "image/webp"
+
+# Thumbnail cache is trimmed to this part of the budget so it is not evicted on every new thumbnail
+EVICT_TO = 0.9
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Thumbnails being rendered: cache path -> future, so concurrent requests render once
+_pending = {}
+_pending_lock = threading.Lock()
+
+# Bytes in the cache folder, counted on first use and updated by this process
+_cache_bytes = None
+_cache_lock = threading.Lock()
+
+
+def render_thumbnail(source_path, thumbnail_path, size):
+    """
+    Decode image, downscale it to fit size x size and save it as WebP.
+    Runs in a worker process, decoding and resizing are CPU bound.
+    Returns the size of the written thumbnail.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        # JPEG is decoded at reduced scale right away, much less work for big photos
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        # Write to temp file and rename so readers never see half written thumbnail
+        temp_path = f"{thumbnail_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            image.save(temp_path, "WEBP", quality=80, method=4)
+            os.replace(temp_path, thumbnail_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    return os.path.getsize(thumbnail_path)
+
+def get_executor():
+    """
+    Process pool for rendering, created on first use.
+    Workers are spawned, not forked, because the server process already runs threads.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=current_app.config['THUMBNAIL_WORKERS'],
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def is_thumbnail_supported(file_name):
+    return Path(file_name).suffix[1:].lower() in THUMBNAIL_EXTENSIONS
+
+def get_thumbnail_path(digest, size):
+    """
+    Thumbnails are addressed by content hash, copies of one image share one thumbnail
+    """
+    return os.path.join(current_app.config['THUMBNAIL_FOLDER'], digest[:2], f"{digest}-{size}.webp")
+
+def get_cache_bytes():
+    """
+    Sum of thumbnail sizes, the folder is walked only once per process
+    """
+    global _cache_bytes
+
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(size for _, _, size in scan_thumbnails())
+        return _cache_bytes
+
+def scan_thumbnails():
+    """
+    Yield (path, mtime, size) of every cached thumbnail with
+    :os.scandir()
+    """
+    root = current_app.config['THUMBNAIL_FOLDER']
+    if not os.path.isdir(root):
+        return
+
+    with os.scandir(root) as folders:
+        for folder in folders:
+            if not folder.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(folder.path) as it:
+                for entry in it:
+                    if entry.name.endswith(".webp"):
+                        try:
+                            file_stat = entry.stat(follow_symlinks=False)
+                        except FileNotFoundError:
+                            continue
+                        yield entry.path, file_stat.st_mtime, file_stat.st_size
+
+def add_cache_bytes(size):
+    """
+    Count new thumbnail and evict least recently used ones when over
+    :app.config['THUMBNAIL_CACHE_MAX_BYTES']
+    """
+    global _cache_bytes
+
+    total = get_cache_bytes()
+    with _cache_lock:
+        _cache_bytes = total = _cache_bytes + size
+
+    if total > current_app.config['THUMBNAIL_CACHE_MAX_BYTES']:
+        evict_thumbnails()
+
+def evict_thumbnails():
+    """
+    Remove oldest used thumbnails until the cache is under
+    :EVICT_TO
+    of its budget. Hits refresh the mtime, so mtime is the last use.
+    Other processes may write thumbnails too, the folder is recounted here.
+    """
+    global _cache_bytes
+
+    with _cache_lock:
+        thumbnails = sorted(scan_thumbnails(), key=lambda thumbnail: thumbnail[1])
+        total = sum(size for _, _, size in thumbnails)
+        limit = current_app.config['THUMBNAIL_CACHE_MAX_BYTES'] * EVICT_TO
+
+        for path, _, size in thumbnails:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        _cache_bytes = total
+
+def submit_thumbnail(source_path, thumbnail_path, size):
+    """
+    Queue rendering unless the same thumbnail is already being rendered.
+    Returns the future of the render.
+    """
+    with _pending_lock:
+        future = _pending.get(thumbnail_path)
+        if future is not None:
+            return future
+
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        future = get_executor().submit(render_thumbnail, source_path, thumbnail_path, size)
+        _pending[thumbnail_path] = future
+
+    # Runs in the pool management thread, outside of the request
+    app = current_app._get_current_object()
+
+    def done(future):
+        with _pending_lock:
+            _pending.pop(thumbnail_path, None)
+        if not future.cancelled() and future.exception() is None:
+            with app.app_context():
+                add_cache_bytes(future.result())
+
+    future.add_done_callback(done)
+    return future
+
+def get_thumbnail(file_path, size=None):
+    """
+    Returns (thumbnail path, file digest), rendering the thumbnail on first request.
+    Raises the render error (e.g. broken image) to the caller.
+    """
+    size = size or current_app.config['THUMBNAIL_SIZE']
+    digest = get_file_hash(file_path)
+    thumbnail_path = get_thumbnail_path(digest, size)
+
+    try:
+        # Mark as recently used for eviction
+        os.utime(thumbnail_path)
+        return thumbnail_path, digest
+    except FileNotFoundError:
+        pass
+
+    submit_thumbnail(file_path, thumbnail_path, size).result(timeout=current_app.config['THUMBNAIL_TIMEOUT'])
+    return thumbnail_path, digest
+
+def queue_thumbnail(file_path, digest, size=None):
+    """
+    Render thumbnail of just uploaded image in background so the first listing has it ready
+    """
+    if not current_app.config['THUMBNAIL_ON_UPLOAD'] or not is_thumbnail_supported(file_path):
+        return
+
+    size = size or current_app.config['THUMBNAIL_SIZE']
+    thumbnail_path = get_thumbnail_path(digest, size)
+
+    if not os.path.exists(thumbnail_path):
+        submit_thumbnail(file_path, thumbnail_path, size)
@@ -0,0 +1,251 @@
+import os
+import time
+import uuid
+import fcntl
+import hashlib
+import contextlib
+import threading
+
+from flask import current_app
+
+from file_browser import db
+from file_browser.models import UploadSession
+from file_browser.hashing import get_hash_algorithm, store_file_hash, HASH_BUFFER_SIZE
+from file_browser.blobstore import is_blob_store_enabled, store_file
+from file_browser.dircache import invalidate_entry
+from file_browser.helpers import is_content_allowed, UPLOAD_TEMP_PREFIX, SNIFF_SIZE
+from file_browser.metrics import count_hashed_bytes
+
+# Running hash of each upload in this process: upload id -> (offset, hash)
+_upload_hashes = {}
+_upload_hashes_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """
+    Raised when a chunk or finalize request does not fit the upload state.
+    :status is the HTTP status to return
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def create_upload(username, target_path, size=None):
+    """
+    Start chunked upload to target_path.
+    The temp file is created in the target folder so finalize is a rename on the same filesystem.
+    """
+    purge_expired_uploads(username)
+
+    upload_id = uuid.uuid4().hex
+    temp_path = os.path.join(os.path.dirname(target_path), f"{UPLOAD_TEMP_PREFIX}{upload_id}.part")
+
+    # Create empty temp file, fail if it somehow exists
+    with open(temp_path, 'xb'):
+        pass
+
+    upload = UploadSession(id=upload_id,
+                           username=username,
+                           target_path=target_path,
+                           temp_path=temp_path,
+                           size=size,
+                           offset=0,
+                           created_at=time.time())
+    db.session.add(upload)
+    db.session.commit()
+
+    with _upload_hashes_lock:
+        _upload_hashes[upload_id] = (0, hashlib.new(get_hash_algorithm()))
+
+    return upload
+
+def get_upload(upload_id, username):
+    """
+    Returns the upload if it belongs to username, otherwise None
+    """
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.username != username:
+        return None
+    return upload
+
+def get_upload_hash(upload):
+    """
+    Returns running hash of the bytes received so far.
+    If this process did not receive the previous chunks (other worker, restart)
+    the temp file is hashed once up to the current offset.
+    """
+    with _upload_hashes_lock:
+        offset, hash = _upload_hashes.get(upload.id, (None, None))
+
+    if offset == upload.offset:
+        return hash
+
+    hash = hashlib.new(get_hash_algorithm())
+    with open(upload.temp_path, 'rb') as f:
+        remaining = upload.offset
+        while remaining > 0 and (chunk := f.read(min(HASH_BUFFER_SIZE, remaining))):
+            hash.update(chunk)
+            remaining -= len(chunk)
+
+    count_hashed_bytes(hash.name, upload.offset - remaining)
+
+    return hash
+
+@contextlib.contextmanager
+def open_upload(upload, mode):
+    """
+    Open the temp file of the upload locked for this request and reload the received offset.
+    Workers share only the database and the file, the flock keeps two requests
+    from writing or finalizing the same upload at once.
+    """
+    try:
+        f = open(upload.temp_path, mode)
+    except FileNotFoundError:
+        # Finalized or cancelled by another request
+        raise UploadError("No such upload!", status=404)
+
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError("Upload is busy with another request", status=409)
+
+        # Another worker may have received chunks since the upload was loaded
+        offset = db.session.execute(db.select(UploadSession.offset)
+                                    .where(UploadSession.id == upload.id)).scalar_one_or_none()
+        if offset is None:
+            raise UploadError("No such upload!", status=404)
+        upload.offset = offset
+
+        yield f
+
+def check_upload_head(upload, head):
+    if not is_content_allowed(upload.target_path, head):
+        raise UploadError("File content does not match its type!", status=415)
+
+def write_upload_chunk(upload, stream, offset, content_length=None):
+    """
+    Stream request body into the temp file at offset and update the hash.
+    The offset must be equal to the bytes already received, anything written after it
+    by an interrupted request is dropped.
+    The type is checked once the first SNIFF_SIZE bytes of the file are known, a short first
+    read does not decide it. Until then the bytes are held back, a wrong file is refused before
+    anything of it is kept. Files shorter than that are checked on finalize.
+    The received position is saved even if the client disconnects so the upload can resume.
+    """
+    if offset != upload.offset:
+        raise UploadError(f"Expected offset {upload.offset}", status=409)
+
+    if upload.size is not None and content_length is not None and offset + content_length > upload.size:
+        raise UploadError("Chunk is bigger than declared file size")
+
+    with open_upload(upload, 'r+b') as f:
+        if offset != upload.offset:
+            raise UploadError(f"Expected offset {upload.offset}", status=409)
+
+        hash = get_upload_hash(upload)
+        written = 0
+
+        # Start of the file received by earlier chunks
+        head = f.read(offset) if offset < SNIFF_SIZE else None
+        held_back = b""
+
+        try:
+            f.seek(offset)
+            f.truncate()
+
+            while chunk := stream.read(HASH_BUFFER_SIZE):
+                if upload.size is not None and offset + written + len(held_back) + len(chunk) > upload.size:
+                    raise UploadError("Chunk is bigger than declared file size")
+
+                if head is not None:
+                    head += chunk
+                    held_back += chunk
+                    if len(head) < SNIFF_SIZE:
+                        continue
+                    check_upload_head(upload, head)
+                    head = None
+                    chunk, held_back = held_back, b""
+
+                f.write(chunk)
+                hash.update(chunk)
+                written += len(chunk)
+
+            # Body ended before SNIFF_SIZE bytes of the file, the next chunk or finalize checks them
+            if held_back:
+                f.write(held_back)
+                hash.update(held_back)
+                written += len(held_back)
+        finally:
+            count_hashed_bytes(hash.name, written)
+            upload.offset = offset + written
+            db.session.commit()
+
+            with _upload_hashes_lock:
+                _upload_hashes[upload.id] = (upload.offset, hash)
+
+    return upload.offset
+
+def finalize_upload(upload, expected_hash=None, file_path=None):
+    """
+    Flush the temp file and rename it to the target path atomically.
+    With the blob store the content is moved to the store and the target path links to it.
+    file_path puts the file elsewhere than the target path, the quarantine of the malware scan.
+    Returns the file digest which is stored for downloads.
+    """
+    with open_upload(upload, 'rb') as f:
+
+        if upload.size is not None and upload.offset != upload.size:
+            raise UploadError(f"Upload incomplete, received {upload.offset} of {upload.size} bytes", status=409)
+
+        # Files shorter than SNIFF_SIZE were not checked while their chunks came in
+        check_upload_head(upload, f.read(SNIFF_SIZE))
+
+        digest = get_upload_hash(upload).hexdigest()
+
+        if expected_hash and expected_hash.lower() != digest:
+            raise UploadError("Hash does not match uploaded data")
+
+        os.fsync(f.fileno())
+
+        file_path = file_path or upload.target_path
+
+        if is_blob_store_enabled():
+            store_file(upload.temp_path, file_path, digest, get_hash_algorithm())
+        else:
+            os.replace(upload.temp_path, file_path)
+            store_file_hash(file_path, digest, get_hash_algorithm())
+        invalidate_entry(file_path)
+
+        discard_upload(upload, remove_temp_file=False)
+    return digest
+
+def discard_upload(upload, remove_temp_file=True):
+    """
+    Remove upload state and its temp file
+    """
+    if remove_temp_file:
+        try:
+            os.remove(upload.temp_path)
+        except FileNotFoundError:
+            pass
+
+    with _upload_hashes_lock:
+        _upload_hashes.pop(upload.id, None)
+
+    db.session.delete(upload)
+    db.session.commit()
+
+def purge_expired_uploads(username):
+    """
+    Remove unfinished uploads of the user older than
+    :app.config['UPLOAD_SESSION_MAX_AGE']
+    """
+    expired_before = time.time() - current_app.config['UPLOAD_SESSION_MAX_AGE']
+    expired = UploadSession.query.filter(UploadSession.username == username,
+                                         UploadSession.created_at < expired_before).all()
+    for upload in expired:
+        discard_upload(upload)
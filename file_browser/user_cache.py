@@ -0,0 +1,129 @@
+import time
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from file_browser import db
+from file_browser.models import User
+from file_browser.metrics import timed
+
+# Columns no other process changes. Usage, quota, provisioning state and the password hash are
+# changed by other workers, left unloaded they are read from the database when a request uses them
+CACHED_COLUMNS = ("id", "username")
+
+
+class UserCache:
+    """
+    LRU of user rows by id with time to live, in front of the Flask-Login user loader.
+
+    Only values of CACHED_COLUMNS are cached, not ORM instances, because instances belong to the
+    session of one request. Code that changes a user row calls
+    :invalidate()
+    so the next request of this process loads it again.
+    """
+
+    def __init__(self, ttl=0, max_entries=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        """
+        Returns cached column values of the user or None
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            values, expires_at = entry
+            if time.monotonic() >= expires_at:
+                self._drop(user_id)
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self._stats['hits'] += 1
+            return values
+
+    def put(self, user):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+
+        values = {key: getattr(user, key) for key in CACHED_COLUMNS}
+
+        with self._lock:
+            if user.id in self._entries:
+                self._drop(user.id)
+
+            self._entries[user.id] = (values, time.monotonic() + self.ttl)
+            self._ids[user.username] = user.id
+
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def invalidate(self, username):
+        with self._lock:
+            user_id = self._ids.get(username)
+            if user_id is not None:
+                self._drop(user_id)
+                self._stats['invalidations'] += 1
+
+    def configure(self, ttl, max_entries):
+        with self._lock:
+            self.ttl = ttl
+            self.max_entries = max_entries
+            self._entries.clear()
+            self._ids.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ids.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+            stats['ttl'] = self.ttl
+            return stats
+
+    def _drop(self, user_id):
+        values, _ = self._entries.pop(user_id)
+        self._ids.pop(values['username'], None)
+
+
+# Disabled until create_app() sizes it from the config
+user_cache = UserCache()
+
+
+@timed("load_user")
+def load_cached_user(user_id):
+    """
+    Returns the user for the Flask-Login loader, from the cache when possible.
+    A cached user is attached to the request session without a query, the columns that are not
+    cached are loaded by one query when the request reads them. If the request commits, the
+    instance is expired and read from the database as usual.
+    """
+    values = user_cache.get(user_id)
+
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.put(user)
+        return user
+
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def invalidate_user(username):
+    user_cache.invalidate(username)
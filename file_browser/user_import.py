@@ -0,0 +1,174 @@
+import os
+import csv
+import json
+import time
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+
+from file_browser import db
+from file_browser.models import User
+from file_browser.provisioning import run_provisioning, PROVISIONING_READY, PROVISIONING_PENDING, PROVISIONING_DEFERRED
+
+# Same limits as the register form
+USERNAME_MIN_LENGTH = 5
+USERNAME_MAX_LENGTH = 15
+
+# Passwords sent to one worker process at a time
+HASH_CHUNK_SIZE = 16
+
+
+def read_user_records(path, file_format=None):
+    """
+    Yield dicts with 'username', 'password' and optional 'quota' from CSV with header or JSON lines file
+    """
+    file_format = file_format or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def validate_user_record(record):
+    """
+    Returns (username, password, quota) or None if the record cannot be imported
+    """
+    if not isinstance(record, dict):
+        return None
+
+    username = (record.get('username') or "").strip()
+    password = record.get('password') or ""
+    quota = record.get('quota') or None
+
+    if not USERNAME_MIN_LENGTH <= len(username) <= USERNAME_MAX_LENGTH or not password:
+        return None
+
+    # Username is a folder name in users_space
+    if secure_filename(username) != username:
+        return None
+
+    try:
+        quota = int(quota) if quota is not None else None
+    except ValueError:
+        return None
+
+    return username, password, quota
+
+def get_existing_usernames(usernames):
+    existing = set()
+    # Stay under SQLite limit of bound parameters
+    for start in range(0, len(usernames), 500):
+        part = usernames[start:start + 500]
+        existing.update(db.session.execute(db.select(User.username).where(User.username.in_(part))).scalars())
+    return existing
+
+def insert_users(rows):
+    """
+    Insert one batch of users in a single transaction
+    """
+    db.session.execute(db.insert(User), rows)
+    db.session.commit()
+
+def import_users(records, batch_size=500, workers=None, provision=True):
+    """
+    Import users and return counters and phase timings for the report.
+
+    Passwords are hashed in a process pool, scrypt is CPU bound and each hash takes tens
+    of milliseconds. Batches are inserted as soon as their hashes are ready while the pool
+    keeps hashing the rest. Folders are provisioned in parallel threads at the end,
+    with provision=False they are made on the first visit of each user.
+    """
+    report = {'read': 0, 'invalid': 0, 'duplicate': 0, 'inserted': 0, 'provisioned': 0, 'failed': 0}
+    started = time.perf_counter()
+
+    users = []
+    seen = set()
+    for record in records:
+        report['read'] += 1
+        user = validate_user_record(record)
+        if user is None:
+            report['invalid'] += 1
+        elif user[0] in seen:
+            report['duplicate'] += 1
+        else:
+            seen.add(user[0])
+            users.append(user)
+
+    existing = get_existing_usernames([username for username, _, _ in users])
+    report['duplicate'] += len(existing)
+    users = [user for user in users if user[0] not in existing]
+    report['read_seconds'] = time.perf_counter() - started
+
+    # Same hashing as the register view. Spawned workers import only werkzeug, not the app
+    hasher = functools.partial(generate_password_hash,
+                               method=current_app.config['PASSWORD_HASH_METHOD'],
+                               salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+    hashing_started = time.perf_counter()
+    provisioning_state = PROVISIONING_PENDING if provision else PROVISIONING_DEFERRED
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        hashes = executor.map(hasher, (password for _, password, _ in users), chunksize=HASH_CHUNK_SIZE)
+
+        batch = []
+        for (username, _, quota), password_hash in zip(users, hashes):
+            batch.append({'username': username, 'password': password_hash, 'storage_quota': quota,
+                          'provisioning_state': provisioning_state})
+            if len(batch) >= batch_size:
+                insert_users(batch)
+                report['inserted'] += len(batch)
+                batch = []
+
+        if batch:
+            insert_users(batch)
+            report['inserted'] += len(batch)
+
+    report['insert_seconds'] = time.perf_counter() - hashing_started
+
+    provisioning_started = time.perf_counter()
+    if provision and users:
+        app = current_app._get_current_object()
+        with ThreadPoolExecutor(max_workers=app.config['PROVISION_WORKERS'],
+                                thread_name_prefix="import-provisioning") as executor:
+            futures = [executor.submit(run_provisioning, app, username) for username, _, _ in users]
+            for future in as_completed(futures):
+                if future.result() == PROVISIONING_READY:
+                    report['provisioned'] += 1
+                else:
+                    report['failed'] += 1
+
+    report['provision_seconds'] = time.perf_counter() - provisioning_started
+    report['total_seconds'] = time.perf_counter() - started
+    return report
+
+@click.command("import-users")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="Input format, guessed from the extension by default.")
+@click.option("--batch-size", default=500, show_default=True, help="Users inserted per transaction.")
+@click.option("--workers", default=os.cpu_count(), show_default=True, help="Password hashing processes.")
+@click.option("--no-provision", is_flag=True, help="Only insert users, folders are created on their first visit.")
+@with_appcontext
+def import_users_command(path, file_format, batch_size, workers, no_provision):
+    """Import users from CSV (username,password[,quota]) or JSON lines file."""
+    report = import_users(read_user_records(path, file_format),
+                          batch_size=batch_size,
+                          workers=workers,
+                          provision=not no_provision)
+
+    click.echo(f"Read {report['read']} records: {report['invalid']} invalid, {report['duplicate']} duplicate")
+    click.echo(f"Inserted {report['inserted']} users in {report['insert_seconds']:.2f}s "
+               f"({report['inserted'] / max(report['insert_seconds'], 1e-9):.0f} users/s)")
+    if not no_provision:
+        click.echo(f"Provisioned {report['provisioned']} folders in {report['provision_seconds']:.2f}s "
+                   f"({report['provisioned'] / max(report['provision_seconds'], 1e-9):.0f} users/s), "
+                   f"{report['failed']} failed")
+    click.echo(f"Done in {report['total_seconds']:.2f}s")
@@ -0,0 +1 @@
+This is the file that contains some random data
\ No newline at end of file
@@ -1,58 +1,177 @@
 import os
+import hmac
 from pathlib import Path
-from file_browser import db, app, basedir, csrf
+from file_browser import db, basedir, csrf
 
-from flask import request, redirect, render_template, flash, url_for, session, abort, send_file, jsonify
-from flask_login import login_required, login_user, logout_user
-from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from flask import request, redirect, render_template, stream_template, flash, url_for, session, abort, jsonify
+from flask import get_flashed_messages, send_file, current_app, Blueprint
+from flask_login import login_required, login_user, logout_user, current_user
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import get_input_stream
 
 from file_browser.models import User
 from file_browser.forms import UserFormLogin, UserFormRegister, CreateFolderForm, UploadFileForm
-from file_browser.helpers import get_user_upload_folder, convert_file_info, get_user_location_path, sanitize_folder_name
-from file_browser.helpers import redirect_url_to_page_and_path
-from file_browser.helpers import allowed_file
-from file_browser.helpers import calculate_file_hash
+from file_browser.helpers import get_user_upload_folder, get_user_location_path, sanitize_folder_name
+from file_browser.helpers import redirect_url_to_page_and_path, holds_user_folder, csrf_header_protected
+from file_browser.helpers import safe_join_user_path, is_upload_temp_path
+from file_browser.helpers import allowed_file, get_readable_byte_size, ICON_FILE_TYPES
+from file_browser.helpers import is_content_allowed, read_upload_head
+from file_browser.hashing import get_file_hash, get_stored_file_hash, get_hash_algorithm
+from file_browser.hashing import save_and_hash_upload, move_file_hashes, forget_file_hash
+from file_browser.listing import list_directory, get_listing_etag, listing_encoder, Listing
+from file_browser.dircache import directory_cache, invalidate_entry
+from file_browser.conditional import send_file_conditional, get_offload_header
+from file_browser.archives import send_folder_archive
+from file_browser.blobstore import is_blob_store_enabled, save_upload_to_blob_store, release_blob_references
+from file_browser.operations import run_batch, resolve_user_path, OperationError
+from file_browser.search import SEARCH_TYPES, search_files, rebuild_user_index_in_background, is_rebuilding
+from file_browser.search import index_entry, unindex_entry, move_entry
+from file_browser.quota import get_remaining_quota, has_quota_for, add_storage_usage, get_user_quota
+from file_browser.thumbnails import get_thumbnail, queue_thumbnail, is_thumbnail_supported, THUMBNAIL_MIMETYPE
+from file_browser.provisioning import queue_provisioning, ensure_provisioned
+from file_browser.passwords import PasswordHashingBusy, allow_login_attempt, hash_password, verify_password
+from file_browser.passwords import needs_rehash, username_limiter
+from file_browser.user_cache import user_cache, invalidate_user
+from file_browser.jobs import JOB_KINDS, start_job, get_job, get_user_jobs, request_cancel
+from file_browser.uploads import UploadError, create_upload, get_upload, write_upload_chunk, finalize_upload, discard_upload
+from file_browser.scanning import is_upload_scan_enabled, new_upload_scan, queue_upload_scan, get_user_scan
+from file_browser.sessions import regenerate_session
+from file_browser.metrics import render_metrics, LOCAL_ADDRESSES, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
-@app.route("/", defaults={"requested_path": ""}, methods=["GET", "POST"])
-@app.route("/<path:requested_path>")
+# Registered on the app by create_app()
+bp = Blueprint("main", __name__)
+
+@bp.route("/", defaults={"requested_path": ""}, methods=["GET", "POST"])
+@bp.route("/<path:requested_path>")
 @login_required
 def index(requested_path):
     
     user = session['user']
+    
+    # Folder of just registered user may still be in the provisioning queue
+    if not ensure_provisioned(current_user):
+        return abort(503)
+    
     create_folder_form = CreateFolderForm()
     upload_file_form = UploadFileForm()
     
     user_folder = get_user_upload_folder() 
-    abs_path = safe_join(user_folder, requested_path)
+    abs_path = safe_join_user_path(user_folder, requested_path)
     
-    if user not in abs_path:
+    if abs_path is None or user not in abs_path:
         flash("Not allowed!")
         return redirect_url_to_page_and_path()
     
     if os.path.isfile(abs_path):
         try:
-            return send_file(abs_path)
+            return send_file_conditional(abs_path)
         
-        except Exception as e:
-            print(e)
+        except Exception:
+            current_app.logger.exception("Sending '%s' failed", abs_path)
 
-    all_files = [convert_file_info(file, user_folder) for file in os.scandir(abs_path)]
+    # Sorting and cursor pagination
+    sort_by = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    cursor = request.args.get("cursor")
+    
+    listing = list_directory(abs_path, user_folder,
+                             sort_by=sort_by,
+                             order=order,
+                             cursor=cursor,
+                             page_size=current_app.config['LISTING_PAGE_SIZE'])
     
     parent_path = os.path.relpath(Path(abs_path).parents[0], user_folder)
     path_indicator = get_user_location_path(parent_path, requested_path)
     
-    return render_template("home/index.html", 
+    storage_quota = get_user_quota(current_user)
+    
+    # Pop flashed messages now, the session is saved before the streamed body is rendered
+    get_flashed_messages()
+    
+    return stream_template("home/index.html", 
                            user_folder=user_folder, 
-                           files=all_files, 
+                           files=listing['files'], 
+                           next_cursor=listing['next_cursor'],
+                           sort_by=listing['sort_by'],
+                           order=listing['order'],
+                           total_files=listing['total'],
+                           requested_path=requested_path,
+                           storage_used=get_readable_byte_size(current_user.storage_used),
+                           storage_quota=get_readable_byte_size(storage_quota) if storage_quota else None,
                            parent_path=parent_path, 
                            path_indicator=path_indicator,
+                           icon_file_types=ICON_FILE_TYPES,
                            create_folder_form=create_folder_form, 
-                           upload_file_form=upload_file_form,
-                           os=os)
+                           upload_file_form=upload_file_form)
+
+# Directory listing for the web client
+@bp.route("/api/listing", defaults={"requested_path": ""})
+@bp.route("/api/listing/<path:requested_path>")
+@login_required
+def listing_api(requested_path):
+    """
+    Same page as the index view as compact JSON encoded with
+    :msgspec
+    Rows are arrays described by
+    :file_browser.listing.ListingRow
+    The ETag is keyed by the directory mtime, a matching If-None-Match
+    is answered with 304 before the directory is read.
+    """
+    user = session['user']
+    
+    if not ensure_provisioned(current_user):
+        return jsonify({'error': 'User folder is not ready!'}), 503
+    
+    user_folder = get_user_upload_folder()
+    abs_path = safe_join_user_path(user_folder, requested_path)
+    
+    if abs_path is None or user not in abs_path or not os.path.isdir(abs_path):
+        return jsonify({'error': 'No such folder!'}), 404
+    
+    sort_by = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    cursor = request.args.get("cursor")
+    page_size = current_app.config['LISTING_PAGE_SIZE']
+    
+    # Storage usage is in the body, uploads to other folders change it too
+    etag = get_listing_etag(abs_path, sort_by, order, cursor, page_size, current_user.storage_used)
+    
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    
+    else:
+        listing = list_directory(abs_path, user_folder,
+                                 sort_by=sort_by,
+                                 order=order,
+                                 cursor=cursor,
+                                 page_size=page_size,
+                                 compact=True)
+        
+        parent_path = os.path.relpath(Path(abs_path).parents[0], user_folder)
+        
+        body = listing_encoder.encode(Listing(
+            path=requested_path.strip("/"),
+            location=get_user_location_path(parent_path, requested_path),
+            parent=None if parent_path == '..' else "" if parent_path == '.' else parent_path,
+            rows=list(listing['files']),
+            next_cursor=listing['next_cursor'],
+            sort=listing['sort_by'],
+            order=listing['order'],
+            total=listing['total'],
+            storage_used=current_user.storage_used,
+            storage_quota=get_user_quota(current_user)))
+        
+        response = current_app.response_class(body, mimetype="application/json")
+    
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response
 
 # Register user
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     
     """
@@ -62,7 +181,8 @@ def register():
     First it checks if there is user with this name in db and if passwords match.
     
     Then for security the password is handled by
-    :werkzeug.security.generate_password_hash()
+    :file_browser.passwords.hash_password()
+    with the configured method in the hashing thread pool
     
     Then new user is created with the credentials specified
     We add it to the database.
@@ -88,28 +208,33 @@ def register():
                 flash("Passwords dont match!")
                 return redirect("register")
             
-            # Hash
-            hash_password = generate_password_hash(user_password, method="scrypt", salt_length=16)
+            # Hash with the configured method in the hashing pool
+            try:
+                password_hash = hash_password(user_password)
+            except PasswordHashingBusy:
+                flash("Server is busy, please try again!")
+                return render_template("auth/register.html", form=form), 503
             
             # Init new User
             new_user = User(
                 username=register_user,
-                password =hash_password
+                password=password_hash
             )
             
-            # Add to db
+            # Add to db, the user folder is created in background
             db.session.add(new_user)
             db.session.commit()
+            queue_provisioning(new_user.username)
             
             flash("Registration succes! Proceed with loging in!")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         
-        redirect(url_for("register"))
+        redirect(url_for("main.register"))
     
     return render_template("auth/register.html", form=form)
 
 # Login user
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     form = UserFormLogin()
     if request.method == "POST":
@@ -118,35 +243,54 @@ def login():
             login_username = form.username.data
             login_password = form.password.data
             
+            # Throttle before the database lookup and before any hashing
+            if not allow_login_attempt(login_username, request.remote_addr or ""):
+                flash("Too many login attempts! Try again later.")
+                return render_template("auth/login.html", form=form), 429
+            
             user = User.query.filter_by(username=login_username).first()
             wrong_credentials_error = "Incorect username or password!"
             
             if not user:
                 flash(wrong_credentials_error)
-                return redirect(url_for("login"))
+                return redirect(url_for("main.login"))
             
-            if not check_password_hash(user.password, login_password):
-                flash(wrong_credentials_error)
-                return redirect(url_for("login"))
+            try:
+                if not verify_password(user.password, login_password):
+                    flash(wrong_credentials_error)
+                    return redirect(url_for("main.login"))
                 
+                # Hash made with old parameters is replaced while the plain password is known
+                if needs_rehash(user.password):
+                    user.password = hash_password(login_password)
+                    db.session.commit()
+                    invalidate_user(user.username)
+            
+            except PasswordHashingBusy:
+                flash("Server is busy, please try again!")
+                return render_template("auth/login.html", form=form), 503
+            
+            username_limiter.reset(login_username.lower())
             login_user(user)
             session["user"] = user.username
+            regenerate_session(session)
             
             flash("Login success!")
-            return redirect(url_for('index')) 
+            return redirect(url_for('main.index')) 
           
     return render_template("auth/login.html", form=form)
 
 # Logout user
-@app.route("/logout", methods=["GET", "POST"])
+@bp.route("/logout", methods=["GET", "POST"])
 @login_required
 def logout():
     logout_user()
+    regenerate_session(session)
     session.clear()
     flash("Logged out!")
     return redirect("login")
 
-@app.route("/return_to_root>", methods=["GET", "POST"])
+@bp.route("/return_to_root>", methods=["GET", "POST"])
 @login_required
 def return_to_root():
     """
@@ -155,8 +299,9 @@ def return_to_root():
     return redirect_url_to_page_and_path()
 
 # Route for create new folder
-@app.route("/create_folder", methods=["GET", "POST"])
+@bp.route("/create_folder", methods=["GET", "POST"])
 @login_required
+@holds_user_folder
 def create_folder():
     """
     Route for creating new folder
@@ -189,6 +334,8 @@ def create_folder():
         # Create new folder or catch exception
         try:
             os.mkdir(abs_path_to_folder)
+            invalidate_entry(abs_path_to_folder)
+            index_entry(abs_path_to_folder)
             flash(f"Folder {sanitized_folder_name} created!")
             return redirect_url_to_page_and_path(current_path)
         
@@ -197,45 +344,86 @@ def create_folder():
             flash("An error occured while creating folder! Please try again!")
             return redirect_url_to_page_and_path()
     
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
      
 # Route to download file
-@app.route("/download/<path:requested_file>")
+@bp.route("/download/<path:requested_file>")
 @login_required
 def download(requested_file):
     
     user = session['user']
     user_folder = get_user_upload_folder()
-    abs_path = safe_join(user_folder, requested_file)
+    abs_path = safe_join_user_path(user_folder, requested_file)
     
-    if user not in user_folder:
+    if abs_path is None or user not in user_folder:
         return abort(404)
     
     # If the path doesnt exists abort
     if not os.path.exists(abs_path):
         flash("File doesnt exists! Redirecting to root!")
         return redirect_url_to_page_and_path()
+    
+    # Folders are streamed as archive, ?format=zip|tar and ?compression=auto|store
+    if os.path.isdir(abs_path):
+        return send_folder_archive(abs_path,
+                                   request.args.get("format", "zip"),
+                                   request.args.get("compression", "auto"))
  
     if os.path.isfile(abs_path):
         try:
-            # Send the file to the client
-            response = send_file(abs_path, as_attachment=True)
+            # Stored hash of the file, it is calculated only if the file changed since upload.
+            # When the front proxy sends the file the worker does not read it, only a stored hash is used
+            # and without one the ETag is made from inode, size and mtime
+            if get_offload_header(abs_path) is not None:
+                file_hash = get_stored_file_hash(abs_path)
+            else:
+                file_hash = get_file_hash(abs_path)
 
-            # Calculate hash of the downloaded file
-            file_hash = calculate_file_hash(abs_path)
+            # Send the file to the client, the hash is also the ETag for conditional and range requests
+            response = send_file_conditional(abs_path, as_attachment=True, etag=file_hash)
 
             # Add file hash to response headers
-            response.headers['X-File-Hash'] = file_hash
+            if file_hash is not None:
+                response.headers['X-File-Hash'] = file_hash
+                response.headers['X-File-Hash-Algorithm'] = get_hash_algorithm()
 
             return response
         
-        except Exception as e:
-            print(e)
+        except Exception:
+            current_app.logger.exception("Download of '%s' failed", abs_path)
+
+# Downscaled preview of image file
+@bp.route("/thumbnail/<path:requested_file>")
+@login_required
+def thumbnail(requested_file):
+    """
+    Serve WebP thumbnail of image file, rendered on first request.
+    The listing adds ?v=<file version> to the url so the response can be cached for a year,
+    a changed file gets a new url.
+    """
+    user_folder = get_user_upload_folder()
+    abs_path = safe_join_user_path(user_folder, requested_file)
+    
+    if abs_path is None or not os.path.isfile(abs_path) or not is_thumbnail_supported(abs_path):
+        return abort(404)
+    
+    try:
+        thumbnail_path, digest = get_thumbnail(abs_path)
+    except Exception:
+        current_app.logger.exception("Thumbnail of '%s' failed", abs_path)
+        return abort(404)
+    
+    response = send_file(thumbnail_path, mimetype=THUMBNAIL_MIMETYPE, etag=digest, conditional=True, max_age=365 * 24 * 60 * 60)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = 'v' in request.args
+    return response
 
 # Verify file integrity after each request
-@app.after_request
+@bp.after_request
 def verify_file(response):
-    if request.endpoint == "download":
+    # 304 and 416 send no file, there is nothing to report
+    if request.endpoint == "main.download" and 'X-File-Hash' in response.headers and response.status_code in (200, 206):
         # Get user path and file name
         user_folder = get_user_upload_folder()
         file_name = request.view_args["requested_file"]
@@ -243,8 +431,9 @@ def verify_file(response):
         # Build path
         file_path = os.path.join(user_folder, file_name)
         
-        # Calculate the original file hash and get the stored hash in the headers
-        original_file_hash = calculate_file_hash(file_path)
+        # The stored hash is returned only if the file was not changed while the response was made
+        # so the check needs one stat() instead of reading the file again
+        original_file_hash = get_stored_file_hash(file_path)
         downloaded_file_hash = response.headers['X-File-Hash']
         
         # Compare original file hash with downloaded
@@ -259,8 +448,9 @@ def verify_file(response):
     return response
 
 # Route for upload file
-@app.route("/upload_file", methods=["GET", "POST"])
+@bp.route("/upload_file", methods=["GET", "POST"])
 @login_required
+@holds_user_folder
 def upload_file():
     """
     This route handles file upload
@@ -271,6 +461,11 @@ def upload_file():
     Max size is 15mb
     """
     if request.method == 'POST':
+        # Refuse before the body is parsed, parsing would already write it to a temp file
+        if not has_quota_for(session['user'], request.content_length or 0):
+            flash("Storage quota exceeded!")
+            return redirect_url_to_page_and_path()
+        
         user_folder = get_user_upload_folder()
         current_path = request.form.get("folder_path")
         
@@ -290,9 +485,39 @@ def upload_file():
         
         if file and allowed_file(file.filename):
             secured_filename = secure_filename(file.filename)
+            
+            # Type is sniffed from the first bytes werkzeug already has, the upload is not read again
+            if not is_content_allowed(secured_filename, read_upload_head(file)):
+                flash("File content does not match its type!")
+                return redirect_url_to_page_and_path(current_path)
+            
             # Construct the abs path
             abs_path_for_upload = safe_join(user_folder, *folder_level)
-            file.save(os.path.join(abs_path_for_upload, secured_filename))
+            upload_path = os.path.join(abs_path_for_upload, secured_filename)
+            
+            # Saved to quarantine, the scanner renames it to upload_path when it is clean
+            if is_upload_scan_enabled():
+                scan_id, quarantine_path = new_upload_scan()
+                if is_blob_store_enabled():
+                    digest = save_upload_to_blob_store(file, quarantine_path)
+                else:
+                    digest = save_and_hash_upload(file, quarantine_path)
+                add_storage_usage(session['user'], os.path.getsize(quarantine_path))
+                queue_upload_scan(scan_id, session['user'], upload_path, quarantine_path, digest)
+                flash(f"File {secured_filename} is being checked, it will show up when the check passes.")
+                return redirect_url_to_page_and_path(current_path)
+            
+            replaced = os.path.isfile(upload_path)
+            replaced_size = os.path.getsize(upload_path) if replaced else 0
+            # Save and hash in one pass, or link to the stored blob of the same content
+            if is_blob_store_enabled():
+                digest = save_upload_to_blob_store(file, upload_path)
+            else:
+                digest = save_and_hash_upload(file, upload_path)
+            queue_thumbnail(upload_path, digest)
+            add_storage_usage(session['user'], os.path.getsize(upload_path) - replaced_size)
+            invalidate_entry(os.path.join(abs_path_for_upload, secured_filename))
+            index_entry(os.path.join(abs_path_for_upload, secured_filename))
             return redirect_url_to_page_and_path(current_path)
         
         else:
@@ -300,9 +525,155 @@ def upload_file():
     
     return redirect_url_to_page_and_path()
 
+# Start chunked upload
+@bp.route("/uploads", methods=["POST"])
+@login_required
+@holds_user_folder
+def create_chunked_upload():
+    """
+    Start resumable upload for files bigger than the form upload limit.
+    Expects json with 'file_name', 'folder_path' and optional 'size' in bytes.
+    The chunks are sent with PUT /uploads/<upload_id>?offset=N and the upload is
+    completed with POST /uploads/<upload_id>/finalize
+    """
+    file_name = request.json.get('file_name', '')
+    current_path = request.json.get('folder_path', '/')
+    size = request.json.get('size')
+    
+    if not allowed_file(file_name):
+        return jsonify({'error': 'File format not supported!'}), 400
+    
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({'error': 'Invalid size!'}), 400
+    
+    if size is not None and not has_quota_for(session['user'], size):
+        return jsonify({'error': 'Storage quota exceeded!'}), 413
+    
+    # Construct the abs path
+    user_folder = get_user_upload_folder()
+    folder_level = current_path[1:].split("/")
+    target_path = safe_join(user_folder, *folder_level, secure_filename(file_name))
+    
+    if target_path is None or not os.path.isdir(os.path.dirname(target_path)):
+        return jsonify({'error': 'No such folder!'}), 400
+    
+    upload = create_upload(session['user'], target_path, size)
+    
+    return jsonify({'upload_id': upload.id, 'offset': upload.offset, 'size': upload.size}), 201
+
+# Status of chunked upload, used to resume
+@bp.route("/uploads/<upload_id>", methods=["GET"])
+@login_required
+def chunked_upload_status(upload_id):
+    upload = get_upload(upload_id, session['user'])
+    if upload is None:
+        return jsonify({'error': 'No such upload!'}), 404
+    
+    return jsonify({'upload_id': upload.id, 'offset': upload.offset, 'size': upload.size}), 200
+
+# Receive one chunk
+@bp.route("/uploads/<upload_id>", methods=["PUT"])
+@csrf_header_protected
+@login_required
+@holds_user_folder
+def upload_chunk(upload_id):
+    """
+    The request body is streamed to the temp file without being buffered in memory.
+    On offset mismatch 409 is returned with the offset the server expects.
+    """
+    upload = get_upload(upload_id, session['user'])
+    if upload is None:
+        return jsonify({'error': 'No such upload!'}), 404
+    
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Missing offset!'}), 400
+    
+    # Usage is counted on finalize, the chunk is checked against what the user has left
+    if not has_quota_for(session['user'], offset + (request.content_length or 0)):
+        return jsonify({'error': 'Storage quota exceeded!', 'offset': upload.offset}), 413
+    
+    # Read the raw body, only this chunk is limited not the whole file
+    stream = get_input_stream(request.environ, max_content_length=current_app.config['UPLOAD_CHUNK_MAX_SIZE'])
+    
+    try:
+        new_offset = write_upload_chunk(upload, stream, offset, request.content_length)
+    except UploadError as error:
+        return jsonify({'error': error.message, 'offset': upload.offset}), error.status
+    
+    return jsonify({'upload_id': upload.id, 'offset': new_offset, 'size': upload.size}), 200
+
+# Complete chunked upload
+@bp.route("/uploads/<upload_id>/finalize", methods=["POST"])
+@login_required
+@holds_user_folder
+def finalize_chunked_upload(upload_id):
+    upload = get_upload(upload_id, session['user'])
+    if upload is None:
+        return jsonify({'error': 'No such upload!'}), 404
+    
+    expected_hash = (request.get_json(silent=True) or {}).get('hash')
+    
+    target_path = upload.target_path
+    replaced_size = os.path.getsize(target_path) if os.path.isfile(target_path) else 0
+    
+    if is_upload_scan_enabled():
+        scan_id, quarantine_path = new_upload_scan()
+        try:
+            file_hash = finalize_upload(upload, expected_hash, quarantine_path)
+        except UploadError as error:
+            return jsonify({'error': error.message, 'offset': upload.offset}), error.status
+        
+        add_storage_usage(session['user'], os.path.getsize(quarantine_path))
+        queue_upload_scan(scan_id, session['user'], target_path, quarantine_path, file_hash)
+        # Accepted, the file is released when the scan passes. GET /uploads/scans/<scan_id> tells the state
+        return jsonify({'success': True, 'hash': file_hash, 'scan_id': scan_id}), 202
+    
+    try:
+        file_hash = finalize_upload(upload, expected_hash)
+    except UploadError as error:
+        return jsonify({'error': error.message, 'offset': upload.offset}), error.status
+    
+    index_entry(target_path)
+    queue_thumbnail(target_path, file_hash)
+    add_storage_usage(session['user'], os.path.getsize(target_path) - replaced_size)
+    
+    return jsonify({'success': True, 'hash': file_hash}), 200
+
+# Cancel chunked upload
+@bp.route("/uploads/<upload_id>", methods=["DELETE"])
+@login_required
+@holds_user_folder
+def cancel_chunked_upload(upload_id):
+    upload = get_upload(upload_id, session['user'])
+    if upload is None:
+        return jsonify({'error': 'No such upload!'}), 404
+    
+    discard_upload(upload)
+    return jsonify({'success': True}), 200
+
+# State of malware scan of quarantined upload
+@bp.route("/uploads/scans/<scan_id>", methods=["GET"])
+@login_required
+def upload_scan_state(scan_id):
+    """
+    State is pending or scanning until the scanner is done, then clean (the file is in place),
+    infected (the file was removed), failed (the file stays in quarantine) or missing
+    (the file or its folder was gone before it was released)
+    """
+    scan = get_user_scan(scan_id, session['user'])
+    if scan is None:
+        return jsonify({'error': 'No such upload!'}), 404
+    
+    return jsonify({'scan_id': scan.id,
+                    'state': scan.state,
+                    'file_name': os.path.basename(scan.target_path),
+                    'signature': scan.signature}), 200
+
 # Rename file or folder
-@app.route("/rename_file", methods=["POST"])
+@bp.route("/rename_file", methods=["POST"])
 @login_required
+@holds_user_folder
 def rename():
     if request.method == "POST":
         old_file_name = request.json.get('old_file_name')
@@ -315,6 +686,10 @@ def rename():
         folder_level = path_to_file[1:].split("/")
         full_path_to_file = os.path.join(user_folder, *folder_level, old_file_name)
         
+        # Upload temp and quarantine files are not user files
+        if is_upload_temp_path(full_path_to_file):
+            return jsonify({'error': 'No such file!'}), 400
+        
         # Secure file name and add the original extension
         secured_new_file_name = sanitize_folder_name(new_file_name)
         
@@ -336,6 +711,10 @@ def rename():
         # Catch any error
         try:
             os.rename(full_path_to_file, new_path_to_file)
+            invalidate_entry(full_path_to_file)
+            invalidate_entry(new_path_to_file)
+            move_file_hashes(full_path_to_file, new_path_to_file)
+            move_entry(full_path_to_file, new_path_to_file)
         except Exception as e:
             flash("Error while renaming!")
         
@@ -345,8 +724,9 @@ def rename():
         return jsonify({'error': 'Method not allowed'}), 400
     
 # Route for deleting file
-@app.route("/delete_file", methods=["POST"])
+@bp.route("/delete_file", methods=["POST"])
 @login_required
+@holds_user_folder
 def delete_file():
     
     if request.method == "POST":
@@ -359,7 +739,7 @@ def delete_file():
         folder_level = path_to_file[1:].split("/")
         full_path_to_file = os.path.join(user_folder, *folder_level, file_to_delete)
         
-        if not user in full_path_to_file:
+        if not user in full_path_to_file or is_upload_temp_path(full_path_to_file):
             flash("Not allowed!")
             return abort(404)
         
@@ -369,7 +749,11 @@ def delete_file():
         
         try:
             if os.path.isfile(full_path_to_file):
+                deleted_stat = os.stat(full_path_to_file)
                 os.remove(full_path_to_file)
+                forget_file_hash(full_path_to_file)
+                add_storage_usage(user, -deleted_stat.st_size)
+                release_blob_references([deleted_stat])
                 
             elif os.path.isdir(full_path_to_file):
                 
@@ -386,6 +770,169 @@ def delete_file():
             flash("File cannot be deleted! Sorry")
             return jsonify({'error': 'Error!'}), 400  
         
+        invalidate_entry(full_path_to_file)
+        unindex_entry(full_path_to_file)
+        
         return jsonify({'success': True}), 200
     
-    return jsonify({'error': 'Method not allowed'}), 400
\ No newline at end of file
+    return jsonify({'error': 'Method not allowed'}), 400
+
+# Run many file operations in one request
+@bp.route("/batch", methods=["POST"])
+@login_required
+@holds_user_folder
+def batch():
+    """
+    Accepts json {'operations': [...]} where each operation is one of
+    {'op': 'delete', 'path': ...}
+    {'op': 'rename', 'path': ..., 'new_name': ...}
+    {'op': 'move' or 'copy', 'path': ..., 'destination': <folder>}
+    {'op': 'mkdir', 'path': <parent folder>, 'name': ...}
+    Paths are relative to the user root like '/home/username/file.txt'.
+    Returns one result per operation in the same order.
+    """
+    operations = (request.get_json(silent=True) or {}).get('operations')
+    
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'No operations!'}), 400
+    
+    if len(operations) > current_app.config['BATCH_MAX_OPERATIONS']:
+        return jsonify({'error': 'Too many operations!'}), 400
+    
+    user_folder = get_user_upload_folder()
+    results = run_batch(user_folder, operations, session['user'])
+    
+    return jsonify({'success': all(result['success'] for result in results), 'results': results}), 200
+
+# Start background recursive delete or copy
+@bp.route("/jobs", methods=["POST"])
+@login_required
+@holds_user_folder
+def create_job():
+    """
+    Accepts json {'op': 'delete', 'path': ...} or {'op': 'copy', 'path': ..., 'destination': <folder>}
+    Folders are deleted or copied with all their content in background.
+    Progress is read from GET /jobs/<job_id>
+    """
+    data = request.get_json(silent=True) or {}
+    op = data.get('op')
+    
+    if op not in JOB_KINDS:
+        return jsonify({'error': f"Unknown operation '{op}'!"}), 400
+    
+    user_folder = get_user_upload_folder()
+    
+    try:
+        source = resolve_user_path(user_folder, data.get('path'))
+        destination = resolve_user_path(user_folder, data.get('destination'), allow_root=True) if op == "copy" else None
+    except OperationError as error:
+        return jsonify({'error': error.message}), 400
+    
+    if not os.path.lexists(source):
+        return jsonify({'error': 'No such file!'}), 400
+    
+    if op == "copy":
+        if not os.path.isdir(destination):
+            return jsonify({'error': 'No such folder!'}), 400
+        
+        if Path(destination).is_relative_to(source):
+            return jsonify({'error': 'Cannot copy folder into itself!'}), 400
+        
+        if os.path.lexists(os.path.join(destination, os.path.basename(source))):
+            return jsonify({'error': f"'{os.path.basename(source)}' already exists in destination!"}), 400
+    
+    job = start_job(session['user'], op, source, destination)
+    
+    return jsonify(job.to_dict(user_folder)), 202
+
+# List jobs of the user
+@bp.route("/jobs", methods=["GET"])
+@login_required
+def list_jobs():
+    user_folder = get_user_upload_folder()
+    jobs = get_user_jobs(session['user'])
+    
+    return jsonify({'jobs': [job.to_dict(user_folder) for job in jobs]}), 200
+
+# Job progress and status
+@bp.route("/jobs/<job_id>", methods=["GET"])
+@login_required
+def job_status(job_id):
+    job = get_job(job_id, session['user'])
+    if job is None:
+        return jsonify({'error': 'No such job!'}), 404
+    
+    return jsonify(job.to_dict(get_user_upload_folder())), 200
+
+# Cancel job
+@bp.route("/jobs/<job_id>/cancel", methods=["POST"])
+@login_required
+def cancel_job(job_id):
+    job = get_job(job_id, session['user'])
+    if job is None:
+        return jsonify({'error': 'No such job!'}), 404
+    
+    request_cancel(job)
+    return jsonify(job.to_dict(get_user_upload_folder())), 200
+
+# Search files by name in the whole user tree
+@bp.route("/search")
+@login_required
+def search():
+    """
+    Query parameters
+    :q - text to search
+    :type - 'prefix', 'substring' (default) or 'ext'
+    :limit - max results, default 100
+    The first search of a user builds the index in background and returns 'indexing': True
+    """
+    query = request.args.get('q', '').strip()
+    search_type = request.args.get('type', 'substring')
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    user = session['user']
+    
+    if not query or search_type not in SEARCH_TYPES:
+        return jsonify({'error': 'Invalid search!'}), 400
+    
+    results = search_files(user, query, search_type, limit)
+    
+    if results is None:
+        rebuild_user_index_in_background(user)
+        results = []
+    
+    return jsonify({'results': results, 'indexing': is_rebuilding(user)}), 200
+
+# Storage usage of the user
+@bp.route("/quota")
+@login_required
+def quota():
+    return jsonify({'used': current_user.storage_used,
+                    'quota': get_user_quota(current_user),
+                    'remaining': get_remaining_quota(current_user.username)}), 200
+
+# Directory listing cache counters
+@bp.route("/cache_stats")
+@login_required
+def cache_stats():
+    stats = directory_cache.stats()
+    stats['user_cache'] = user_cache.stats()
+    return jsonify(stats), 200
+
+@bp.route("/metrics")
+def metrics():
+    """
+    Prometheus metrics summed over the workers writing to METRICS_FOLDER.
+    Needs the METRICS_TOKEN bearer token, without a token only local scrapes not sent through the proxy get them.
+    """
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(401)
+    elif request.remote_addr not in LOCAL_ADDRESSES or 'X-Forwarded-For' in request.headers:
+        abort(403)
+
+    return current_app.response_class(render_metrics(current_app.config['METRICS_FOLDER']),
+                                      mimetype=METRICS_CONTENT_TYPE)
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import multiprocessing
+
+# Production server settings, start with:
+# gunicorn -c gunicorn.conf.py wsgi:app
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+
+# Processes for CPU work (password hashing, templates), threads for requests waiting on disk
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 4))
+
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Restart workers now and then so memory of big listings is given back
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+# The app must be created in each worker, not in the master. The background threads
+# (search crawler, quota reconciler, session cleaner) take lock files in create_app() so only
+# one worker runs each of them, in a preloaded master they would hold the locks and die at fork.
+preload_app = False
+
+accesslog = os.getenv('WEB_ACCESS_LOG', '-')
+errorlog = '-'
+
+DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'file_browser', 'file_browser.db')
+
+# Workers write their metrics here and /metrics sums them, the workers read it from the environment they inherit
+METRICS_FOLDER = os.environ.setdefault('METRICS_FOLDER', os.path.join(os.path.dirname(DATABASE_PATH), 'metrics'))
+
+
+def on_starting(server):
+    """
+    Switch the database to WAL before any worker opens it and check the pool is big enough.
+    Runs in the master with plain sqlite3, the app is not imported here.
+    """
+    connection = sqlite3.connect(DATABASE_PATH, timeout=30)
+    try:
+        journal_mode = connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    finally:
+        connection.close()
+
+    if journal_mode != 'wal':
+        server.log.warning("SQLite database is in '%s' journal mode, WAL is not supported on this "
+                           "filesystem. Writers of all workers will block readers.", journal_mode)
+
+    pool = int(os.getenv('DB_POOL_SIZE', 10)) + int(os.getenv('DB_MAX_OVERFLOW', 10))
+    if threads > pool:
+        server.log.warning("WEB_THREADS=%s is more than the database pool of %s connections per worker, "
+                           "requests will wait for connections.", threads, pool)
+
+    server.log.info("SQLite journal mode %s, %s workers x %s threads", journal_mode, workers, threads)
+
+    # Counters start from zero with the server, snapshots of the previous run are dropped
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+    for entry in os.scandir(METRICS_FOLDER):
+        if entry.name.endswith(('.json', '.tmp')):
+            os.remove(entry.path)
+
+
+def child_exit(server, worker):
+    """
+    Keep the counts of an exited worker in the retired snapshot, restarted workers do not lower the totals
+    """
+    from file_browser.metrics import retire_snapshot
+
+    try:
+        retire_snapshot(METRICS_FOLDER, worker.pid)
+    except (OSError, ValueError) as error:
+        server.log.warning("Retiring metrics of worker %s failed: %s", worker.pid, error)
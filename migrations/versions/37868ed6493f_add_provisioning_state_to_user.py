@@ -0,0 +1,32 @@
+"""add provisioning state to user
+
+Revision ID: 37868ed6493f
+Revises: fabdafac26e0
+Create Date: 2026-10-18 13:48:14.368671
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '37868ed6493f'
+down_revision = 'fabdafac26e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases made by db.create_all() after the column was added have it already
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('user')}
+    if 'provisioning_state' in columns:
+        return
+
+    # Users registered before background provisioning have their folder, existing rows are ready
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('provisioning_state', sa.String(), nullable=False, server_default="ready"))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('provisioning_state')
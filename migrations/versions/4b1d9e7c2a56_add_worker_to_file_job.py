@@ -0,0 +1,34 @@
+"""add worker to file job
+
+Revision ID: 4b1d9e7c2a56
+Revises: 37868ed6493f
+Create Date: 2026-10-18 16:02:37.514208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1d9e7c2a56'
+down_revision = '37868ed6493f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The table is made by db.create_all(), with the column when it was created after it was added
+    inspector = sa.inspect(op.get_bind())
+    if 'file_job' not in inspector.get_table_names():
+        return
+    if 'worker' in {column['name'] for column in inspector.get_columns('file_job')}:
+        return
+
+    # Unfinished jobs without a worker are marked interrupted by the job sweep
+    with op.batch_alter_table('file_job') as batch_op:
+        batch_op.add_column(sa.Column('worker', sa.String(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file_job') as batch_op:
+        batch_op.drop_column('worker')
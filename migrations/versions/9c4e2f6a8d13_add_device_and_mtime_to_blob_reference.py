@@ -0,0 +1,37 @@
+"""add device and mtime to blob reference
+
+Revision ID: 9c4e2f6a8d13
+Revises: 4b1d9e7c2a56
+Create Date: 2026-10-18 16:41:09.827315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e2f6a8d13'
+down_revision = '4b1d9e7c2a56'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The table is made by db.create_all(), with the columns when it was created after they were added
+    inspector = sa.inspect(op.get_bind())
+    if 'blob_reference' not in inspector.get_table_names():
+        return
+    columns = {column['name'] for column in inspector.get_columns('blob_reference')}
+
+    # Existing rows keep None and match by inode alone, like before
+    with op.batch_alter_table('blob_reference') as batch_op:
+        if 'device' not in columns:
+            batch_op.add_column(sa.Column('device', sa.BigInteger(), nullable=True))
+        if 'mtime_ns' not in columns:
+            batch_op.add_column(sa.Column('mtime_ns', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('blob_reference') as batch_op:
+        batch_op.drop_column('mtime_ns')
+        batch_op.drop_column('device')
@@ -0,0 +1,55 @@
+"""add storage usage and quota to user
+
+Revision ID: fabdafac26e0
+Revises: 
+Create Date: 2026-10-18 13:47:43.220727
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fabdafac26e0'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def get_user_columns():
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns('user')}
+
+
+def upgrade():
+    # Databases made by db.create_all() after the columns were added have them already
+    columns = get_user_columns()
+
+    with op.batch_alter_table('user') as batch_op:
+        if 'storage_used' not in columns:
+            batch_op.add_column(sa.Column('storage_used', sa.BigInteger(), nullable=False, server_default="0"))
+        if 'storage_quota' not in columns:
+            batch_op.add_column(sa.Column('storage_quota', sa.BigInteger(), nullable=True))
+
+    if 'storage_used' in columns:
+        return
+
+    # Usage of existing users is measured from their folders, like 'flask quota-reconcile' does
+    from file_browser.quota import measure_user_storage
+    from file_browser.helpers import get_user_root
+
+    connection = op.get_bind()
+    user = sa.table('user', sa.column('username', sa.String), sa.column('storage_used', sa.BigInteger))
+
+    for username in connection.execute(sa.select(user.c.username)).scalars().all():
+        if os.path.isdir(get_user_root(username)):
+            connection.execute(user.update()
+                               .where(user.c.username == username)
+                               .values(storage_used=measure_user_storage(username)))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('storage_quota')
+        batch_op.drop_column('storage_used')
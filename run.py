@@ -1,4 +1,6 @@
-from file_browser import app
+from file_browser import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True)
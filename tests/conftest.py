@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from file_browser import create_app, db
+from file_browser.models import User
+
+USERNAME = "tester1"
+
+
+@pytest.fixture
+def app(tmp_path):
+    """
+    App with its database, users_space and caches in a temp folder and no background threads
+    """
+    app = create_app({'TESTING': True,
+                      'BACKGROUND_SERVICES': False,
+                      'WTF_CSRF_ENABLED': False,
+                      'SQLALCHEMY_DATABASE_URI': "sqlite:///" + str(tmp_path / "test.db"),
+                      'UPLOAD_FOLDER': str(tmp_path / "users_space"),
+                      'SEARCH_INDEX_FOLDER': str(tmp_path / "search_index"),
+                      'THUMBNAIL_FOLDER': str(tmp_path / "thumbnails"),
+                      'THUMBNAIL_ON_UPLOAD': False,
+                      'BLOB_STORE_FOLDER': str(tmp_path / "blob_store"),
+                      'PROVISION_TEMPLATE_FOLDER': str(tmp_path / "user_template"),
+                      'SESSION_BACKEND': "cookie",
+                      'LISTING_CACHE_INOTIFY': False,
+                      'LOGIN_LIMIT_DATABASE': str(tmp_path / "login_limits.db"),
+                      'USER_LOCK_FOLDER': str(tmp_path / "user_locks"),
+                      'QUARANTINE_FOLDER': str(tmp_path / "quarantine"),
+                      'JOB_LOCK_FOLDER': str(tmp_path / "job_locks"),
+                      'PASSWORD_HASH_METHOD': "pbkdf2:sha256:1000"})
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def user_root(app):
+    """
+    Ready user with an empty root folder, returns the folder path
+    """
+    root = os.path.join(app.config['UPLOAD_FOLDER'], USERNAME)
+    os.makedirs(root)
+
+    with app.app_context():
+        db.session.add(User(username=USERNAME, password="x", provisioning_state="ready"))
+        db.session.commit()
+
+    return root
+
+
+@pytest.fixture
+def client(app, user_root):
+    """
+    Test client logged in as USERNAME
+    """
+    client = app.test_client()
+    with app.app_context():
+        user_id = User.query.filter_by(username=USERNAME).one().id
+
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+        session['user'] = USERNAME
+
+    return client
+
+
+def get_storage_used(app):
+    with app.app_context():
+        return User.query.filter_by(username=USERNAME).one().storage_used
@@ -0,0 +1,79 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from file_browser.helpers import UPLOAD_TEMP_PREFIX
+
+TEXT = b"some text that deflates well\n" * 1000
+IMAGE = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def project(user_root):
+    """
+    project/ with notes.txt, an empty folder, images/photo.jpg, a symlink and an upload temp file
+    """
+    project = os.path.join(user_root, "project")
+    os.makedirs(os.path.join(project, "images"))
+    os.makedirs(os.path.join(project, "empty"))
+    with open(os.path.join(project, "notes.txt"), "wb") as f:
+        f.write(TEXT)
+    with open(os.path.join(project, "images", "photo.jpg"), "wb") as f:
+        f.write(IMAGE)
+    with open(os.path.join(project, f"{UPLOAD_TEMP_PREFIX}abc.part"), "wb") as f:
+        f.write(b"unfinished")
+    os.symlink("/etc/passwd", os.path.join(project, "passwd"))
+    return project
+
+
+def download_archive(client, **query):
+    response = client.get("/download/project", query_string=query)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == "no-store"
+    return response
+
+
+def test_zip_archive(client, project):
+    response = download_archive(client)
+
+    assert response.mimetype == "application/zip"
+    assert 'filename=project.zip' in response.headers['Content-Disposition']
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert sorted(archive.namelist()) == ["project/empty/", "project/images/", "project/images/photo.jpg",
+                                              "project/notes.txt"]
+        assert archive.read("project/notes.txt") == TEXT
+        assert archive.read("project/images/photo.jpg") == IMAGE
+        # Already compressed types are stored
+        assert archive.getinfo("project/notes.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert archive.getinfo("project/images/photo.jpg").compress_type == zipfile.ZIP_STORED
+
+def test_zip_archive_without_compression(client, project):
+    response = download_archive(client, compression="store")
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.getinfo("project/notes.txt").compress_type == zipfile.ZIP_STORED
+        assert archive.read("project/notes.txt") == TEXT
+
+def test_tar_archive(client, project):
+    response = download_archive(client, format="tar")
+
+    assert response.mimetype == "application/x-tar"
+    assert len(response.data) % tarfile.RECORDSIZE == 0
+
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert sorted(archive.getnames()) == ["project/empty", "project/images", "project/images/photo.jpg",
+                                              "project/notes.txt"]
+        assert archive.getmember("project/images").isdir()
+        assert archive.extractfile("project/notes.txt").read() == TEXT
+        assert archive.extractfile("project/images/photo.jpg").read() == IMAGE
+
+def test_unknown_format_sends_zip(client, project):
+    response = download_archive(client, format="rar", compression="best")
+
+    assert response.mimetype == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.testzip() is None
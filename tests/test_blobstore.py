@@ -0,0 +1,113 @@
+import io
+import os
+import time
+
+import pytest
+
+from file_browser import db
+from file_browser.models import Blob, BlobReference
+from file_browser.blobstore import collect_garbage
+
+CONTENT = b"same content uploaded twice\n" * 100
+
+
+@pytest.fixture(params=["hardlink", "reflink"])
+def blob_app(app, request):
+    """
+    Blob store on. Without reflink support the reflink mode copies, the file gets its own inode
+    """
+    app.config.update({'BLOB_STORE_ENABLED': True, 'BLOB_LINK_MODE': request.param})
+    return app
+
+@pytest.fixture
+def folder(user_root):
+    folder = os.path.join(user_root, "docs")
+    os.makedirs(folder)
+    return folder
+
+
+def upload(client, name, content=CONTENT):
+    client.post("/upload_file", data={'folder_path': "/docs", 'upload_file_name': (io.BytesIO(content), name)},
+                content_type="multipart/form-data")
+
+def delete(client, name):
+    results = client.post("/batch", json={'operations': [{'op': "delete", 'path': f"/docs/{name}"}]}).get_json()['results']
+    assert results[0]['success']
+
+def get_blobs(app):
+    with app.app_context():
+        return [(blob.digest, blob.refcount) for blob in Blob.query.all()]
+
+def get_blob_files(app):
+    return [name for _, _, names in os.walk(app.config['BLOB_STORE_FOLDER']) for name in names]
+
+
+def test_same_content_is_stored_once(blob_app, client, folder):
+    upload(client, "a.txt")
+    upload(client, "b.txt")
+
+    (digest, refcount), = get_blobs(blob_app)
+    assert refcount == 2
+    assert get_blob_files(blob_app) == [digest]
+    for name in ("a.txt", "b.txt"):
+        with open(os.path.join(folder, name), "rb") as f:
+            assert f.read() == CONTENT
+
+def test_blob_is_removed_with_last_file(blob_app, client, folder):
+    upload(client, "a.txt")
+    upload(client, "b.txt")
+
+    delete(client, "a.txt")
+    assert [refcount for _, refcount in get_blobs(blob_app)] == [1]
+
+    delete(client, "b.txt")
+    assert get_blobs(blob_app) == []
+    assert get_blob_files(blob_app) == []
+    with blob_app.app_context():
+        assert BlobReference.query.count() == 0
+
+def test_overwritten_file_releases_its_blob(blob_app, client, folder):
+    upload(client, "a.txt")
+    upload(client, "a.txt", b"other content\n")
+
+    assert [refcount for _, refcount in get_blobs(blob_app)] == [1]
+    assert len(get_blob_files(blob_app)) == 1
+    with open(os.path.join(folder, "a.txt"), "rb") as f:
+        assert f.read() == b"other content\n"
+
+def test_reused_inode_does_not_release_blob(app, client, folder):
+    app.config.update({'BLOB_STORE_ENABLED': True, 'BLOB_LINK_MODE': "reflink"})
+    upload(client, "a.txt")
+    upload(client, "b.txt")
+    with app.app_context():
+        references = BlobReference.query.all()
+    if not references:
+        pytest.skip("reflinked files share the inode of the blob")
+
+    # a.txt is removed behind the app and its inode reused by an unrelated file
+    os.remove(os.path.join(folder, "a.txt"))
+    unrelated = os.path.join(folder, "unrelated.txt")
+    with open(unrelated, "wb") as f:
+        f.write(b"unrelated")
+    past = time.time() - 60
+    os.utime(unrelated, (past, past))
+    with app.app_context():
+        reference = db.session.get(BlobReference, os.stat(os.path.join(folder, "b.txt")).st_ino)
+        other = next(row for row in BlobReference.query.all() if row is not reference)
+        other.inode = os.stat(unrelated).st_ino
+        db.session.commit()
+
+    delete(client, "unrelated.txt")
+
+    # b.txt still holds the blob, the stale row is gone
+    assert [refcount for _, refcount in get_blobs(app)] == [2]
+    assert len(get_blob_files(app)) == 1
+    with app.app_context():
+        assert BlobReference.query.count() == 1
+
+    # The file removed behind the app is counted until blob-gc recounts
+    delete(client, "b.txt")
+    assert [refcount for _, refcount in get_blobs(app)] == [1]
+    with app.app_context():
+        assert collect_garbage() == (1, len(CONTENT))
+    assert get_blob_files(app) == []
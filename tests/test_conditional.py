@@ -0,0 +1,139 @@
+import os
+
+import pytest
+
+from file_browser.conditional import get_requested_ranges, MAX_RANGES
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def file_url(user_root):
+    with open(os.path.join(user_root, "data.txt"), "wb") as f:
+        f.write(CONTENT)
+    return "/download/data.txt"
+
+
+def requested_ranges(app, headers, file_size=len(CONTENT), etag="tag", last_modified=0):
+    with app.test_request_context(headers=headers):
+        return get_requested_ranges(file_size, etag, last_modified)
+
+
+def test_adjacent_ranges_are_merged(app):
+    assert requested_ranges(app, {'Range': "bytes=0-9,10-19,30-39"}) == [(0, 20), (30, 40)]
+
+def test_overlapping_ranges_send_whole_file(app):
+    # werkzeug refuses unordered and overlapping ranges
+    assert requested_ranges(app, {'Range': "bytes=0-9,5-19"}) is None
+    assert requested_ranges(app, {'Range': "bytes=30-39,0-9"}) is None
+
+def test_suffix_and_open_ranges(app):
+    assert requested_ranges(app, {'Range': "bytes=-100"}) == [(924, 1024)]
+    assert requested_ranges(app, {'Range': "bytes=1000-"}) == [(1000, 1024)]
+    assert requested_ranges(app, {'Range': "bytes=1000-5000"}) == [(1000, 1024)]
+
+def test_whole_file_without_usable_range(app):
+    assert requested_ranges(app, {}) is None
+    assert requested_ranges(app, {'Range': "lines=0-10"}) is None
+    assert requested_ranges(app, {'Range': "bytes=abc"}) is None
+    assert requested_ranges(app, {'Range': "bytes=0-9"}, file_size=0) is None
+
+    too_many = ",".join(f"{start}-{start}" for start in range(0, 2 * (MAX_RANGES + 1), 2))
+    assert requested_ranges(app, {'Range': f"bytes={too_many}"}) is None
+
+def test_unsatisfiable_range_is_empty(app):
+    assert requested_ranges(app, {'Range': "bytes=5000-6000"}) == []
+
+def test_if_range(app):
+    assert requested_ranges(app, {'Range': "bytes=0-9", 'If-Range': '"tag"'}) == [(0, 10)]
+    assert requested_ranges(app, {'Range': "bytes=0-9", 'If-Range': '"other"'}) is None
+    assert requested_ranges(app, {'Range': "bytes=0-9", 'If-Range': "Thu, 01 Jan 1970 00:00:00 GMT"}) == [(0, 10)]
+    assert requested_ranges(app, {'Range': "bytes=0-9", 'If-Range': "Thu, 01 Jan 1970 00:01:00 GMT"}) is None
+
+
+def test_download_single_range(client, file_url):
+    response = client.get(file_url, headers={'Range': "bytes=10-19"})
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f"bytes 10-19/{len(CONTENT)}"
+    assert response.data == CONTENT[10:20]
+
+def test_download_multiple_ranges(client, file_url):
+    response = client.get(file_url, headers={'Range': "bytes=0-3,100-103"})
+
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert f"Content-Range: bytes 0-3/{len(CONTENT)}".encode() in response.data
+    assert f"Content-Range: bytes 100-103/{len(CONTENT)}".encode() in response.data
+    assert CONTENT[100:104] in response.data
+    assert response.content_length == len(response.data)
+
+def test_download_unsatisfiable_range(client, file_url):
+    response = client.get(file_url, headers={'Range': "bytes=5000-"})
+
+    assert response.status_code == 416
+
+def test_if_none_match(client, file_url):
+    etag = client.get(file_url).headers['ETag']
+
+    response = client.get(file_url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+    # Not modified wins over the range
+    response = client.get(file_url, headers={'If-None-Match': etag, 'Range': "bytes=0-9"})
+    assert response.status_code == 304
+
+    response = client.get(file_url, headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+def test_if_range_mismatch_sends_whole_file(client, file_url):
+    response = client.get(file_url, headers={'Range': "bytes=0-9", 'If-Range': '"other"'})
+
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def get_flashes(client):
+    with client.session_transaction() as session:
+        return [message for _, message in session.pop('_flashes', [])]
+
+def test_download_flashes_only_sent_files(client, file_url):
+    etag = client.get(file_url).headers['ETag']
+    assert get_flashes(client) == ["File data.txt downloaded!"]
+
+    assert client.get(file_url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(file_url, headers={'Range': "bytes=5000-"}).status_code == 416
+    assert get_flashes(client) == []
+
+    assert client.get(file_url, headers={'Range': "bytes=0-9"}).status_code == 206
+    assert get_flashes(client) == ["File data.txt downloaded!"]
+
+def test_offloaded_download_does_not_hash(app, client, file_url, user_root):
+    from file_browser.models import FileHash
+
+    app.config['FILE_DELIVERY'] = "x-accel-redirect"
+    file_stat = os.stat(os.path.join(user_root, "data.txt"))
+
+    response = client.get(file_url)
+
+    assert response.headers['X-Accel-Redirect'].endswith("/data.txt")
+    assert response.data == b""
+    assert response.headers['ETag'] == f'"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+    assert 'X-File-Hash' not in response.headers
+    with app.app_context():
+        assert FileHash.query.count() == 0
+
+    assert client.get(file_url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+def test_offloaded_download_uses_stored_hash(app, client, file_url):
+    # Hashed and stored by a direct download
+    file_hash = client.get(file_url).headers['X-File-Hash']
+    app.config['FILE_DELIVERY'] = "x-sendfile"
+
+    response = client.get(file_url)
+
+    assert 'X-Sendfile' in response.headers
+    assert response.headers['X-File-Hash'] == file_hash
+    assert response.headers['ETag'] == f'"{file_hash}"'
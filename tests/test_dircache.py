@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+
+import pytest
+
+from file_browser import dircache
+from file_browser.dircache import DirectoryCache, ENTRY_SIZE_ESTIMATE
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is only available on Linux")
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / "folder"
+    folder.mkdir()
+    for name in ("a.txt", "b.txt"):
+        (folder / name).write_bytes(b"x")
+    past = time.time() - 60
+    os.utime(folder, (past, past))
+    return str(folder)
+
+@pytest.fixture
+def cache():
+    cache = DirectoryCache(max_bytes=100 * ENTRY_SIZE_ESTIMATE)
+    if cache.stats()['inotify'] is False:
+        pytest.skip("inotify is not available")
+    return cache
+
+
+def watched(cache):
+    return set(cache._watcher._watches)
+
+
+def test_stored_listing_is_watched(cache, folder):
+    entries, _rows = cache.get(folder)
+    assert sorted(entry.name for entry in entries) == ["a.txt", "b.txt"]
+    assert watched(cache) == {folder}
+
+    cache.get(folder)
+    assert cache.stats()['hits'] == 1
+
+    cache.invalidate(folder)
+    assert watched(cache) == set()
+
+def test_inotify_drops_changed_listing(cache, folder):
+    cache.get(folder)
+
+    with open(os.path.join(folder, "c.txt"), "wb"):
+        pass
+    for _ in range(100):
+        if not cache.stats()['directories']:
+            break
+        time.sleep(0.01)
+
+    assert cache.stats()['directories'] == 0
+
+def test_oversized_listing_is_not_watched(cache, folder):
+    cache.configure(ENTRY_SIZE_ESTIMATE)
+
+    cache.get(folder)
+
+    assert cache.stats()['directories'] == 0
+    assert watched(cache) == set()
+
+def test_listing_changed_while_scanning_is_not_watched(cache, folder, monkeypatch):
+    scandir = os.scandir
+
+    def changing_scandir(path):
+        cache.invalidate(path)
+        return scandir(path)
+
+    monkeypatch.setattr(dircache.os, "scandir", changing_scandir)
+
+    cache.get(folder)
+
+    assert cache.stats()['directories'] == 0
+    assert watched(cache) == set()
+
+def test_failed_scan_is_not_watched(cache, folder, monkeypatch):
+    def failing_scandir(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(dircache.os, "scandir", failing_scandir)
+
+    with pytest.raises(PermissionError):
+        cache.get(folder)
+
+    assert watched(cache) == set()
@@ -0,0 +1,127 @@
+import os
+import time
+import uuid
+
+import pytest
+
+from file_browser import db
+from file_browser.models import FileJob, User
+from file_browser.jobs import get_worker_token, sweep_orphaned_jobs, prune_finished_jobs, JOB_HISTORY
+from file_browser.quota import measure_user_storage
+
+from conftest import USERNAME, get_storage_used
+
+
+@pytest.fixture
+def tree(app, user_root):
+    """
+    home/project/ with 3 files in two folders (600 bytes) and an empty home/backup/
+    """
+    home = os.path.join(user_root, "home")
+    os.makedirs(os.path.join(home, "project", "src"))
+    os.makedirs(os.path.join(home, "backup"))
+    for path, size in (("project/a.txt", 100), ("project/src/b.txt", 200), ("project/src/c.txt", 300)):
+        with open(os.path.join(home, path), "wb") as f:
+            f.write(b"x" * size)
+
+    with app.app_context():
+        db.session.execute(db.update(User).values(storage_used=measure_user_storage(USERNAME)))
+        db.session.commit()
+    return home
+
+
+def wait_for_job(client, job_id):
+    for _ in range(500):
+        job = client.get(f"/jobs/{job_id}").get_json()
+        if job['finished_at'] is not None:
+            return job
+        time.sleep(0.01)
+    raise AssertionError("Job did not finish")
+
+def add_job(worker, status="running", finished_at=None):
+    record = FileJob(id=uuid.uuid4().hex, username=USERNAME, kind="delete", source="/nowhere",
+                     status=status, worker=worker, created_at=time.time(), finished_at=finished_at)
+    db.session.add(record)
+    db.session.commit()
+    return record.id
+
+
+def test_copy_job(app, client, tree):
+    response = client.post("/jobs", json={'op': "copy", 'path': "/home/project", 'destination': "/home/backup"})
+    assert response.status_code == 202
+
+    job = wait_for_job(client, response.get_json()['job_id'])
+
+    assert job['status'] == "done"
+    assert (job['done_items'], job['total_items']) == (5, 5)
+    assert job['done_bytes'] == 600
+    with open(os.path.join(tree, "backup", "project", "src", "c.txt"), "rb") as f:
+        assert f.read() == b"x" * 300
+    assert get_storage_used(app) == 1200
+
+def test_delete_job(app, client, tree):
+    response = client.post("/jobs", json={'op': "delete", 'path': "/home/project"})
+
+    job = wait_for_job(client, response.get_json()['job_id'])
+
+    assert job['status'] == "done"
+    assert not os.path.exists(os.path.join(tree, "project"))
+    assert get_storage_used(app) == 0
+
+def test_copy_job_over_quota(app, client, tree):
+    with app.app_context():
+        db.session.execute(db.update(User).values(storage_quota=1000))
+        db.session.commit()
+
+    response = client.post("/jobs", json={'op': "copy", 'path': "/home/project", 'destination': "/home/backup"})
+    job = wait_for_job(client, response.get_json()['job_id'])
+
+    assert job['status'] == "failed"
+    assert job['error'] == "Storage quota exceeded!"
+    assert os.listdir(os.path.join(tree, "backup")) == []
+
+def test_job_of_other_user_is_hidden(client, tree, app):
+    with app.app_context():
+        record = FileJob(id=uuid.uuid4().hex, username="someone", kind="delete", source="/x", created_at=0)
+        db.session.add(record)
+        db.session.commit()
+        job_id = record.id
+
+    assert client.get(f"/jobs/{job_id}").status_code == 404
+    assert client.post(f"/jobs/{job_id}/cancel").status_code == 404
+
+
+def test_sweep_marks_jobs_of_gone_processes(app):
+    with app.app_context():
+        live_id = add_job(get_worker_token())
+        gone_id = add_job("gone")
+        old_id = add_job(None, status="queued")
+        done_id = add_job("gone", status="done", finished_at=1.0)
+        stale_lock = os.path.join(app.config['JOB_LOCK_FOLDER'], "gone.lock")
+        open(stale_lock, "w").close()
+
+        assert sweep_orphaned_jobs() == 2
+
+        jobs = {job.id: job for job in FileJob.query.all()}
+        assert jobs[live_id].finished_at is None
+        for job_id in (gone_id, old_id):
+            assert (jobs[job_id].status, jobs[job_id].error) == ("failed", "Interrupted")
+            assert jobs[job_id].finished_at is not None
+        assert jobs[done_id].status == "done"
+        # Lock file of this process stays, the stale one is removed
+        assert os.listdir(app.config['JOB_LOCK_FOLDER']) == [f"{get_worker_token()}.lock"]
+
+        assert sweep_orphaned_jobs() == 0
+
+def test_prune_keeps_recent_history(app):
+    with app.app_context():
+        for number in range(JOB_HISTORY + 5):
+            add_job("gone", status="done", finished_at=float(number))
+        running_id = add_job(get_worker_token())
+
+        prune_finished_jobs(USERNAME)
+        db.session.remove()
+
+        finished = [job.finished_at for job in FileJob.query.filter(FileJob.finished_at.is_not(None))]
+        assert sorted(finished) == [float(number) for number in range(5, JOB_HISTORY + 5)]
+        assert db.session.get(FileJob, running_id) is not None
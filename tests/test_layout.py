@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from file_browser.models import FileHash
+from file_browser.helpers import get_layout_user_root, get_user_root, lock_user_folder
+from file_browser.layout import migrate_user, MIGRATION_MOVED, MIGRATION_IN_PLACE, MIGRATION_MISSING, MIGRATION_BUSY
+
+from conftest import USERNAME
+
+
+@pytest.fixture
+def flat_user(app, user_root):
+    with open(os.path.join(user_root, "notes.txt"), "wb") as f:
+        f.write(b"hello")
+    app.config['USERS_SPACE_LAYOUT'] = "sharded"
+    return user_root
+
+
+def test_user_is_moved_to_sharded_layout(app, client, flat_user):
+    # Hash stored under the flat path
+    file_hash = client.get("/download/notes.txt").headers['X-File-Hash']
+
+    with app.app_context():
+        # Not moved yet, the flat folder is still used
+        assert get_user_root(USERNAME) == flat_user
+
+        assert migrate_user(USERNAME, "sharded") == MIGRATION_MOVED
+
+        sharded_root = get_layout_user_root(USERNAME, "sharded")
+        assert get_user_root(USERNAME) == sharded_root
+        assert [row.path for row in FileHash.query.all()] == [os.path.join(sharded_root, "notes.txt")]
+
+    assert not os.path.exists(flat_user)
+    response = client.get("/download/notes.txt")
+    assert response.data == b"hello"
+    assert response.headers['X-File-Hash'] == file_hash
+
+def test_second_run_finds_user_in_place(app, flat_user):
+    with app.app_context():
+        migrate_user(USERNAME, "sharded")
+
+        assert migrate_user(USERNAME, "sharded") == MIGRATION_IN_PLACE
+
+def test_user_without_folder_is_missing(app, flat_user):
+    with app.app_context():
+        assert migrate_user("nobody", "sharded") == MIGRATION_MISSING
+
+def test_user_folder_in_use_is_busy(app, flat_user):
+    with app.app_context():
+        with lock_user_folder(USERNAME, shared=True):
+            assert migrate_user(USERNAME, "sharded") == MIGRATION_BUSY
+        assert os.path.isdir(flat_user)
+
+def test_move_back_to_flat_removes_empty_shards(app, flat_user):
+    with app.app_context():
+        migrate_user(USERNAME, "sharded")
+        app.config['USERS_SPACE_LAYOUT'] = "flat"
+
+        assert migrate_user(USERNAME, "flat") == MIGRATION_MOVED
+
+        assert os.listdir(app.config['UPLOAD_FOLDER']) == [USERNAME]
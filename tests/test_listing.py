@@ -0,0 +1,108 @@
+import os
+import json
+import base64
+import time
+
+import pytest
+
+from file_browser.listing import encode_cursor, decode_cursor
+from file_browser.helpers import UPLOAD_TEMP_PREFIX
+
+# Name and size of the files in the listed folder, sizes differ from the name order
+FILES = {"apple.txt": 30, "Banana.txt": 10, "cherry.txt": 70, "date.txt": 20,
+         "elder.txt": 50, "fig.txt": 40, "grape.txt": 60}
+
+PAGE_SIZE = 3
+
+
+@pytest.fixture
+def listed_folder(app, user_root):
+    app.config['LISTING_PAGE_SIZE'] = PAGE_SIZE
+    for name, size in FILES.items():
+        with open(os.path.join(user_root, name), "wb") as f:
+            f.write(b"x" * size)
+    # Hidden from the listing
+    with open(os.path.join(user_root, f"{UPLOAD_TEMP_PREFIX}unfinished.part"), "wb") as f:
+        f.write(b"x")
+    return user_root
+
+
+def list_pages(client, **query):
+    """
+    Names of all pages following next_cursor, and the number of pages
+    """
+    names = []
+    pages = 0
+    cursor = None
+    while True:
+        params = dict(query, cursor=cursor) if cursor else query
+        listing = client.get("/api/listing", query_string=params).get_json()
+        names.extend(row[0] for row in listing['rows'])
+        pages += 1
+        cursor = listing['next_cursor']
+        if cursor is None:
+            return names, pages
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("size", "desc", (1234, "a.txt"))
+
+    assert decode_cursor(cursor, "size", "desc") == (1234, "a.txt")
+
+def test_cursor_of_other_sort_is_ignored():
+    cursor = encode_cursor("size", "asc", (1234, "a.txt"))
+
+    assert decode_cursor(cursor, "size", "desc") is None
+    assert decode_cursor(cursor, "mtime", "asc") is None
+    assert decode_cursor(encode_cursor("name", "asc", ("a.txt", "a.txt")), "size", "asc") is None
+
+def test_broken_cursor_is_ignored():
+    def raw_cursor(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+    assert decode_cursor(None, "name", "asc") is None
+    assert decode_cursor("not a cursor!", "name", "asc") is None
+    assert decode_cursor(raw_cursor({"sort": "name"}), "name", "asc") is None
+    assert decode_cursor(raw_cursor(["name", "asc", "a"]), "name", "asc") is None
+    assert decode_cursor(raw_cursor(["size", "asc", "12", "a.txt"]), "size", "asc") is None
+
+
+@pytest.mark.parametrize("sort_by, order, expected", [
+    ("name", "asc", sorted(FILES, key=str.lower)),
+    ("name", "desc", sorted(FILES, key=str.lower, reverse=True)),
+    ("size", "asc", sorted(FILES, key=FILES.get)),
+    ("size", "desc", sorted(FILES, key=FILES.get, reverse=True)),
+])
+def test_pages_follow_cursor(client, listed_folder, sort_by, order, expected):
+    names, pages = list_pages(client, sort=sort_by, order=order)
+
+    assert names == expected
+    assert pages == -(-len(FILES) // PAGE_SIZE)
+
+def test_total_counts_whole_folder(client, listed_folder):
+    listing = client.get("/api/listing").get_json()
+
+    assert listing['total'] == len(FILES)
+    assert len(listing['rows']) == PAGE_SIZE
+
+def test_cursor_of_other_sort_starts_from_first_page(client, listed_folder):
+    cursor = client.get("/api/listing", query_string={'sort': "name"}).get_json()['next_cursor']
+
+    listing = client.get("/api/listing", query_string={'sort': "size", 'cursor': cursor}).get_json()
+
+    assert [row[0] for row in listing['rows']] == sorted(FILES, key=FILES.get)[:PAGE_SIZE]
+
+def test_listing_not_modified(client, listed_folder):
+    # The ETag is given only for folders not changed in the current clock tick
+    past = time.time() - 60
+    os.utime(listed_folder, (past, past))
+
+    etag = client.get("/api/listing").headers['ETag']
+
+    assert client.get("/api/listing", headers={'If-None-Match': etag}).status_code == 304
+
+    with open(os.path.join(listed_folder, "new.txt"), "wb"):
+        pass
+    os.utime(listed_folder, (past + 1, past + 1))
+
+    assert client.get("/api/listing", headers={'If-None-Match': etag}).status_code == 200
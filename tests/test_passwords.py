@@ -0,0 +1,59 @@
+from werkzeug.security import generate_password_hash
+
+from file_browser import create_app, db
+from file_browser.passwords import SharedBuckets, TokenBucketLimiter, get_password_method, needs_rehash
+
+
+def test_password_method_is_kept_per_app(app):
+    other_app = create_app(dict(app.config, PASSWORD_HASH_METHOD="pbkdf2:sha256:2000"))
+
+    with app.app_context():
+        assert get_password_method() == "pbkdf2:sha256:1000"
+    with other_app.app_context():
+        assert get_password_method() == "pbkdf2:sha256:2000"
+        assert needs_rehash(generate_password_hash("secret", method="pbkdf2:sha256:1000"))
+    with app.app_context():
+        assert get_password_method() == "pbkdf2:sha256:1000"
+        assert not needs_rehash(generate_password_hash("secret", method="pbkdf2:sha256:1000"))
+
+    with other_app.app_context():
+        db.session.remove()
+
+def test_default_method_parameters_are_filled_in(app):
+    app.config['PASSWORD_HASH_METHOD'] = "scrypt"
+    app.extensions['password_method'] = None
+
+    with app.app_context():
+        assert get_password_method().startswith("scrypt:")
+        assert not needs_rehash(generate_password_hash("secret", method="scrypt"))
+        assert needs_rehash(generate_password_hash("secret", method="scrypt", salt_length=8))
+
+
+def test_limiter_in_memory():
+    limiter = TokenBucketLimiter("test", capacity=2, rate=0)
+
+    assert limiter.allow("a") and limiter.allow("a")
+    assert not limiter.allow("a")
+    assert limiter.allow("b")
+
+    limiter.reset("a")
+    assert limiter.allow("a")
+
+def test_limiter_buckets_shared_between_processes(tmp_path):
+    # Two limiters on one database, like two workers
+    first = TokenBucketLimiter("test")
+    second = TokenBucketLimiter("test")
+    first.configure(2, 0, SharedBuckets(str(tmp_path / "limits.db")))
+    second.configure(2, 0, SharedBuckets(str(tmp_path / "limits.db")))
+
+    assert first.allow("a")
+    assert second.allow("a")
+    assert not first.allow("a")
+
+    second.reset("a")
+    assert first.allow("a")
+
+def test_unlimited_limiter():
+    limiter = TokenBucketLimiter("test")
+
+    assert all(limiter.allow("a") for _ in range(100))
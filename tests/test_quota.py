@@ -0,0 +1,131 @@
+import os
+import time
+
+import pytest
+
+from file_browser import db
+from file_browser.models import User, UploadScan
+from file_browser.quota import measure_user_storage, reconcile_user_storage, reconcile_all_users
+from file_browser.helpers import lock_user_folder
+from file_browser.scanning import SCAN_PENDING, SCAN_CLEAN, get_quarantine_path
+
+from conftest import USERNAME, get_storage_used
+
+
+@pytest.fixture
+def files(app, user_root):
+    """
+    home/a.txt (100 bytes), home/folder/ with two files (300 bytes) and an empty home/target/.
+    The usage counter starts measured.
+    """
+    home = os.path.join(user_root, "home")
+    os.makedirs(os.path.join(home, "folder"))
+    os.makedirs(os.path.join(home, "target"))
+    for path, size in (("a.txt", 100), ("folder/b.txt", 120), ("folder/c.txt", 180)):
+        with open(os.path.join(home, path), "wb") as f:
+            f.write(b"x" * size)
+
+    with app.app_context():
+        set_user(storage_used=measure_user_storage(USERNAME))
+    return home
+
+
+def set_user(**values):
+    db.session.execute(db.update(User).where(User.username == USERNAME).values(**values))
+    db.session.commit()
+
+def run_batch(client, *operations):
+    response = client.post("/batch", json={'operations': list(operations)})
+    assert response.status_code == 200
+    return response.get_json()['results']
+
+
+def test_copy_adds_usage(app, client, files):
+    assert get_storage_used(app) == 400
+
+    results = run_batch(client,
+                        {'op': "copy", 'path': "/home/a.txt", 'destination': "/home/target"},
+                        {'op': "copy", 'path': "/home/folder", 'destination': "/home/target"})
+
+    assert all(result['success'] for result in results)
+    assert get_storage_used(app) == 800
+
+def test_delete_frees_usage(app, client, files):
+    results = run_batch(client,
+                        {'op': "delete", 'path': "/home/a.txt"},
+                        {'op': "delete", 'path': "/home/folder/b.txt"})
+
+    assert all(result['success'] for result in results)
+    assert get_storage_used(app) == 180
+
+def test_move_and_rename_keep_usage(app, client, files):
+    results = run_batch(client,
+                        {'op': "move", 'path': "/home/a.txt", 'destination': "/home/target"},
+                        {'op': "rename", 'path': "/home/folder", 'new_name': "renamed"})
+
+    assert all(result['success'] for result in results)
+    assert get_storage_used(app) == 400
+
+def test_copy_over_quota_is_refused(app, client, files):
+    with app.app_context():
+        set_user(storage_quota=750)
+
+    # The second copy does not fit in what the first one left
+    results = run_batch(client,
+                        {'op': "copy", 'path': "/home/folder", 'destination': "/home/target"},
+                        {'op': "copy", 'path': "/home/a.txt", 'destination': "/home/target"})
+
+    assert results[0]['success']
+    assert not results[1]['success']
+    assert results[1]['error'] == "Storage quota exceeded!"
+    assert get_storage_used(app) == 700
+    assert not os.path.exists(os.path.join(files, "target", "a.txt"))
+
+def test_usage_matches_measured_tree(app, client, files):
+    run_batch(client,
+              {'op': "copy", 'path': "/home/folder", 'destination': "/home/target"},
+              {'op': "delete", 'path': "/home/a.txt"},
+              {'op': "mkdir", 'path': "/home", 'name': "new"})
+
+    with app.app_context():
+        assert get_storage_used(app) == measure_user_storage(USERNAME) == 600
+
+def test_upload_temp_files_are_not_reachable(client, files):
+    with open(os.path.join(files, ".upload-abc.part"), "wb") as f:
+        f.write(b"x")
+
+    results = run_batch(client, {'op': "delete", 'path': "/home/.upload-abc.part"})
+
+    assert not results[0]['success']
+    assert os.path.exists(os.path.join(files, ".upload-abc.part"))
+
+def add_quarantined_upload(scan_id, state, size):
+    quarantine_path = get_quarantine_path(scan_id)
+    with open(quarantine_path, "wb") as f:
+        f.write(b"x" * size)
+    db.session.add(UploadScan(id=scan_id, username=USERNAME, target_path="/nowhere", quarantine_path=quarantine_path,
+                              state=state, created_at=time.time(), updated_at=time.time()))
+    db.session.commit()
+
+def test_reconcile_counts_quarantined_uploads(app, files):
+    with app.app_context():
+        add_quarantined_upload("waiting", SCAN_PENDING, 50)
+        # Released already, a file left under the name is not the user's
+        add_quarantined_upload("released", SCAN_CLEAN, 70)
+        set_user(storage_used=0)
+
+        assert reconcile_user_storage(USERNAME) == 450
+    assert get_storage_used(app) == 450
+
+def test_reconcile_skips_user_folder_in_use(app, files):
+    with app.app_context():
+        set_user(storage_used=0)
+
+        # A request is writing into the folder
+        with lock_user_folder(USERNAME, shared=True):
+            assert reconcile_user_storage(USERNAME, blocking=False) is None
+            assert reconcile_all_users() == 0
+        assert get_storage_used(app) == 0
+
+        assert reconcile_all_users() == 1
+    assert get_storage_used(app) == 400
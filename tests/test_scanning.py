@@ -0,0 +1,114 @@
+import io
+import os
+import threading
+
+import pytest
+
+from file_browser import scanning
+from file_browser.scanning import ClamdScanner, create_fake_clamd, scan_upload, EICAR_TEST_STRING
+from file_browser.scanning import SCAN_PENDING, SCAN_CLEAN, SCAN_INFECTED, SCAN_MISSING
+
+from conftest import get_storage_used
+
+
+@pytest.fixture
+def clamd_address():
+    server = create_fake_clamd("127.0.0.1:0")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def scan_app(app, clamd_address, monkeypatch):
+    """
+    Scans enabled against the fake clamd. Scans are run by the test, not by the pool.
+    """
+    app.config.update({'UPLOAD_SCAN_ENABLED': True, 'CLAMD_ADDRESS': clamd_address})
+    monkeypatch.setattr(scanning, "submit_scan", lambda scan_id: False)
+    return app
+
+@pytest.fixture
+def folder(user_root):
+    folder = os.path.join(user_root, "docs")
+    os.makedirs(folder)
+    return folder
+
+
+def upload_form(client, name, content):
+    client.post("/upload_file", data={'folder_path': "/docs", 'upload_file_name': (io.BytesIO(content), name)},
+                content_type="multipart/form-data")
+
+def upload_chunked(client, name, content):
+    upload_id = client.post("/uploads", json={'file_name': name, 'folder_path': "/docs"}).get_json()['upload_id']
+    client.put(f"/uploads/{upload_id}", query_string={'offset': 0}, data=content)
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 202
+    return response.get_json()['scan_id']
+
+def get_scan_ids(app):
+    from file_browser.models import UploadScan
+
+    with app.app_context():
+        return [scan.id for scan in UploadScan.query.order_by(UploadScan.created_at).all()]
+
+def run_scan(app, scan_id):
+    with app.app_context():
+        return scan_upload(scan_id)
+
+
+def test_fake_clamd_detects_eicar(scan_app, tmp_path):
+    scanner = ClamdScanner.from_config(scan_app.config)
+    clean = tmp_path / "clean.txt"
+    clean.write_bytes(b"nothing to see\n" * 10000)
+    infected = tmp_path / "eicar.txt"
+    infected.write_bytes(EICAR_TEST_STRING)
+
+    assert scanner.scan(str(clean)) is None
+    assert scanner.scan(str(infected)) == "Eicar-Test-Signature"
+
+def test_clean_upload_is_released(scan_app, client, folder):
+    upload_form(client, "notes.txt", b"hello world")
+    scan_id, = get_scan_ids(scan_app)
+
+    # Waits in quarantine outside the user folder
+    assert os.listdir(folder) == []
+    assert len(os.listdir(scan_app.config['QUARANTINE_FOLDER'])) == 1
+    assert client.get(f"/uploads/scans/{scan_id}").get_json()['state'] == SCAN_PENDING
+
+    assert run_scan(scan_app, scan_id) == SCAN_CLEAN
+
+    with open(os.path.join(folder, "notes.txt"), "rb") as f:
+        assert f.read() == b"hello world"
+    assert os.listdir(scan_app.config['QUARANTINE_FOLDER']) == []
+    assert client.get(f"/uploads/scans/{scan_id}").get_json()['state'] == SCAN_CLEAN
+    assert get_storage_used(scan_app) == len(b"hello world")
+
+def test_infected_upload_is_removed(scan_app, client, folder):
+    scan_id = upload_chunked(client, "eicar.txt", EICAR_TEST_STRING)
+
+    assert run_scan(scan_app, scan_id) == SCAN_INFECTED
+
+    assert os.listdir(folder) == []
+    assert os.listdir(scan_app.config['QUARANTINE_FOLDER']) == []
+    assert client.get(f"/uploads/scans/{scan_id}").get_json()['signature'] == "Eicar-Test-Signature"
+    assert get_storage_used(scan_app) == 0
+
+def test_upload_to_renamed_folder_is_dropped(scan_app, client, folder):
+    upload_form(client, "notes.txt", b"hello world")
+    scan_id, = get_scan_ids(scan_app)
+    os.rename(folder, folder + "-renamed")
+
+    assert run_scan(scan_app, scan_id) == SCAN_MISSING
+
+    assert os.listdir(scan_app.config['QUARANTINE_FOLDER']) == []
+    assert get_storage_used(scan_app) == 0
+
+def test_failed_scan_stays_pending(scan_app, client, folder):
+    upload_form(client, "notes.txt", b"hello world")
+    scan_id, = get_scan_ids(scan_app)
+    scan_app.config['CLAMD_ADDRESS'] = "127.0.0.1:1"
+
+    assert run_scan(scan_app, scan_id) == SCAN_PENDING
+    assert os.listdir(folder) == []
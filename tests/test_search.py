@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+from file_browser.search import rebuild_user_index, is_rebuilding
+from file_browser.helpers import UPLOAD_TEMP_PREFIX
+
+from conftest import USERNAME
+
+
+@pytest.fixture
+def tree(user_root):
+    """
+    Notes.txt, report_2024.pdf, photos/holiday.jpg, photos/Summer.JPG and an upload temp file
+    """
+    os.makedirs(os.path.join(user_root, "photos"))
+    for path in ("Notes.txt", "report_2024.pdf", "photos/holiday.jpg", "photos/Summer.JPG",
+                 f"{UPLOAD_TEMP_PREFIX}abc.part"):
+        with open(os.path.join(user_root, path), "wb") as f:
+            f.write(b"x")
+    return user_root
+
+@pytest.fixture
+def indexed(app, tree):
+    with app.app_context():
+        assert rebuild_user_index(USERNAME) == 5
+    return tree
+
+
+def search(client, query, search_type="substring"):
+    response = client.get("/search", query_string={'q': query, 'type': search_type})
+    assert response.status_code == 200
+    return [result['path'] for result in response.get_json()['results']]
+
+def run_batch(client, *operations):
+    results = client.post("/batch", json={'operations': list(operations)}).get_json()['results']
+    assert all(result['success'] for result in results)
+
+
+def test_first_search_builds_index(client, tree):
+    response = client.get("/search", query_string={'q': "notes"}).get_json()
+    assert response['results'] == []
+
+    for _ in range(500):
+        if not is_rebuilding(USERNAME):
+            break
+        time.sleep(0.01)
+
+    assert search(client, "notes") == ["/Notes.txt"]
+
+def test_search_types(client, indexed):
+    assert search(client, "hol", "prefix") == ["/photos/holiday.jpg"]
+    assert search(client, "day") == ["/photos/holiday.jpg"]
+    # Short queries do not use the trigram index
+    assert search(client, "_2") == ["/report_2024.pdf"]
+    assert search(client, ".jpg", "ext") == ["/photos/holiday.jpg", "/photos/Summer.JPG"]
+    assert search(client, "photos", "prefix") == ["/photos"]
+
+def test_upload_temp_files_are_not_indexed(client, indexed):
+    assert search(client, "part", "ext") == []
+    assert search(client, UPLOAD_TEMP_PREFIX, "prefix") == []
+
+def test_invalid_search(client, indexed):
+    assert client.get("/search", query_string={'q': ""}).status_code == 400
+    assert client.get("/search", query_string={'q': "x", 'type': "regex"}).status_code == 400
+
+def test_index_follows_changes(client, indexed):
+    run_batch(client,
+              {'op': "rename", 'path': "/photos", 'new_name': "pictures"},
+              {'op': "delete", 'path': "/Notes.txt"},
+              {'op': "mkdir", 'path': "/", 'name': "archive"},
+              {'op': "copy", 'path': "/report_2024.pdf", 'destination': "/archive"})
+
+    assert search(client, "holiday") == ["/pictures/holiday.jpg"]
+    assert search(client, "photos", "prefix") == []
+    assert search(client, "notes") == []
+    assert sorted(search(client, "report")) == ["/archive/report_2024.pdf", "/report_2024.pdf"]
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from file_browser import create_app, db
+from file_browser.models import User
+
+from conftest import USERNAME
+
+PASSWORD = "correct horse"
+
+
+@pytest.fixture
+def session_app(app, user_root, tmp_path):
+    """
+    App with server side sessions in SQLite and a user with a known password
+    """
+    session_app = create_app(dict(app.config, SESSION_BACKEND="sqlite", SESSION_FOLDER=str(tmp_path / "sessions")))
+
+    with session_app.app_context():
+        db.session.execute(db.update(User).where(User.username == USERNAME)
+                           .values(password=generate_password_hash(PASSWORD, method="pbkdf2:sha256:1000")))
+        db.session.commit()
+    yield session_app
+
+    with session_app.app_context():
+        db.session.remove()
+
+
+def get_session_id(client, app):
+    cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+    return cookie.value if cookie else None
+
+def get_stored_ids(app):
+    with sqlite3.connect(os.path.join(app.config['SESSION_FOLDER'], "sessions.db")) as connection:
+        prefix = app.config['SESSION_KEY_PREFIX']
+        return {store_id[len(prefix):] for (store_id,) in connection.execute("SELECT id FROM sessions")}
+
+
+def test_login_and_logout_regenerate_session_id(session_app):
+    client = session_app.test_client()
+
+    # Anonymous session with something in it, like the id an attacker planted
+    with client.session_transaction() as session:
+        session['visited'] = True
+    anonymous_id = get_session_id(client, session_app)
+    assert anonymous_id in get_stored_ids(session_app)
+
+    response = client.post("/login", data={'username': USERNAME, 'password': PASSWORD})
+    assert response.status_code == 302
+    logged_in_id = get_session_id(client, session_app)
+
+    assert logged_in_id != anonymous_id
+    assert anonymous_id not in get_stored_ids(session_app)
+    assert client.get("/quota").status_code == 200
+
+    client.get("/logout")
+    logged_out_id = get_session_id(client, session_app)
+
+    assert logged_out_id != logged_in_id
+    assert logged_in_id not in get_stored_ids(session_app)
+
+def test_old_session_id_is_not_logged_in(session_app):
+    client = session_app.test_client()
+    with client.session_transaction() as session:
+        session['visited'] = True
+    anonymous_id = get_session_id(client, session_app)
+
+    client.post("/login", data={'username': USERNAME, 'password': PASSWORD})
+
+    # A client still holding the id from before the login
+    other_client = session_app.test_client()
+    other_client.set_cookie(session_app.config['SESSION_COOKIE_NAME'], anonymous_id)
+    assert other_client.get("/quota").status_code == 302
+
+def test_wrong_password_keeps_session_anonymous(session_app):
+    client = session_app.test_client()
+
+    response = client.post("/login", data={'username': USERNAME, 'password': "wrong"})
+
+    assert response.status_code == 302
+    assert client.get("/quota").status_code == 302
@@ -0,0 +1,187 @@
+import os
+import fcntl
+import hashlib
+
+import pytest
+from werkzeug.exceptions import ClientDisconnected
+
+from file_browser import db
+from file_browser.models import UploadSession
+from file_browser.uploads import get_upload, write_upload_chunk
+from file_browser.helpers import SNIFF_SIZE
+
+from conftest import USERNAME, get_storage_used
+
+CONTENT = b"".join(b"line %d of the uploaded text file\n" % number for number in range(400))
+
+
+@pytest.fixture
+def upload_id(client, user_root):
+    os.makedirs(os.path.join(user_root, "docs"))
+    response = client.post("/uploads", json={'file_name': "notes.txt", 'folder_path': "/docs", 'size': len(CONTENT)})
+    assert response.status_code == 201
+    assert response.get_json()['offset'] == 0
+    return response.get_json()['upload_id']
+
+
+def put_chunk(client, upload_id, offset, data):
+    return client.put(f"/uploads/{upload_id}", query_string={'offset': offset}, data=data)
+
+def get_temp_path(app, upload_id):
+    with app.app_context():
+        return db.session.get(UploadSession, upload_id).temp_path
+
+
+class DisconnectingStream:
+    """
+    Request body that breaks after the first read, like a client that went away
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size):
+        if self.data is None:
+            raise ClientDisconnected()
+        data, self.data = self.data, None
+        return data
+
+
+def test_chunks_and_finalize(app, client, user_root, upload_id):
+    middle = len(CONTENT) // 2
+
+    response = put_chunk(client, upload_id, 0, CONTENT[:middle])
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == middle
+
+    response = put_chunk(client, upload_id, middle, CONTENT[middle:])
+    assert response.get_json()['offset'] == len(CONTENT)
+
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 200
+
+    with open(os.path.join(user_root, "docs", "notes.txt"), "rb") as f:
+        assert f.read() == CONTENT
+    assert response.get_json()['hash'] == hashlib.new(app.config['FILE_HASH_ALGORITHM'], CONTENT).hexdigest()
+    assert get_storage_used(app) == len(CONTENT)
+    # The temp file was renamed into place
+    assert os.listdir(os.path.join(user_root, "docs")) == ["notes.txt"]
+
+def test_wrong_offset_is_refused(client, upload_id):
+    put_chunk(client, upload_id, 0, CONTENT[:100])
+
+    response = put_chunk(client, upload_id, 50, CONTENT[50:200])
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 100
+
+    response = put_chunk(client, upload_id, 200, CONTENT[200:300])
+    assert response.status_code == 409
+
+def test_finalize_incomplete_upload(client, upload_id):
+    put_chunk(client, upload_id, 0, CONTENT[:100])
+
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 409
+
+def test_chunk_over_declared_size(client, upload_id):
+    response = put_chunk(client, upload_id, 0, CONTENT + b"more")
+    assert response.status_code == 400
+
+def test_resume_after_disconnect(app, client, user_root, upload_id):
+    received = SNIFF_SIZE + 1000
+
+    with app.test_request_context():
+        upload = get_upload(upload_id, USERNAME)
+        with pytest.raises(ClientDisconnected):
+            write_upload_chunk(upload, DisconnectingStream(CONTENT[:received]), 0)
+
+    # The received position was saved, the client asks for it and sends the rest
+    status = client.get(f"/uploads/{upload_id}").get_json()
+    assert status['offset'] == received
+
+    response = put_chunk(client, upload_id, received, CONTENT[received:])
+    assert response.get_json()['offset'] == len(CONTENT)
+
+    expected_hash = hashlib.new(app.config['FILE_HASH_ALGORITHM'], CONTENT).hexdigest()
+    response = client.post(f"/uploads/{upload_id}/finalize", json={'hash': expected_hash})
+    assert response.status_code == 200
+
+    with open(os.path.join(user_root, "docs", "notes.txt"), "rb") as f:
+        assert f.read() == CONTENT
+
+def test_resume_in_other_process_rehashes(app, client, upload_id):
+    from file_browser import uploads
+
+    put_chunk(client, upload_id, 0, CONTENT[:500])
+    # Running hash of this process is lost, like after a restart or with another worker
+    uploads._upload_hashes.clear()
+    put_chunk(client, upload_id, 500, CONTENT[500:])
+
+    expected_hash = hashlib.new(app.config['FILE_HASH_ALGORITHM'], CONTENT).hexdigest()
+    assert client.post(f"/uploads/{upload_id}/finalize").get_json()['hash'] == expected_hash
+
+def test_wrong_hash_is_refused(client, upload_id):
+    put_chunk(client, upload_id, 0, CONTENT)
+
+    response = client.post(f"/uploads/{upload_id}/finalize", json={'hash': "0" * 128})
+    assert response.status_code == 400
+
+def test_busy_upload(app, client, upload_id):
+    with open(get_temp_path(app, upload_id), "rb") as f:
+        # Another request is writing the upload
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        response = put_chunk(client, upload_id, 0, CONTENT[:100])
+        assert response.status_code == 409
+
+        response = client.post(f"/uploads/{upload_id}/finalize")
+        assert response.status_code == 409
+
+def test_binary_content_after_short_first_chunk(app, client, upload_id):
+    # No NUL byte in the first chunk, the type is decided when SNIFF_SIZE bytes are known
+    assert put_chunk(client, upload_id, 0, b"MZ\x90").get_json()['offset'] == 3
+
+    response = put_chunk(client, upload_id, 3, b"\0" * SNIFF_SIZE)
+    assert response.status_code == 415
+    assert response.get_json()['offset'] == 3
+
+def test_short_binary_file_is_checked_on_finalize(client, user_root):
+    os.makedirs(os.path.join(user_root, "docs"))
+    upload_id = client.post("/uploads", json={'file_name': "tiny.txt", 'folder_path': "/docs"}).get_json()['upload_id']
+
+    put_chunk(client, upload_id, 0, b"\x7fELF\0\0")
+
+    assert client.post(f"/uploads/{upload_id}/finalize").status_code == 415
+
+def test_cancel_removes_temp_file(app, client, upload_id):
+    put_chunk(client, upload_id, 0, CONTENT[:100])
+    temp_path = get_temp_path(app, upload_id)
+
+    assert client.delete(f"/uploads/{upload_id}").status_code == 200
+    assert not os.path.exists(temp_path)
+    assert client.get(f"/uploads/{upload_id}").status_code == 404
+
+def test_temp_file_is_not_served(app, client, user_root, upload_id):
+    put_chunk(client, upload_id, 0, CONTENT[:100])
+    name = os.path.basename(get_temp_path(app, upload_id))
+
+    assert client.get(f"/download/docs/{name}").status_code == 404
+
+def test_chunk_over_form_limit_with_csrf(app, client, user_root):
+    app.config['WTF_CSRF_ENABLED'] = True
+    content = b"0123456789abcdef\n" * (20 * 1024 * 1024 // 17)
+    assert len(content) > app.config['MAX_CONTENT_LENGTH']
+
+    # Any page sets the token cookie read by the web client
+    client.get("/")
+    token = client.get_cookie("csrftoken").value
+    os.makedirs(os.path.join(user_root, "docs"))
+    upload_id = client.post("/uploads", json={'file_name': "big.txt", 'folder_path': "/docs"},
+                            headers={'X-CSRFToken': token}).get_json()['upload_id']
+
+    assert put_chunk(client, upload_id, 0, content).status_code == 400
+
+    response = client.put(f"/uploads/{upload_id}", query_string={'offset': 0}, data=content,
+                          headers={'X-CSRFToken': token})
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == len(content)
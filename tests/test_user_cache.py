@@ -0,0 +1,38 @@
+from file_browser import db
+from file_browser.models import User
+from file_browser.user_cache import user_cache
+
+from conftest import USERNAME
+
+
+def update_user(app, **values):
+    """
+    Change the row like another worker does, without invalidating the cache of this process
+    """
+    with app.app_context():
+        db.session.execute(db.update(User).where(User.username == USERNAME).values(**values))
+        db.session.commit()
+
+
+def test_cached_user_is_loaded_without_query(client):
+    client.get("/quota")
+    hits = user_cache.stats()['hits']
+
+    assert client.get("/cache_stats").status_code == 200
+    assert user_cache.stats()['hits'] == hits + 1
+
+def test_usage_changed_by_other_worker_is_seen(app, client):
+    assert client.get("/quota").get_json()['used'] == 0
+
+    update_user(app, storage_used=1234, storage_quota=5000)
+
+    quota = client.get("/quota").get_json()
+    assert user_cache.stats()['hits'] >= 1
+    assert (quota['used'], quota['quota'], quota['remaining']) == (1234, 5000, 3766)
+
+def test_only_stable_columns_are_cached(app, client):
+    client.get("/quota")
+
+    with app.app_context():
+        user_id = User.query.filter_by(username=USERNAME).one().id
+    assert set(user_cache.get(user_id)) == {'id', 'username'}
@@ -0,0 +1,5 @@
+from file_browser import create_app
+
+# WSGI entry point for production servers:
+# gunicorn -c gunicorn.conf.py wsgi:app
+app = create_app()